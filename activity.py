@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Frame energy activity detection, used to skip running the model on
+recordings with nothing in them
+
+This follows remove_silence() in Korimako_Detector.ipynb, which uses
+librosa.effects.split(): the waveform is cut into overlapping frames and
+each frame's energy compared with a reference level, all vectorized in
+NumPy. split() and remove_silence() use the loudest frame as the reference,
+as librosa does.
+
+That can't tell a silent recording from a busy one, as utils.load_audio_16k_mono()
+normalizes every recording to the same average level, so the gate instead
+compares each frame with the recording's noise floor (a low percentile of
+the frame energies). A frame is active if it is more than threshold_db
+above the floor. When the gate is applied after the band pass filters, as
+it is in score.py, this is the energy in the bird band only. Steady hiss
+or wind has few active frames, calls stand out above it. Frames of digital
+silence (at MIN_ENERGY) are left out of the floor, otherwise a recording
+ending in zeros would have a floor of -100 dB and every frame with any
+sound in it would be active.
+
+The defaults keep every recording in "top scorers/", the least active of
+which has 0.19 of its frames active, and skip the quiet night recordings in
+test_files/, which have under 0.03.
+
+@author: que
+"""
+
+import numpy as np
+
+# librosa's defaults, 128 ms frames every 32 ms at 16 kHz
+DEFAULT_FRAME_LENGTH = 2048
+DEFAULT_HOP_LENGTH = 512
+# Noise floor percentile of the frame energies
+DEFAULT_FLOOR_PERCENTILE = 5
+DEFAULT_THRESHOLD_DB = 6.0
+DEFAULT_MIN_ACTIVITY = 0.03
+# Smallest mean square energy, -100 dB
+MIN_ENERGY = 1e-10
+MIN_DB = 10*np.log10(MIN_ENERGY)
+
+
+def frame_db(wave_data, frame_length = DEFAULT_FRAME_LENGTH,
+             hop_length = DEFAULT_HOP_LENGTH):
+    """
+    Return the mean square energy in dB of frames of wave_data, one every
+    hop_length samples. Frames are centred on their start sample with the
+    waveform zero padded at each end, as librosa does.
+    """
+    pad = frame_length//2
+    squares = np.square(np.asarray(wave_data, dtype=np.float64))
+    # Frame sums from differences of the cumulative sum, rather than a copy
+    # of every frame
+    cumulative = np.concatenate((np.zeros(pad + 1), np.cumsum(squares),
+                                 np.full(pad, np.sum(squares))))
+    starts = np.arange(0, len(wave_data) + 1, hop_length)
+    energy = (cumulative[starts + frame_length] - cumulative[starts])/frame_length
+    return 10*np.log10(np.maximum(energy, MIN_ENERGY))
+
+
+def active_frames(wave_data, threshold_db = DEFAULT_THRESHOLD_DB,
+                  floor_percentile = DEFAULT_FLOOR_PERCENTILE,
+                  frame_length = DEFAULT_FRAME_LENGTH, hop_length = DEFAULT_HOP_LENGTH):
+    """
+    Return a boolean array, one per frame from frame_db(), of the frames
+    more than threshold_db above the noise floor of wave_data. The floor
+    ignores silent frames and none are active if every frame is silent.
+    """
+    db = frame_db(wave_data, frame_length, hop_length)
+    sound = db > MIN_DB
+    if not np.any(sound):
+        return sound
+    return db > np.percentile(db[sound], floor_percentile) + threshold_db
+
+
+def activity(wave_data, threshold_db = DEFAULT_THRESHOLD_DB,
+             floor_percentile = DEFAULT_FLOOR_PERCENTILE):
+    """
+    Return the fraction of the frames of wave_data that are active (see
+    active_frames()), from 0 to 1
+    """
+    if len(wave_data) == 0:
+        return 0.0
+    return float(np.mean(active_frames(wave_data, threshold_db, floor_percentile)))
+
+
+def split(wave_data, top_db = 60, frame_length = DEFAULT_FRAME_LENGTH,
+          hop_length = DEFAULT_HOP_LENGTH):
+    """
+    Return a (num_intervals, 2) array of the [start, end) samples of the
+    runs of frames within top_db of the loudest frame, like
+    librosa.effects.split()
+    """
+    db = frame_db(wave_data, frame_length, hop_length)
+    loud = db > np.max(db) - top_db
+    # Runs start where the padded mask goes up and end where it goes down
+    changes = np.diff(np.concatenate(([0], loud.astype(np.int8), [0])))
+    starts = np.flatnonzero(changes == 1)*hop_length
+    ends = np.minimum(np.flatnonzero(changes == -1)*hop_length, len(wave_data))
+    return np.stack((starts, ends), axis=1)
+
+
+def remove_silence(wave_data, top_db = 50, min_chunk_size = 2000, merge_chunks = True):
+    """
+    Return the parts of wave_data within top_db of its loudest frame that
+    are at least min_chunk_size samples long, joined together if
+    merge_chunks is True or as a list otherwise. As remove_silence() in
+    Korimako_Detector.ipynb, None if merged and there are no such parts.
+    """
+    intervals = split(wave_data, top_db=top_db)
+    chunks = [wave_data[start:end] for (start, end) in intervals
+              if end - start >= min_chunk_size]
+    if not merge_chunks:
+        return chunks
+    return np.concatenate(chunks) if chunks else None
+
+
+class ActivityGate:
+    """
+    Decides whether a filtered waveform has enough activity to be worth
+    running the model on, and counts the recordings and model runs skipped
+
+    A recording is skipped if less than min_activity of its frames are more
+    than threshold_db above its noise floor (see activity()).
+    """
+
+    def __init__(self, threshold_db = DEFAULT_THRESHOLD_DB,
+                 min_activity = DEFAULT_MIN_ACTIVITY,
+                 floor_percentile = DEFAULT_FLOOR_PERCENTILE):
+        self.threshold_db = threshold_db
+        self.min_activity = min_activity
+        self.floor_percentile = floor_percentile
+        self.checked = 0
+        self.skipped = 0
+        self.runs_skipped = 0
+        self.seconds_skipped = 0.0
+
+    def check(self, wave_data, num_offsets = 1, sample_rate = 16000):
+        """
+        Return True if the model should be run on wave_data. Otherwise the
+        recording, its length and its num_offsets runs of the model are
+        counted as skipped.
+        """
+        self.checked += 1
+        if activity(wave_data, self.threshold_db, self.floor_percentile) >= self.min_activity:
+            return True
+        self.skipped += 1
+        self.runs_skipped += num_offsets
+        self.seconds_skipped += len(wave_data)/float(sample_rate)
+        return False
+
+    def print_summary(self):
+        """
+        Print how many recordings and model runs (one per offset) were
+        skipped
+        """
+        if self.checked == 0:
+            return
+        print("Activity gate: skipped {:d} of {:d} recordings ({:.1f}%), "
+              "{:d} model runs, {:.0f} s of audio".format(
+                  self.skipped, self.checked, 100.0*self.skipped/self.checked,
+                  self.runs_skipped, self.seconds_skipped))
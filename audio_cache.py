@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+On-disk cache of downloaded recordings, so rescoring with different
+filter or offset settings doesn't download and decode everything again
+
+Raw recordings are stored once per SHA256 of their contents under
+raw/, with an SQLite index mapping recording IDs to hashes. The decoded
+16 kHz mono float32 audio, as returned by utils.load_audio_16k_mono() with
+its default window and level, is kept next to it under decoded/ as a .npy
+file that is memory mapped when read. The least recently used files are
+deleted once the cache is larger than max_size_mb.
+
+CachedClient wraps a Cacophony API client (or local_api.LocalAPI) so
+download_raw() reads from the cache, and adds load_audio() which also skips
+decoding. It is safe to use from several threads and processes.
+
+@author: que
+"""
+
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import utils
+import timing
+
+DEFAULT_MAX_SIZE_MB = 10240
+RAW = "raw"
+DECODED = "decoded"
+
+
+class AudioCache:
+    """
+    Content addressed cache of raw and decoded recordings in directory,
+    holding at most max_size_mb of files
+    """
+
+    def __init__(self, directory, max_size_mb = DEFAULT_MAX_SIZE_MB):
+        self.directory = directory
+        self.max_bytes = int(max_size_mb*1024*1024)
+        self.hits = {RAW: 0, DECODED: 0}
+        self.misses = {RAW: 0, DECODED: 0}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.con = sqlite3.connect(os.path.join(directory, "index.db"), isolation_level=None,
+                                   check_same_thread=False, timeout=60)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute('''CREATE TABLE IF NOT EXISTS recordings
+                 (rec_id INTEGER NOT NULL PRIMARY KEY,
+                 sha256 TEXT) ''')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS files
+                 (name TEXT NOT NULL PRIMARY KEY,
+                 sha256 TEXT,
+                 kind TEXT,
+                 nbytes INT,
+                 last_access REAL) ''')
+        self.con.execute("CREATE INDEX IF NOT EXISTS files_last_access ON files(last_access)")
+
+    @staticmethod
+    def file_name(kind, sha256, sample_rate = None):
+        """
+        Return the path of a cached file relative to the cache directory
+        """
+        if kind == RAW:
+            return os.path.join(RAW, sha256[:2], sha256)
+        return os.path.join(DECODED, sha256[:2], "{}-{:d}.npy".format(sha256, sample_rate))
+
+    def lookup(self, rec_id, kind, sample_rate = None):
+        """
+        Return the path of the cached file of kind for rec_id, marking it as
+        used, or None if it isn't cached
+        """
+        with self.lock:
+            row = self.con.execute("SELECT sha256 FROM recordings WHERE rec_id = ?",
+                                   (rec_id,)).fetchone()
+            name = None
+            if row is not None:
+                name = self.file_name(kind, row[0], sample_rate)
+                cur = self.con.execute("UPDATE files SET last_access = ? WHERE name = ?",
+                                       (time.time(), name))
+                if cur.rowcount == 0 or not os.path.exists(os.path.join(self.directory, name)):
+                    name = None
+            if name is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+            return os.path.join(self.directory, name)
+
+    def store(self, name, sha256, kind, write):
+        """
+        Write a new cached file "name" by calling write(f) on a temporary
+        file, index it and evict old files if the cache is full
+        """
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first so a partial file is never read
+        tmp_path = "{}.{:d}.{:d}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.con.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)",
+                             (name, sha256, kind, os.path.getsize(path), time.time()))
+            self.evict()
+
+    def get_raw(self, rec_id):
+        """
+        Return the raw recording rec_id as bytes, or None if it isn't cached
+        or its contents don't match its hash
+        """
+        path = self.lookup(rec_id, RAW)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != os.path.basename(path):
+            self.discard(path, RAW)
+            return None
+        return data
+
+    def put_raw(self, rec_id, data):
+        """
+        Cache the raw recording rec_id, the bytes data
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.con.execute("INSERT OR REPLACE INTO recordings VALUES (?,?)", (rec_id, sha256))
+        self.store(self.file_name(RAW, sha256), sha256, RAW, lambda f: f.write(data))
+
+    def get_decoded(self, rec_id, sample_rate):
+        """
+        Return the decoded audio of recording rec_id at sample_rate as a
+        read only memory mapped float32 array, or None if it isn't cached
+        """
+        path = self.lookup(rec_id, DECODED, sample_rate)
+        if path is None:
+            return None
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            self.discard(path, DECODED)
+            return None
+
+    def discard(self, path, kind):
+        """
+        Delete the damaged cached file at path, counting the lookup that
+        found it as a miss
+        """
+        with self.lock:
+            self.hits[kind] -= 1
+            self.misses[kind] += 1
+            self.con.execute("DELETE FROM files WHERE name = ?",
+                             (os.path.relpath(path, self.directory),))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def put_decoded(self, rec_id, sample_rate, wave_data):
+        """
+        Cache the decoded audio of recording rec_id, which must already have
+        its raw recording cached
+        """
+        with self.lock:
+            row = self.con.execute("SELECT sha256 FROM recordings WHERE rec_id = ?",
+                                   (rec_id,)).fetchone()
+        if row is None:
+            return
+        self.store(self.file_name(DECODED, row[0], sample_rate), row[0], DECODED,
+                   lambda f: np.save(f, np.asarray(wave_data, dtype=np.float32)))
+
+    def evict(self):
+        """
+        Delete the least recently used files until the cache is no more than
+        max_bytes. Called with the lock held.
+        """
+        total = self.con.execute("SELECT COALESCE(SUM(nbytes), 0) FROM files").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for (name, nbytes) in self.con.execute("SELECT name, nbytes FROM files ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            stale.append((name,))
+            total -= nbytes
+        for (name,) in stale:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        self.con.executemany("DELETE FROM files WHERE name = ?", stale)
+
+    def print_summary(self):
+        """
+        Print the hits and misses of the raw and decoded caches
+        """
+        print("Audio cache: raw {:d} hits, {:d} misses, decoded {:d} hits, {:d} misses".format(
+            self.hits[RAW], self.misses[RAW], self.hits[DECODED], self.misses[DECODED]))
+
+    def close(self):
+        self.con.close()
+
+
+class CachedClient:
+    """
+    Wraps the API client "client" so recordings are read from the
+    AudioCache "cache" before they are downloaded. Other calls are passed
+    through to the client.
+    """
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def download_raw(self, rec_id):
+        """
+        Yield the raw recording rec_id in chunks, as the API does, from the
+        cache or downloaded and added to the cache
+        """
+        data = self.cache.get_raw(rec_id)
+        if data is None:
+            data = b"".join(self.client.download_raw(rec_id))
+            self.cache.put_raw(rec_id, data)
+        yield data
+
+    def load_audio(self, rec_id, sample_rate = 16000, timings = None):
+        """
+        Return a tuple of the decoded audio of recording rec_id, as from
+        utils.load_audio_16k_mono(), and the number of bytes downloaded
+        for it. The decoded audio comes from the cache if it's there.
+        Download and decoding times are added to timings.
+        """
+        wave_data = self.cache.get_decoded(rec_id, sample_rate)
+        if wave_data is not None:
+            return (wave_data, 0)
+
+        data = self.cache.get_raw(rec_id)
+        num_bytes = 0
+        if data is None:
+            with timing.timed(timings, "download"):
+                data = b"".join(self.client.download_raw(rec_id))
+            num_bytes = len(data)
+            self.cache.put_raw(rec_id, data)
+
+        with timing.timed(timings, "decode"):
+            wave_data = utils.load_audio_16k_mono("", out_sample_rate=sample_rate,
+                                                  stream=io.BytesIO(data),
+                                                  stream_type=utils.client_stream_type(self.client))
+        self.cache.put_decoded(rec_id, sample_rate, wave_data)
+        return (wave_data, num_bytes)
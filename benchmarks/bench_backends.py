@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the TFLite model backends against the SavedModel: per-frame bird
+score parity and the top class/threshold scores on the same files, and
+model throughput
+
+Convert the TFLite models first (see tflite_model.py), then run from the top
+of the repository:
+
+    python benchmarks/bench_backends.py [--num-offsets 3] [--threads 1] [directory ...]
+
+@author: que
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import utils
+import score
+
+
+def score_files(waves, model, num_offsets):
+    """
+    Run the model over every decoded waveform and return a tuple of
+    (cpu_seconds, wall_seconds, list of score.ScoreResult)
+    """
+    results = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for wave_data in waves:
+        (outputs, offset) = score.model_outputs(model, wave_data, num_offsets,
+                                                single_pass=True)
+        results.append(score.score_model_outputs(outputs, utils.BIRDS_CLASSES,
+                                                 offset=offset))
+    return (time.process_time() - cpu_start, time.perf_counter() - wall_start,
+            results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directories", nargs="*", default=["test_files"])
+    parser.add_argument("--num-offsets", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="TFLite interpreter threads")
+    parser.add_argument("--backends", nargs="+", default=list(utils.MODEL_BACKENDS[1:]))
+    args = parser.parse_args()
+
+    files = []
+    for d in args.directories:
+        files += sorted(glob.glob(os.path.join(d, "**", "*.mp3"), recursive=True))
+    # Decode once so only the model is timed
+    waves = [utils.load_audio_16k_mono(f) for f in files]
+    audio_seconds = sum(len(w) for w in waves)/16000.0
+
+    print("Files: {:d} ({:.0f} s of audio), offsets: {:d}\n".format(
+        len(files), audio_seconds, args.num_offsets))
+    print("{:12s} {:>8s} {:>8s} {:>9s} {:>10s} {:>10s} {:>10s}".format(
+        "backend", "CPU s", "wall s", "audio s/s", "max frame", "max class", "max thresh"))
+
+    reference = None
+    for backend in ["savedmodel"] + args.backends:
+        model, class_names = utils.load_model_and_class_names(backend, num_threads=args.threads)
+        # Warm up so graph tracing and tensor allocation aren't timed
+        score.model_outputs(model, waves[0], args.num_offsets, single_pass=True)
+        (cpu, wall, results) = score_files(waves, model, args.num_offsets)
+        if reference is None:
+            reference = results
+
+        # Largest differences from the SavedModel in the per-frame maximum bird
+        # score and the per-file scores
+        frame_diff = max(np.max(np.abs(a.max_bird_scores - b.max_bird_scores))
+                         for a, b in zip(reference, results))
+        class_diff = max(abs(a.top_class_score - b.top_class_score)
+                         for a, b in zip(reference, results))
+        thresh_diff = max(abs(a.threshold_score - b.threshold_score)
+                          for a, b in zip(reference, results))
+        print("{:12s} {:8.2f} {:8.2f} {:9.1f} {:10.4f} {:10.4f} {:10.4f}".format(
+            backend, cpu, wall, audio_seconds/wall, frame_diff, class_diff, thresh_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the import time of the scoring modules with python -X importtime and
+check them against the budget in import_budget.json, so the headless
+scoring path stays quick to start.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_import_time.py [--output results.json] [--repeat 5]
+
+Exits with status 1 if any module takes longer than its budget. Each module
+is imported in a fresh interpreter and the best of --repeat runs is kept.
+
+@author: que
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, "..")
+BUDGET_FILE = os.path.join(BENCH_DIR, "import_budget.json")
+
+
+def import_times(module):
+    """
+    Import module in a fresh interpreter and return a dictionary of
+    cumulative import time in milliseconds for every module it loaded
+    """
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                       cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       universal_newlines=True, check=True)
+    times = {}
+    for line in p.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        times[fields[2].strip()] = int(fields[1])/1000.0
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default=None,
+                        help="Save the results to this JSON file")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5,
+                        help="Show the slowest N modules pulled in by each import")
+    args = parser.parse_args()
+
+    with open(BUDGET_FILE) as f:
+        budget = json.load(f)
+
+    results = {}
+    over_budget = False
+    for module, budget_ms in budget.items():
+        runs = [import_times(module) for i in range(args.repeat)]
+        best = min(runs, key=lambda times: times[module])
+        results[module] = {"cumulative_ms": best[module], "budget_ms": budget_ms}
+
+        status = "ok" if best[module] <= budget_ms else "OVER BUDGET"
+        over_budget |= best[module] > budget_ms
+        print("{:12s} {:8.1f} ms  (budget {:6.0f} ms) {}".format(module, best[module],
+                                                                 budget_ms, status))
+        slowest = sorted((t, name) for name, t in best.items() if name != module)[::-1]
+        for t, name in slowest[:args.top]:
+            print("    {:30s} {:8.1f} ms".format(name, t))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
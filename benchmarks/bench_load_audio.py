@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the windowed decoding in utils.load_audio_16k_mono() with the
+previous implementation, which decoded and resampled the whole file with
+pydub, normalised the gain over the full clip and then sliced the window.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_load_audio.py [--end-time 40] [directory ...]
+
+@author: que
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import pydub
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import utils
+
+
+def full_decode_load_audio_16k_mono(filename, out_sample_rate=16000, target_db = -20,
+                                    start_time = 0, end_time=40):
+    """
+    The previous implementation of utils.load_audio_16k_mono(), mono files only
+    """
+    a = pydub.AudioSegment.from_file(filename, os.path.splitext(filename)[1][1:].lower())
+    a = a.set_frame_rate(out_sample_rate)
+    gain_change = target_db - a.dBFS
+    a = a.apply_gain(gain_change)
+    wav = np.array(a.get_array_of_samples(), dtype='float32')
+    wav = np.float32(wav) / 2**15
+    if a.channels == 2:
+        wav = wav.reshape((-1, 2))
+    return wav[out_sample_rate*start_time:out_sample_rate*end_time]
+
+
+def time_loading(load, files, start_time, end_time):
+    """
+    Load every file in files with load() and return a tuple of (cpu_seconds,
+    wall_seconds, list of waveforms). CPU time includes the ffmpeg child
+    processes.
+    """
+    waves = []
+    cpu_start = sum(os.times()[:4])
+    wall_start = time.perf_counter()
+    for f in files:
+        waves.append(load(f, start_time=start_time, end_time=end_time))
+    return (sum(os.times()[:4]) - cpu_start, time.perf_counter() - wall_start, waves)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directories", nargs="*", default=["test_files"])
+    parser.add_argument("--start-time", type=int, default=0)
+    parser.add_argument("--end-time", type=int, default=40)
+    args = parser.parse_args()
+
+    files = []
+    for d in args.directories:
+        files += sorted(glob.glob(os.path.join(d, "**", "*.mp3"), recursive=True))
+
+    cpu_full, wall_full, full = time_loading(full_decode_load_audio_16k_mono, files,
+                                             args.start_time, args.end_time)
+    cpu_window, wall_window, window = time_loading(utils.load_audio_16k_mono, files,
+                                                   args.start_time, args.end_time)
+
+    audio_seconds = sum(len(w) for w in window)/16000.0
+    max_length_diff = max(abs(len(a) - len(b)) for a, b in zip(full, window))
+
+    print("Files decoded:         {:d} ({:.0f}s of audio)".format(len(files), audio_seconds))
+    print("Full decode:           CPU {:7.2f}s  wall {:7.2f}s".format(cpu_full, wall_full))
+    print("Windowed decode:       CPU {:7.2f}s  wall {:7.2f}s".format(cpu_window, wall_window))
+    print("CPU speedup:           {:5.2f}x".format(cpu_full/cpu_window))
+    print("Wall speedup:          {:5.2f}x".format(wall_full/wall_window))
+    print("Max length difference: {:d} samples".format(max_length_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the CPU time of score.score_audio_file() with one model call per
+offset against the single pass mode, and check that both give the same scores
+
+Run from the top of the repository:
+
+    python benchmarks/bench_single_pass.py [--num-offsets 3] [directory ...]
+
+@author: que
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import utils
+import score
+
+
+def time_scoring(files, model, num_offsets, single_pass):
+    """
+    Score every file in files and return a tuple of (cpu_seconds,
+    wall_seconds, list of scores)
+    """
+    results = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for f in files:
+        results.append(score.score_audio_file(f, model, utils.BIRDS_CLASSES,
+                                              num_offsets=num_offsets,
+                                              single_pass=single_pass))
+    return (time.process_time() - cpu_start, time.perf_counter() - wall_start,
+            results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directories", nargs="*", default=["test_files"])
+    parser.add_argument("--num-offsets", type=int, default=3)
+    args = parser.parse_args()
+
+    files = []
+    for d in args.directories:
+        files += sorted(glob.glob(os.path.join(d, "**", "*.mp3"), recursive=True))
+
+    model, class_names = utils.load_model_and_class_names()
+
+    # Warm up the model so graph tracing isn't counted against either mode
+    score.score_audio_file(files[0], model, utils.BIRDS_CLASSES,
+                           num_offsets=args.num_offsets, single_pass=True)
+    score.score_audio_file(files[0], model, utils.BIRDS_CLASSES,
+                           num_offsets=args.num_offsets, single_pass=False)
+
+    cpu_multi, wall_multi, multi = time_scoring(files, model, args.num_offsets, False)
+    cpu_single, wall_single, single = time_scoring(files, model, args.num_offsets, True)
+
+    max_diff = max(max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+                   for a, b in zip(multi, single))
+
+    print("Files scored:          {:d}".format(len(files)))
+    print("Offsets:               {:d}".format(args.num_offsets))
+    print("One call per offset:   CPU {:7.2f}s  wall {:7.2f}s".format(cpu_multi, wall_multi))
+    print("Single pass:           CPU {:7.2f}s  wall {:7.2f}s".format(cpu_single, wall_single))
+    print("CPU speedup:           {:5.2f}x".format(cpu_multi/cpu_single))
+    print("Max score difference:  {:g}".format(max_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time each stage of the scoring path separately on the bundled clips:
+
+    decode    utils.load_audio_16k_mono
+    filter    the Butterworth filters (score.filter_wave_data)
+    gate      the activity measure of the --activity-gate (activity.activity)
+    model     the model calls for every offset (score.model_outputs)
+    count     the per-frame bird counting (score.score_model_outputs)
+    insert    the SQLite inserts into the score_db scores table
+
+and report throughput in recordings/s and audio seconds/s with the peak RSS
+after each stage. Results are saved as JSON so runs on different commits can
+be compared with --compare.
+
+Run from the top of the repository:
+
+    python benchmarks/run_benchmarks.py -o bench.json
+    python benchmarks/run_benchmarks.py -o new.json --compare bench.json
+
+If the model can't be loaded the model stage is skipped and the counting
+stage is timed on random scores with the same number of frames.
+
+@author: que
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import utils
+import score
+import activity
+import score_db
+import score_dir
+
+DEFAULT_DIRECTORIES = [os.path.join(REPO_DIR, d) for d in ("test_files", "outliers", "top scorers")]
+SAMPLE_RATE = 16000
+NUM_CLASSES = 521
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size so far of this process and of its
+    largest finished child (ffmpeg) in MB
+    """
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    scale = 1024*1024 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/scale)
+
+
+def time_stage(func, items, repeat):
+    """
+    Call func on every item in items, repeat times, and return a tuple of the
+    results of the last run and a dictionary of the fastest run's timings
+    """
+    best = None
+    for i in range(repeat):
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        results = [func(item) for item in items]
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        if best is None or wall < best[0]:
+            best = (wall, cpu)
+
+    (rss, child_rss) = peak_rss_mb()
+    return (results, {"wall_seconds": best[0],
+                      "cpu_seconds": best[1],
+                      "peak_rss_mb": rss,
+                      "peak_child_rss_mb": child_rss})
+
+
+def report(name, stats, recordings, audio_seconds):
+    """
+    Add the throughput of a stage to its timings from time_stage(), print
+    them and return them. audio_seconds is None if it doesn't apply.
+    """
+    wall = stats["wall_seconds"]
+    stats["recordings"] = recordings
+    stats["audio_seconds"] = audio_seconds
+    stats["recordings_per_s"] = recordings/wall
+    stats["audio_seconds_per_s"] = None if audio_seconds is None else audio_seconds/wall
+    print("{:8s} {:6d} {:9.3f} {:9.3f} {:10.1f} {:>10s} {:9.1f}".format(
+        name, recordings, wall, stats["cpu_seconds"], stats["recordings_per_s"],
+        "-" if audio_seconds is None else "{:.1f}".format(stats["audio_seconds_per_s"]),
+        stats["peak_rss_mb"]), flush=True)
+    return stats
+
+
+def make_records(count):
+    """
+    Return count Cacophony style recording records for the insert stage
+    """
+    start = datetime.datetime(2021, 9, 17, 5, 0, tzinfo=datetime.timezone.utc)
+    return [{"id": i + 1,
+             "deviceId": i % 10,
+             "deviceName": "bench-{:d}".format(i % 10),
+             "recordingDateTime": (start + datetime.timedelta(minutes=i)).isoformat(),
+             "location": {"lat": -43.5, "lng": 172.6}} for i in range(count)]
+
+
+def insert_rows(rows, batch_size):
+    """
+    Insert rows into a new scores table in a temporary database, committing
+    every batch_size rows as score_db does
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        con = sqlite3.connect(os.path.join(tmp, "bench.db"),
+                              detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        score_db.configure_connection(con)
+        score_db.create_sql_table(con)
+        # insert_score_rows prints each row, which shouldn't be timed
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(0, len(rows), batch_size):
+                score_db.insert_score_rows(con, rows[i:i + batch_size])
+                con.commit()
+        con.close()
+
+
+def git_commit():
+    """
+    Return the current git commit of the repository, or None
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_file):
+    """
+    Print the change in wall time of each stage against a previous results
+    file
+    """
+    with open(previous_file) as f:
+        previous = json.load(f)
+    print("\nCompared with {} ({}):".format(previous_file, previous.get("commit")))
+    for name, stats in results["stages"].items():
+        if name not in previous["stages"]:
+            continue
+        before = previous["stages"][name]["wall_seconds"]
+        print("{:8s} {:9.3f}s -> {:9.3f}s  {:6.2f}x".format(
+            name, before, stats["wall_seconds"], before/stats["wall_seconds"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directories", nargs="*", default=DEFAULT_DIRECTORIES)
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Save the results to this JSON file")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Compare against a previous results JSON file")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each stage, the fastest is reported")
+    parser.add_argument("--num-offsets", type=int, default=score_db.DEFAULT_NUM_OFFSETS)
+    parser.add_argument("--lowpass", type=int, default=7000)
+    parser.add_argument("--highpass", type=int, default=1000)
+    parser.add_argument("--backend", choices=utils.MODEL_BACKENDS, default="savedmodel")
+    parser.add_argument("--insert-rows", type=int, default=10000,
+                        help="Rows inserted in the insert stage")
+    args = parser.parse_args()
+
+    files = score_dir.find_audio_files(args.directories)
+    print("Recordings: {:d}\n".format(len(files)))
+    print("{:8s} {:>6s} {:>9s} {:>9s} {:>10s} {:>10s} {:>9s}".format(
+        "stage", "recs", "wall s", "CPU s", "recs/s", "audio s/s", "RSS MB"))
+
+    results = {"commit": git_commit(),
+               "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.platform(),
+               "cpu_count": os.cpu_count(),
+               "options": vars(args),
+               "stages": {}}
+
+    stages = results["stages"]
+
+    # Decode the first file outside the timing so ffmpeg is in the page cache
+    utils.load_audio_16k_mono(files[0])
+    (waves, stats) = time_stage(utils.load_audio_16k_mono, files, args.repeat)
+    audio_seconds = sum(len(w) for w in waves)/float(SAMPLE_RATE)
+    stages["decode"] = report("decode", stats, len(files), audio_seconds)
+
+    (filtered, stats) = time_stage(
+        lambda w: score.filter_wave_data(w, args.lowpass, args.highpass, SAMPLE_RATE),
+        waves, args.repeat)
+    stages["filter"] = report("filter", stats, len(files), audio_seconds)
+
+    (activities, stats) = time_stage(activity.activity, filtered, args.repeat)
+    stages["gate"] = report("gate", stats, len(files), audio_seconds)
+
+    try:
+        model, class_names = utils.load_model_and_class_names(args.backend)
+    except Exception as e:
+        print("model    skipped, couldn't load the model: {}".format(e))
+        results["model_error"] = str(e)
+        model = None
+
+    if model is not None:
+        # Warm up so graph tracing isn't timed
+        score.model_outputs(model, waves[0], args.num_offsets, single_pass=True)
+        (model_results, stats) = time_stage(
+            lambda w: score.model_outputs(model, w, args.num_offsets, single_pass=True),
+            waves, args.repeat)
+        stages["model"] = report("model", stats, len(files), audio_seconds)
+    else:
+        # Random scores in the shape the model would produce
+        rng = np.random.default_rng(0)
+        model_results = []
+        for w in waves:
+            (views, offset) = score.offset_views(w, args.num_offsets)
+            model_results.append(([(rng.random((score.num_model_frames(len(v)), NUM_CLASSES),
+                                                dtype=np.float32), None) for v in views],
+                                   offset))
+    results["synthetic_scores"] = model is None
+
+    (scores, stats) = time_stage(
+        lambda r: score.score_model_outputs(r[0], utils.BIRDS_CLASSES,
+                                            top_k_scores=score_db.DEFAULT_TOP_K_CLASS,
+                                            offset=r[1]),
+        model_results, args.repeat)
+    stages["count"] = report("count", stats, len(files), audio_seconds)
+
+    # Throughput for inserts is per row
+    records = make_records(args.insert_rows)
+    rows = [score_db.make_score_row((scores[i % len(scores)].top_class_score,
+                                     scores[i % len(scores)].threshold_score), 0.0, rec)
+            for i, rec in enumerate(records)]
+    (done, stats) = time_stage(lambda r: insert_rows(r, score_db.INSERT_BATCH_SIZE),
+                               [rows], args.repeat)
+    stages["insert"] = report("insert", stats, len(rows), None)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("\nSaved results to {}".format(args.output))
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Custom classifier heads, such as the Korimako model trained in
+Korimako_Detector.ipynb, run on the YAMNet embeddings of the same model
+pass used for the bird scores
+
+A head is a saved Keras model taking one 1024 element embedding per frame
+(dense heads) or per frame with a channel axis (the Conv1D heads). The
+embeddings of every frame of every offset are passed to it in one call and
+a recording's score is the mean of its predictions, as in
+apply_classification_model() in the notebook, along with the highest frame
+prediction. Heads that take several frames at once (the segment models)
+aren't supported.
+
+score_db.py runs the heads given with --head and stores their scores in the
+head_scores table.
+
+@author: que
+"""
+
+import os
+
+import numpy as np
+
+EMBEDDING_SIZE = 1024
+
+
+class Head:
+    """
+    A saved Keras classifier head called "name", loaded from model_path.
+    output_index picks the output used as the score for heads with more
+    than one (softmax) output.
+    """
+
+    def __init__(self, name, model_path, output_index = 0):
+        import tensorflow as tf
+
+        self.name = name
+        self.model_path = model_path
+        self.output_index = output_index
+        self.model = tf.keras.models.load_model(model_path, compile=False)
+        self.input_shape = tuple(self.model.input_shape[1:])
+        if int(np.prod(self.input_shape)) != EMBEDDING_SIZE:
+            raise ValueError("Head {} takes inputs of shape {}, not one {} element "
+                             "embedding per frame".format(name, self.input_shape, EMBEDDING_SIZE))
+
+    def predict(self, embeddings):
+        """
+        Return the head's prediction for each row of the (num_frames, 1024)
+        embeddings
+        """
+        x = np.asarray(embeddings, dtype=np.float32).reshape((-1,) + self.input_shape)
+        # Calling the model directly avoids the per call overhead of predict()
+        predictions = np.asarray(self.model(x, training=False))
+        return predictions.reshape(len(x), -1)[:, self.output_index]
+
+
+def parse_head(spec):
+    """
+    Load a Head from a command line spec "name=path" or "path", where the
+    name defaults to the file name without its suffix
+    """
+    if "=" in spec:
+        (name, model_path) = spec.split("=", 1)
+    else:
+        model_path = spec
+        name = os.path.splitext(os.path.basename(os.path.normpath(spec)))[0]
+    return Head(name, model_path)
+
+
+def frame_embeddings(outputs):
+    """
+    Return the embeddings of every frame of every offset of the per-offset
+    (scores, embeddings) model outputs from score.run_model() in one array
+    """
+    if any(embeddings is None for (scores, embeddings) in outputs):
+        raise ValueError("The model outputs have no embeddings")
+    return np.concatenate([embeddings for (scores, embeddings) in outputs])
+
+
+def head_scores(heads, outputs):
+    """
+    Return a dictionary of {head name: (mean score, max score)} from running
+    each of the heads on the embeddings in outputs
+    """
+    if not heads:
+        return {}
+    embeddings = frame_embeddings(outputs)
+    scores = {}
+    for head in heads:
+        predictions = head.predict(embeddings)
+        scores[head.name] = (float(np.mean(predictions)), float(np.max(predictions)))
+    return scores
+
+
+def create_head_scores_table(con):
+    """
+    Create the head_scores table, one row per recording and head, if it
+    doesn't exist
+    """
+    con.execute('''CREATE TABLE IF NOT EXISTS head_scores
+                 (id INTEGER NOT NULL,
+                 head TEXT NOT NULL,
+                 mean_score REAL,
+                 max_score REAL,
+                 PRIMARY KEY (id, head)) WITHOUT ROWID''')
+    con.execute("CREATE INDEX IF NOT EXISTS head_scores_head ON head_scores(head, mean_score)")
+
+
+def head_score_rows(rec_id, scores):
+    """
+    Return the head_scores rows for recording rec_id from the dictionary
+    returned by head_scores()
+    """
+    return [(rec_id, name, mean_score, max_score)
+            for name, (mean_score, max_score) in scores.items()]
+
+
+def insert_head_scores(con, rows):
+    """
+    Insert head_scores rows, replacing earlier scores of the same recording
+    and head
+    """
+    if not rows:
+        return
+    con.executemany("INSERT OR REPLACE into head_scores (id, head, mean_score, max_score) "
+                    "VALUES (?,?,?,?)", rows)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Per-frame bird detections for the scores table, so questions like "when in
+the recording was the bird" can be answered without running the model again
+
+"detections" has one row per scored recording, linked to scores.id, with the
+threshold and top class masks of every offset packed into bits, the number
+of bird frames and the longest run of consecutive bird frames, which is
+indexed. "detection_frames" has one row per bird frame with its start time
+and the bird class with the highest score in that frame. A bird frame is a
+frame of the first offset where any offset passes the threshold test. Most
+frames aren't bird frames, so this is far smaller than storing every frame.
+
+For example the recordings with more than 10 consecutive bird frames
+(about 5 s) within an hour of sunrise:
+
+    SELECT scores.* FROM detections JOIN scores USING (id)
+    WHERE max_run > 10 AND hours_from_sunrise BETWEEN -1 AND 1
+
+score_db.py fills these tables when run with --detections.
+
+@author: que
+"""
+
+import numpy as np
+
+import score
+
+
+def create_detections_tables(con):
+    """
+    Create the detections and detection_frames tables, if they don't exist
+    """
+    con.execute('''CREATE TABLE IF NOT EXISTS detections
+                 (id INTEGER NOT NULL PRIMARY KEY,
+                 num_offsets INTEGER,
+                 num_frames INTEGER,
+                 hop_seconds REAL,
+                 threshold_mask BLOB,
+                 top_class_mask BLOB,
+                 bird_frames INTEGER,
+                 max_run INTEGER,
+                 max_run_start REAL) ''')
+    con.execute("CREATE INDEX IF NOT EXISTS detections_max_run ON detections(max_run)")
+    con.execute('''CREATE TABLE IF NOT EXISTS detection_frames
+                 (id INTEGER NOT NULL,
+                 frame INTEGER NOT NULL,
+                 start_seconds REAL,
+                 bird_class INTEGER,
+                 score REAL,
+                 PRIMARY KEY (id, frame)) WITHOUT ROWID''')
+
+
+def pack_mask(mask):
+    """
+    Pack the boolean (num_offsets, num_frames) mask into bytes
+    """
+    return np.packbits(mask, axis=None).tobytes()
+
+
+def unpack_mask(blob, num_offsets, num_frames):
+    """
+    Return the boolean (num_offsets, num_frames) mask packed by pack_mask()
+    """
+    bits = np.unpackbits(np.frombuffer(blob, dtype=np.uint8), count=num_offsets*num_frames)
+    return bits.reshape(num_offsets, num_frames).astype(bool)
+
+
+def longest_run(mask):
+    """
+    Return a tuple of the length and first index of the longest run of True
+    values in the 1D boolean array mask, (0, None) if there are none
+    """
+    # Runs start where the padded mask goes up and end where it goes down
+    changes = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    if len(starts) == 0:
+        return (0, None)
+    longest = np.argmax(ends - starts)
+    return (int(ends[longest] - starts[longest]), int(starts[longest]))
+
+
+def make_detection_rows(rec_id, result, sample_rate = 16000):
+    """
+    Return a tuple of the detections row and the list of detection_frames rows
+    for recording rec_id from its score.ScoreResult
+    """
+    (num_offsets, num_frames) = result.threshold_masks.shape
+    hop_seconds = score.PATCH_HOP_SAMPLES/float(sample_rate)
+
+    bird_mask = np.any(result.threshold_masks, axis=0)
+    (max_run, run_start) = longest_run(bird_mask)
+    detection = (rec_id, num_offsets, num_frames, hop_seconds,
+                 pack_mask(result.threshold_masks), pack_mask(result.top_class_masks),
+                 int(np.count_nonzero(bird_mask)), max_run,
+                 None if run_start is None else run_start*hop_seconds)
+
+    # The class and score of each bird frame come from its best offset
+    frames = np.flatnonzero(bird_mask)
+    best = np.argmax(result.max_bird_scores[:, frames], axis=0)
+    frame_rows = [(rec_id, int(f), float(f*hop_seconds), int(result.max_bird_classes[o, f]),
+                   float(result.max_bird_scores[o, f])) for (f, o) in zip(frames, best)]
+    return (detection, frame_rows)
+
+
+def insert_detections(con, rows):
+    """
+    Insert the (detection, frame_rows) tuples from make_detection_rows() into
+    the database con, replacing any earlier detections of the same recordings
+    """
+    if not rows:
+        return
+    con.executemany("DELETE FROM detection_frames WHERE id = ?",
+                    [(detection[0],) for (detection, frame_rows) in rows])
+    con.executemany("INSERT OR REPLACE into detections (id, num_offsets, num_frames, "
+                    "hop_seconds, threshold_mask, top_class_mask, bird_frames, max_run, "
+                    "max_run_start) VALUES (?,?,?,?,?,?,?,?,?)",
+                    [detection for (detection, frame_rows) in rows])
+    con.executemany("INSERT into detection_frames (id, frame, start_seconds, bird_class, score) "
+                    "VALUES (?,?,?,?,?)",
+                    [row for (detection, frame_rows) in rows for row in frame_rows])
+
+
+def bird_masks(con, rec_id):
+    """
+    Return a tuple of the boolean (num_offsets, num_frames) threshold and top
+    class masks stored for recording rec_id, or None if there are none
+    """
+    row = con.execute("SELECT num_offsets, num_frames, threshold_mask, top_class_mask "
+                      "FROM detections WHERE id = ?", (rec_id,)).fetchone()
+    if row is None:
+        return None
+    (num_offsets, num_frames, threshold_mask, top_class_mask) = row
+    return (unpack_mask(threshold_mask, num_offsets, num_frames),
+            unpack_mask(top_class_mask, num_offsets, num_frames))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Incremental export of the scores table to a Parquet dataset partitioned by
+day and device, so analysis can read just the days and devices it needs:
+
+    python export_parquet.py -d scores.db -o scores_parquet
+
+Each run appends only the rows added to the scores table since the last
+export to the same dataset. The highest rowid exported to each dataset is
+kept in a parquet_export_marks table in the database, and the next export
+starts after it. The rowid is the recording ID, so rows added later with a
+lower ID (from scoring an earlier date range, or score_dir.py's negative IDs
+for files without one) and rows changed in place (for example by --pos-only
+or --ci-only in score_db.py) are only picked up by a --full export, which
+rewrites the dataset.
+
+The dataset is laid out as <output>/day=YYYY-MM-DD/dev_name=<device>/*.parquet
+with the day taken from the local timestamp stored in the scores table. In a
+notebook:
+
+    import export_parquet
+    scores_df = export_parquet.read_scores("scores_parquet",
+                                           start_date="2021-10-01",
+                                           end_date="2021-10-31",
+                                           devices=["Grants Pass"])
+
+@author: que
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import sqlite3
+
+import score_db
+
+DEFAULT_OUTPUT = "scores_parquet"
+SCORE_COLUMNS = ["id", "ts", "dev_name", "dev_id", "thresh_score", "class_score",
+                 "ci_score", "latitude", "longtitude", "sunrise", "sunset",
+                 "hours_from_sunrise"]
+
+
+def parse_arguments():
+    """
+
+    Parse the command line arguments
+
+    Returns
+    -------
+    Args
+
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=str,
+        default = score_db.DEFAULT_DB_NAME,
+        help="SQlite3 database to export the scores from" )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default = DEFAULT_OUTPUT,
+        help="Directory of the Parquet dataset" )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Delete the dataset and export every row again" )
+
+    return parser.parse_args()
+
+
+def create_exports_table(con):
+    """
+    Create the parquet_export_marks table of the highest scores rowid
+    written to each dataset, if it doesn't exist. Databases with the
+    parquet_exports table of every exported ID, from earlier versions, get
+    a mark of the highest ID in it and the old table is dropped.
+    """
+    con.execute('''CREATE TABLE IF NOT EXISTS parquet_export_marks
+                 (dataset TEXT NOT NULL PRIMARY KEY,
+                 last_rowid INTEGER NOT NULL)''')
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                   "AND name = 'parquet_exports'").fetchone() is not None:
+        con.execute("INSERT OR IGNORE INTO parquet_export_marks (dataset, last_rowid) "
+                    "SELECT dataset, MAX(id) FROM parquet_exports GROUP BY dataset")
+        con.execute("DROP TABLE parquet_exports")
+        con.commit()
+
+
+def export_mark(con, dataset):
+    """
+    Return the highest scores rowid already exported to dataset, or None if
+    nothing has been
+    """
+    row = con.execute("SELECT last_rowid FROM parquet_export_marks WHERE dataset = ?",
+                      (dataset,)).fetchone()
+    return None if row is None else row[0]
+
+
+def rows_to_export(con, after = None):
+    """
+    Return the rows of the scores table with a rowid greater than after, or
+    every row if after is None, with the rowid and then the day of each row
+    appended
+    """
+    query = "SELECT {}, rowid, substr(ts, 1, 10) FROM scores".format(", ".join(SCORE_COLUMNS))
+    params = ()
+    if after is not None:
+        query += " WHERE rowid > ?"
+        params = (after,)
+    return con.execute(query + " ORDER BY rowid", params).fetchall()
+
+
+def rows_to_table(rows):
+    """
+    Convert rows from rows_to_export() to a pyarrow Table with UTC timestamp
+    columns and day and dev_name partition columns
+    """
+    import pyarrow as pa
+    import pandas as pd
+
+    df = pd.DataFrame(rows, columns=SCORE_COLUMNS + ["rowid", "day"])
+    df = df.drop(columns="rowid")
+    for column in ("ts", "sunrise", "sunset"):
+        df[column] = pd.to_datetime(df[column], utc=True)
+    df["dev_name"] = df["dev_name"].fillna("unknown")
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def export_scores(con, output, full = False):
+    """
+    Append the rows of the scores table in the open database con not already
+    exported to the Parquet dataset in directory output. If full is True the
+    dataset is deleted and every row is exported again. Returns the number of
+    rows written.
+    """
+    import pyarrow.dataset as ds
+
+    dataset = os.path.abspath(output)
+    # Adds any columns missing from older databases
+    score_db.create_sql_table(con)
+    create_exports_table(con)
+    if full:
+        con.execute("DELETE FROM parquet_export_marks WHERE dataset = ?", (dataset,))
+        shutil.rmtree(output, ignore_errors=True)
+
+    rows = rows_to_export(con, export_mark(con, dataset))
+    if not rows:
+        return 0
+
+    # A new file name for each export so earlier files in a partition are kept
+    export_name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    ds.write_dataset(rows_to_table(rows), output, format="parquet",
+                     partitioning=["day", "dev_name"], partitioning_flavor="hive",
+                     basename_template="part-" + export_name + "-{i}.parquet",
+                     existing_data_behavior="overwrite_or_ignore")
+
+    # Only recorded once the files are written, so a failed export is redone
+    con.execute("INSERT OR REPLACE INTO parquet_export_marks (dataset, last_rowid) VALUES (?,?)",
+                (dataset, max(row[len(SCORE_COLUMNS)] for row in rows)))
+    con.commit()
+    return len(rows)
+
+
+def read_scores(output = DEFAULT_OUTPUT, start_date = None, end_date = None,
+                devices = None, columns = None):
+    """
+    Read scores from the Parquet dataset in directory output into a pandas
+    DataFrame, only reading the partitions needed
+
+    start_date and end_date (inclusive) are dates or "YYYY-MM-DD" strings,
+    devices is a list of device names and columns the columns to read. Any
+    left as None are not filtered on.
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(output, format="parquet", partitioning="hive")
+    conditions = []
+    if start_date is not None:
+        conditions.append(ds.field("day") >= str(start_date))
+    if end_date is not None:
+        conditions.append(ds.field("day") <= str(end_date))
+    if devices is not None:
+        conditions.append(ds.field("dev_name").isin(list(devices)))
+
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    df = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    if "ts" in df.columns:
+        df = df.sort_values("ts", ignore_index=True)
+    return df
+
+
+def main():
+    """
+
+    Main routine - exports the new scores to the Parquet dataset
+
+    Returns
+    -------
+    None.
+
+    """
+    args = parse_arguments()
+
+    con = sqlite3.connect(args.database)
+    count = export_scores(con, args.output, full=args.full)
+    con.close()
+
+    print("Exported {:d} new scores from {} to {}".format(count, args.database, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Butterworth filtering for Yamnnet/Cacophony Audio Classification Experiments
+
+Filter designs are cached in second-order sections form per (cutoff, fs,
+order). When both a low pass and a high pass cutoff are given their sections
+are stacked into one cascade, which has the same response as applying the
+two filters one after the other, and applied with a single forward-backward
+sosfiltfilt pass. Data is kept as float32 throughout.
+
+scipy.signal is imported on first use as it is slow to import and the
+filters are often not needed.
+
+@author: que
+"""
+
+import functools
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def butter_sos(cutoff, fs, btype, order=5):
+    """
+    Return the second-order sections of a Butterworth filter of type btype
+    ('low' or 'high') with the given cutoff frequency for sample rate fs
+    """
+    from scipy import signal
+    nyq = 0.5 * fs
+    normal_cutoff = cutoff / nyq
+    return signal.butter(order, normal_cutoff, btype=btype, analog=False,
+                         output='sos')
+
+
+@functools.lru_cache(maxsize=None)
+def band_sos(low_pass_cutoff, high_pass_cutoff, fs, order=5):
+    """
+    Return the float32 second-order sections of a low pass filter followed
+    by a high pass filter. Either cutoff may be None to leave that filter out.
+    """
+    sections = []
+    if low_pass_cutoff is not None:
+        sections.append(butter_sos(low_pass_cutoff, fs, 'low', order))
+    if high_pass_cutoff is not None:
+        sections.append(butter_sos(high_pass_cutoff, fs, 'high', order))
+    return np.concatenate(sections).astype(np.float32)
+
+
+def bandpass_filter(data, low_pass_cutoff=None, high_pass_cutoff=None,
+                    fs=16000, order=5):
+    """
+    Apply the low pass and/or high pass Butterworth filters to data with a
+    single zero-phase sosfiltfilt pass and return float32 results.
+
+    data may be a single waveform or a 2-D array with one waveform per row,
+    in which case every row is filtered in the same call.
+
+    If both cutoffs are None the data is returned unfiltered.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if low_pass_cutoff is None and high_pass_cutoff is None:
+        return data
+    from scipy import signal
+    sos = band_sos(low_pass_cutoff, high_pass_cutoff, fs, order)
+    return signal.sosfiltfilt(sos, data, axis=-1).astype(np.float32, copy=False)
+
+
+def bandpass_filter_chunk(data, low_pass_cutoff=None, high_pass_cutoff=None,
+                          fs=16000, order=5, zi=None):
+    """
+    Apply the low pass and/or high pass Butterworth filters to one chunk of
+    a stream and return a tuple of the float32 filtered chunk and the filter
+    state to pass as zi with the next chunk (None to start the stream).
+
+    This is a causal, forward only, sosfilt pass, so unlike bandpass_filter()
+    it has phase lag and the magnitude response is only applied once.
+
+    If both cutoffs are None the data is returned unfiltered.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if low_pass_cutoff is None and high_pass_cutoff is None:
+        return (data, None)
+    from scipy import signal
+    sos = band_sos(low_pass_cutoff, high_pass_cutoff, fs, order)
+    if zi is None:
+        zi = np.zeros((sos.shape[0], 2), dtype=np.float32)
+    (filtered, zi) = signal.sosfilt(sos, data, zi=zi)
+    return (filtered.astype(np.float32, copy=False), zi)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Durable job queue for score_db.py runs
+
+Each recording found on the server is stored in the "jobs" table with its
+record, state (pending/downloading/scored/failed/skipped), attempt count
+and last error. Recordings the activity gate skipped the model for are
+"skipped" rather than stored with a zero score. The "days" table records which days have been fully enumerated so an
+interrupted backfill resumes from the jobs table without querying the API
+again. Recordings can be uploaded days after they were made, so a day is
+only treated as complete once it was enumerated at least requery_days after
+it ended; until then it is queried again on every run. Failed recordings
+are retried with exponential backoff.
+
+@author: que
+"""
+
+import datetime
+import json
+import time
+
+PENDING = "pending"
+DOWNLOADING = "downloading"
+SCORED = "scored"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_BACKOFF = 60.0
+DEFAULT_REQUERY_DAYS = 7
+
+
+def create_jobs_tables(con):
+    """
+    
+    Create the "jobs" and "days" tables if they don't already exist in the
+    database with open connection con
+
+    Parameters
+    ----------
+    con : SqLite3 Connection
+        Connection to open database.
+
+    Returns
+    -------
+    None
+
+    """
+    con.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id INTEGER NOT NULL PRIMARY KEY,
+                 day TEXT,
+                 rec TEXT,
+                 state TEXT,
+                 attempts INT DEFAULT 0,
+                 last_error TEXT,
+                 next_attempt REAL DEFAULT 0,
+                 updated REAL) ''')
+    con.execute("CREATE INDEX IF NOT EXISTS jobs_day_state ON jobs(day, state)")
+    con.execute('''CREATE TABLE IF NOT EXISTS days
+                 (day TEXT NOT NULL PRIMARY KEY,
+                 num_recordings INT,
+                 enumerated REAL) ''')
+
+
+def day_key(day):
+    """
+    Return the key used for a date or datetime in the jobs and days tables
+    """
+    return day.strftime("%Y-%m-%d")
+
+
+def day_enumerated(con, day, requery_days=DEFAULT_REQUERY_DAYS):
+    """
+    Returns True if all the recordings for day were added to the jobs table
+    by a query made at least requery_days after the day ended, so no more
+    are expected to be uploaded. Days enumerated sooner are queried again.
+    """
+    row = con.execute("SELECT enumerated FROM days WHERE day = ?", (day_key(day),)).fetchone()
+    if row is None:
+        return False
+    if isinstance(day, datetime.datetime):
+        day = day.date()
+    day_end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+    return row[0] >= day_end.timestamp() + requery_days*24*60*60
+
+
+def add_jobs(con, day, recordings):
+    """
+    
+    Add a pending job for each recording in "recordings" that has been
+    processed by the server and isn't already in the jobs table. If every
+    recording has been processed the day is marked as enumerated, otherwise
+    it will be queried again on the next run.
+
+    Parameters
+    ----------
+    con : SqLite3 Connection
+        Connection to open database.
+    day : date
+        Day the recordings were made.
+    recordings : list of dict
+        Audio recording records.
+
+    Returns
+    -------
+    None
+
+    """
+    now = time.time()
+    key = day_key(day)
+    con.executemany("INSERT OR IGNORE INTO jobs (id, day, rec, state, attempts, next_attempt, updated) "
+                    "VALUES (?,?,?,?,0,0,?)",
+                    [(rec['id'], key, json.dumps(rec), PENDING, now)
+                     for rec in recordings if rec['processingState'] == 'FINISHED'])
+    if all(rec['processingState'] == 'FINISHED' for rec in recordings):
+        con.execute("INSERT OR REPLACE INTO days VALUES (?,?,?)", (key, len(recordings), now))
+
+
+def runnable_jobs(con, start_day, end_day, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                  include_skipped=False):
+    """
+    
+    Return the records of the recordings made on or after start_day and
+    before end_day that still need scoring: pending jobs, jobs interrupted
+    while downloading and failed jobs with fewer than max_attempts attempts
+    whose backoff has expired. Jobs the activity gate skipped are included
+    if include_skipped is True, for runs without the gate.
+
+    """
+    query = ("SELECT rec FROM jobs WHERE day >= ? AND day < ? AND (state IN (?, ?, ?) OR "
+             "(state = ? AND attempts < ? AND next_attempt <= ?))")
+    params = [day_key(start_day), day_key(end_day), PENDING, DOWNLOADING,
+              SKIPPED if include_skipped else PENDING, FAILED, max_attempts, time.time()]
+    return [json.loads(row[0]) for row in con.execute(query + " ORDER BY id", params)]
+
+
+def next_retry_delay(con, start_day, end_day, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Return the number of seconds until the next failed job for a recording
+    made on or after start_day and before end_day can be retried, or None if
+    there are no jobs left to retry
+    """
+    row = con.execute("SELECT MIN(next_attempt) FROM jobs WHERE day >= ? AND day < ? "
+                      "AND state = ? AND attempts < ?",
+                      (day_key(start_day), day_key(end_day), FAILED, max_attempts)).fetchone()
+    if row[0] is None:
+        return None
+    return max(0.0, row[0] - time.time())
+
+
+def mark_jobs(con, rec_ids, state):
+    """
+    Set the state of the jobs for the recordings in rec_ids
+    """
+    now = time.time()
+    con.executemany("UPDATE jobs SET state = ?, updated = ? WHERE id = ?",
+                    [(state, now, rec_id) for rec_id in rec_ids])
+
+
+def mark_failed(con, failures, retry_backoff=DEFAULT_RETRY_BACKOFF):
+    """
+    
+    Mark jobs as failed. failures is a list of (rec_id, error) tuples. The
+    job's attempt count is incremented and it can be retried after
+    retry_backoff * 2**(attempts - 1) seconds.
+
+    """
+    now = time.time()
+    con.executemany("UPDATE jobs SET state = ?, attempts = attempts + 1, last_error = ?, "
+                    "next_attempt = ? * (1 << attempts) + ?, updated = ? WHERE id = ?",
+                    [(FAILED, str(error), retry_backoff, now, now, rec_id)
+                     for (rec_id, error) in failures])
+
+
+def job_counts(con):
+    """
+    Return a dictionary of the number of jobs in each state
+    """
+    return dict(con.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
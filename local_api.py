@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Local stand-in for the Cacophony user API (cacophonyapi.user.UserAPI)
+
+Serves recordings from a directory tree laid out like test_files/: audio
+files named YYYYMMDD-HHMMSS.(mp3|mp4|wav) next to a recordings.csv exported
+from the Cacophony browse site. Only the calls used by score_db.py are
+provided, query() and download_raw().
+
+@author: que
+"""
+
+import csv
+import datetime
+import glob
+import os
+
+import utils
+
+CHUNK_SIZE = 64*1024
+AUDIO_SUFFIXES = (".wav", ".mp3", ".mp4")
+
+
+def _to_date(d):
+    if isinstance(d, datetime.datetime):
+        return d.date()
+    return d
+
+
+class LocalAPI:
+    """
+    Minimal Cacophony API client backed by the recordings.csv files and audio
+    files under "directory"
+    """
+
+    # The files may be wav, mp3 or mp4, so ffmpeg works out the format of
+    # what download_raw() returns (see utils.load_audio_16k_mono())
+    stream_type = None
+
+    def __init__(self, directory):
+        self.recordings = {}
+        self.filenames = {}
+
+        audio_files = {}
+        for f in glob.glob(os.path.join(directory, "**", "*"), recursive=True):
+            if f.lower().endswith(AUDIO_SUFFIXES):
+                try:
+                    audio_files[(os.path.dirname(f), utils.filename_to_date(f))] = f
+                except ValueError:
+                    pass
+
+        for csv_file in glob.glob(os.path.join(directory, "**", "recordings.csv"), recursive=True):
+            path = os.path.dirname(csv_file)
+            with open(csv_file) as f:
+                for row in csv.DictReader(f):
+                    dt = datetime.datetime.strptime("{} {}".format(row["Date"], row["Time"]),
+                                                    "%Y-%m-%d %H:%M:%S")
+                    filename = audio_files.get((path, dt))
+                    if filename is None:
+                        continue
+                    rec_id = int(row["Id"])
+                    self.filenames[rec_id] = filename
+                    self.recordings[rec_id] = self._make_record(rec_id, dt, row)
+
+    @staticmethod
+    def _make_record(rec_id, dt, row):
+        """
+        Build a recording record in the same shape as the API returns
+        """
+        rec = {"id": rec_id,
+               "type": row["Type"],
+               "deviceId": 0,
+               "deviceName": row["Device"],
+               "recordingDateTime": dt.isoformat(),
+               "processingState": "FINISHED",
+               "additionalMetadata": {}}
+        if row["Latitude"] and row["Longitude"]:
+            rec["location"] = {"lat": float(row["Latitude"]),
+                               "lng": float(row["Longitude"])}
+        if row["Cacophony Index"]:
+            rec["additionalMetadata"]["analysis"] = {"cacophony_index": [
+                {"index_percent": float(ci)} for ci in row["Cacophony Index"].split(";")]}
+        return rec
+
+    def query(self, limit=100, type_=None, startDate=None, endDate=None, **kwargs):
+        """
+        Return the recordings recorded on or after startDate and before
+        endDate, newest first
+        """
+        recordings = []
+        for rec_id in sorted(self.recordings, reverse=True):
+            rec = self.recordings[rec_id]
+            day = datetime.datetime.fromisoformat(rec["recordingDateTime"]).date()
+            if type_ is not None and rec["type"] != type_:
+                continue
+            if startDate is not None and day < _to_date(startDate):
+                continue
+            if endDate is not None and day >= _to_date(endDate):
+                continue
+            recordings.append(rec)
+        return recordings[:limit]
+
+    def download_raw(self, rec_id):
+        """
+        Yield the contents of the audio file for recording rec_id in chunks
+        """
+        with open(self.filenames[rec_id], "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                yield chunk
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Pipelined scoring of Cacophony recordings
+
+Recordings flow through four stages connected by bounded queues:
+
+    download (thread pool) -> decode and filter (process pool)
+        -> inference (one model, micro-batched) -> write (one thread)
+
+so network I/O, ffmpeg decoding, the model and SQLite all overlap. The
+inference stage runs in the calling thread, which owns the model. Every
+recording's offsets are scored in the same model call as the rest of its
+batch, so the pipeline is always single pass.
+
+If writing to the database fails the writer keeps emptying its queue, so
+the other stages never block on it, the remaining recordings are neither
+downloaded nor scored and run_pipeline() raises the writer's error.
+
+@author: que
+"""
+
+import concurrent.futures
+import io
+import multiprocessing
+import queue
+import threading
+import time
+
+import utils
+import score
+
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_DECODE_WORKERS = 2
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT = 0.5
+DEFAULT_QUEUE_SIZE = 32
+
+
+def download_recording(client, rec_id):
+    """
+    Download the raw audio for recording rec_id and return it as bytes
+    """
+    with io.BytesIO() as f:
+        for chunk in client.download_raw(rec_id):
+            f.write(chunk)
+        return f.getvalue()
+
+
+def decode_recording(audio_bytes, stream_type, sample_rate, low_pass_cutoff,
+                     high_pass_cutoff):
+    """
+    Decode and filter raw audio bytes in format stream_type to a float32
+    waveform. Runs in the decode process pool.
+    """
+    wave_data = utils.load_audio_16k_mono("", out_sample_rate=sample_rate,
+                                          stream=io.BytesIO(audio_bytes),
+                                          stream_type=stream_type)
+    return score.filter_wave_data(wave_data, low_pass_cutoff, high_pass_cutoff,
+                                  sample_rate)
+
+
+def run_pipeline(recordings, client, model, bird_classes, open_writer,
+                 write_results,
+                 num_offsets = 3,
+                 low_pass_cutoff = None,
+                 high_pass_cutoff = None,
+                 score_threshold = 0.4,
+                 top_k_scores = 3,
+                 sample_rate = 16000,
+                 download_workers = DEFAULT_DOWNLOAD_WORKERS,
+                 decode_workers = DEFAULT_DECODE_WORKERS,
+                 batch_size = DEFAULT_BATCH_SIZE,
+                 max_wait = DEFAULT_MAX_WAIT,
+                 queue_size = DEFAULT_QUEUE_SIZE,
+                 gate = None,
+                 heads = None):
+    """
+    Download, decode, score and write every recording in "recordings".
+
+    client needs a download_raw(rec_id) method (the Cacophony API or a
+    local_api.LocalAPI). open_writer() is called in the writer thread and
+    returns an SQLite connection, write_results(con, items) is then called
+    there with lists of (rec, result, error) tuples holding either the
+    score.ScoreResult or the exception that stopped the recording being
+    scored. The writer drains everything waiting in its queue into one call
+    and commits after each call.
+
+    Inference collects up to batch_size decoded recordings, waiting at most
+    max_wait seconds after the first one arrives, and scores them with one
+    call to the model. At most queue_size recordings are in flight between
+    download and inference. If decode_workers is 0 decoding happens in the
+    download threads.
+
+    If gate is an activity.ActivityGate, recordings it finds too quiet are
+    left out of the model batch and given a zero score. heads is a list of
+    classifier_heads.Head run on the embeddings of each recording.
+    """
+    infer_q = queue.Queue()
+    write_q = queue.Queue(maxsize=queue_size)
+    in_flight = threading.BoundedSemaphore(queue_size)
+    stream_type = utils.client_stream_type(client)
+
+    # Holds the exception that stopped the writer, if it fails
+    writer_errors = []
+
+    decode_pool = None
+    if decode_workers > 0:
+        # Spawn rather than fork, as this process has TensorFlow loaded and
+        # threads running
+        decode_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=decode_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def download_stage(rec):
+        try:
+            if writer_errors:
+                raise RuntimeError("not downloaded, the pipeline writer failed")
+            audio_bytes = download_recording(client, rec['id'])
+            if decode_pool is not None:
+                decoded = decode_pool.submit(decode_recording, audio_bytes, stream_type,
+                                             sample_rate, low_pass_cutoff, high_pass_cutoff)
+            else:
+                decoded = concurrent.futures.Future()
+                decoded.set_result(decode_recording(audio_bytes, stream_type, sample_rate,
+                                                    low_pass_cutoff, high_pass_cutoff))
+        except Exception as e:
+            decoded = concurrent.futures.Future()
+            decoded.set_exception(e)
+        infer_q.put((rec, decoded))
+
+    def feed_stage(download_pool):
+        for rec in recordings:
+            in_flight.acquire()
+            download_pool.submit(download_stage, rec)
+
+    def write_stage():
+        con = None
+        done = False
+        try:
+            con = open_writer()
+            while not done:
+                items = [write_q.get()]
+                while len(items) < queue_size:
+                    try:
+                        items.append(write_q.get_nowait())
+                    except queue.Empty:
+                        break
+                # The end marker is always the last item queued
+                if items[-1] is None:
+                    done = True
+                    items.pop()
+                if items:
+                    write_results(con, items)
+                    con.commit()
+        except Exception as e:
+            print("Pipeline writer failed: {}".format(e), flush=True)
+            writer_errors.append(e)
+            # Keep emptying the queue so the inference loop never blocks on it
+            while not done:
+                done = write_q.get() is None
+        finally:
+            if con is not None:
+                con.close()
+
+    writer = threading.Thread(target=write_stage, name="pipeline-writer")
+    writer.start()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as download_pool:
+            feeder = threading.Thread(target=feed_stage, args=(download_pool,),
+                                      name="pipeline-feeder", daemon=True)
+            feeder.start()
+
+            remaining = len(recordings)
+            while remaining > 0:
+                # Gather a micro-batch of decoded recordings
+                batch = []
+                deadline = None
+                while len(batch) < min(batch_size, remaining):
+                    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                    try:
+                        (rec, decoded) = infer_q.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    in_flight.release()
+                    try:
+                        batch.append((rec, decoded.result()))
+                    except Exception as e:
+                        write_q.put((rec, None, e))
+                        remaining -= 1
+                    if deadline is None:
+                        deadline = time.monotonic() + max_wait
+
+                if not batch:
+                    continue
+                remaining -= len(batch)
+
+                if gate is not None:
+                    active = []
+                    for (rec, wave_data) in batch:
+                        # An odd waveform only fails that recording
+                        try:
+                            if gate.check(wave_data, num_offsets, sample_rate):
+                                active.append((rec, wave_data))
+                            else:
+                                write_q.put((rec, score.skipped_result(
+                                    num_offsets, score.num_model_frames(len(wave_data)),
+                                    heads), None))
+                        except Exception as e:
+                            write_q.put((rec, None, e))
+                    batch = active
+                    if not batch:
+                        continue
+
+                if writer_errors:
+                    # Nothing more can be stored, so don't run the model
+                    continue
+
+                try:
+                    batch_outputs = score.batch_model_outputs(
+                        model, [wave_data for (rec, wave_data) in batch], num_offsets)
+                except Exception as e:
+                    for (rec, wave_data) in batch:
+                        write_q.put((rec, None, e))
+                    continue
+
+                for (rec, wave_data), (outputs, offset) in zip(batch, batch_outputs):
+                    # A failing head or recording only fails that recording
+                    try:
+                        result = score.score_model_outputs(outputs, bird_classes,
+                                                           score_threshold=score_threshold,
+                                                           top_k_scores=top_k_scores,
+                                                           offset=offset,
+                                                           sample_rate=sample_rate,
+                                                           heads=heads)
+                    except Exception as e:
+                        write_q.put((rec, None, e))
+                        continue
+                    write_q.put((rec, result, None))
+            feeder.join()
+    finally:
+        write_q.put(None)
+        writer.join()
+        if decode_pool is not None:
+            decode_pool.shutdown()
+    if writer_errors:
+        raise writer_errors[0]
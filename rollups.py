@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Summary tables of the scores table, kept up to date by SQLite triggers
+
+"daily_scores" has one row per (day, dev_name) and "hourly_scores" one row
+per (hour of day, dev_name). Each holds the number of recordings and, for
+thresh_score, class_score and ci_score, the count of non-NULL values, their
+sum, minimum and maximum, so means are sum/count. Days and hours come from
+the local timestamp stored in the ts column. Rows without a timestamp are
+left out and a missing dev_name is stored as ''.
+
+Triggers on the scores table update the summaries as rows are inserted,
+updated or deleted, so dashboards can read a few thousand summary rows
+rather than every score. The minimum and maximum can't be undone by
+subtraction, so when a row holding one is removed or changed that group's
+value is recalculated from the scores table, using an index on the group
+expression.
+
+@author: que
+"""
+
+# Summary tables: (table, group column, group column type, SQL expression of the
+# group for a scores row, with {row} for the row name and a dot, or nothing)
+ROLLUPS = (("daily_scores", "day", "TEXT", "substr({row}ts, 1, 10)"),
+           ("hourly_scores", "hour", "INTEGER", "CAST(substr({row}ts, 12, 2) AS INTEGER)"))
+# Summarised columns of the scores table and their prefix in the summaries
+METRICS = (("thresh_score", "thresh"), ("class_score", "class"), ("ci_score", "ci"))
+DEVICE = "coalesce({row}dev_name, '')"
+# Columns whose changes affect the summaries
+UPDATE_COLUMNS = "ts, dev_name, thresh_score, class_score, ci_score"
+
+
+def add_row_sql(table, group, expression, row):
+    """
+    Return the SQL that adds the scores row "row" ("NEW.") to the summary table
+    """
+    columns = [group, "dev_name", "num_recordings"]
+    values = [expression.format(row=row), DEVICE.format(row=row), "1"]
+    updates = ["num_recordings = num_recordings + 1"]
+    for (score, prefix) in METRICS:
+        value = row + score
+        columns += [prefix + "_count", prefix + "_sum", prefix + "_min", prefix + "_max"]
+        values += ["{} IS NOT NULL".format(value), "coalesce({}, 0)".format(value), value, value]
+        updates += ["{0}_count = {0}_count + excluded.{0}_count".format(prefix),
+                    "{0}_sum = {0}_sum + excluded.{0}_sum".format(prefix)]
+        # Scalar min()/max() return NULL if either value is NULL
+        for f in ("min", "max"):
+            updates.append("{0}_{1} = coalesce({1}({0}_{1}, excluded.{0}_{1}), "
+                           "{0}_{1}, excluded.{0}_{1})".format(prefix, f))
+    return ("INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}, dev_name) DO UPDATE SET {};".format(
+        table, ", ".join(columns), ", ".join(values), group, ",\n    ".join(updates)))
+
+
+def remove_row_sql(table, group, expression, row):
+    """
+    Return the SQL that removes the scores row "row" ("OLD.") from the summary
+    table, recalculating the minimum or maximum from the scores table if
+    the row held it
+    """
+    where = "{} = {} AND dev_name = {}".format(group, expression.format(row=row),
+                                               DEVICE.format(row=row))
+    in_group = "{} = {}.{} AND {} = {}.dev_name".format(
+        expression.format(row="scores."), table, group, DEVICE.format(row="scores."), table)
+    updates = ["num_recordings = num_recordings - 1"]
+    for (score, prefix) in METRICS:
+        value = row + score
+        updates += ["{}_count = {}_count - ({} IS NOT NULL)".format(prefix, prefix, value),
+                    "{}_sum = {}_sum - coalesce({}, 0)".format(prefix, prefix, value)]
+        for (f, op) in (("min", "<="), ("max", ">=")):
+            updates.append("{0}_{1} = CASE WHEN {2} {3} {0}_{1} THEN "
+                           "(SELECT {1}({4}) FROM scores WHERE {5}) ELSE {0}_{1} END".format(
+                               prefix, f, value, op, score, in_group))
+    return ("UPDATE {} SET {}\n    WHERE {};\n"
+            "  DELETE FROM {} WHERE {} AND num_recordings <= 0;".format(
+                table, ",\n    ".join(updates), where, table, where))
+
+
+def create_rollup_tables(con):
+    """
+
+    Create the summary tables, their triggers on the scores table and the
+    indexes the triggers need, if they don't already exist in the database
+    with open connection con. New summary tables are filled from the
+    existing scores.
+
+    Parameters
+    ----------
+    con : SqLite3 Connection
+        Connection to open database with a scores table.
+
+    Returns
+    -------
+    None
+
+    """
+    existing = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    for (table, group, group_type, expression) in ROLLUPS:
+        metric_columns = "".join("{0}_count INTEGER, {0}_sum REAL, {0}_min REAL, {0}_max REAL,\n"
+                                 .format(prefix) for (score, prefix) in METRICS)
+        con.execute('''CREATE TABLE IF NOT EXISTS {}
+                     ({} {} NOT NULL,
+                     dev_name TEXT NOT NULL,
+                     num_recordings INTEGER,
+                     {}
+                     PRIMARY KEY ({}, dev_name)) '''.format(table, group, group_type,
+                                                           metric_columns, group))
+        con.execute("CREATE INDEX IF NOT EXISTS scores_{0}_dev ON scores({1}, {2})".format(
+            group, expression.format(row=""), DEVICE.format(row="")))
+
+        con.execute('''CREATE TRIGGER IF NOT EXISTS {0}_insert AFTER INSERT ON scores
+                     WHEN NEW.ts IS NOT NULL BEGIN
+                     {1}
+                     END'''.format(table, add_row_sql(table, group, expression, "NEW.")))
+        con.execute('''CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON scores
+                     WHEN OLD.ts IS NOT NULL BEGIN
+                     {1}
+                     END'''.format(table, remove_row_sql(table, group, expression, "OLD.")))
+        # An update is a removal of the old row and an addition of the new one,
+        # in either order
+        con.execute('''CREATE TRIGGER IF NOT EXISTS {0}_update_old AFTER UPDATE OF {1} ON scores
+                     WHEN OLD.ts IS NOT NULL BEGIN
+                     {2}
+                     END'''.format(table, UPDATE_COLUMNS,
+                                   remove_row_sql(table, group, expression, "OLD.")))
+        con.execute('''CREATE TRIGGER IF NOT EXISTS {0}_update_new AFTER UPDATE OF {1} ON scores
+                     WHEN NEW.ts IS NOT NULL BEGIN
+                     {2}
+                     END'''.format(table, UPDATE_COLUMNS,
+                                   add_row_sql(table, group, expression, "NEW.")))
+
+        if table not in existing:
+            rebuild_rollup(con, table, group, expression)
+
+
+def rebuild_rollup(con, table, group, expression):
+    """
+    Refill the summary table "table" from the scores table
+    """
+    columns = [group, "dev_name", "num_recordings"]
+    values = [expression.format(row=""), DEVICE.format(row=""), "count(*)"]
+    for (score, prefix) in METRICS:
+        columns += [prefix + "_count", prefix + "_sum", prefix + "_min", prefix + "_max"]
+        values += ["count({})".format(score), "total({})".format(score),
+                   "min({})".format(score), "max({})".format(score)]
+    con.execute("DELETE FROM {}".format(table))
+    con.execute("INSERT INTO {} ({}) SELECT {} FROM scores WHERE ts IS NOT NULL "
+                "GROUP BY 1, 2".format(table, ", ".join(columns), ", ".join(values)))
+
+
+def rebuild_rollups(con):
+    """
+    Refill all the summary tables from the scores table, for example after
+    the scores table has been changed with the triggers missing
+    """
+    for (table, group, group_type, expression) in ROLLUPS:
+        rebuild_rollup(con, table, group, expression)
+    con.commit()
@@ -10,26 +10,363 @@ Created on Mon September 13th
 @author: que
 """
 
-import csv
-import io
-import os
-import os.path
-import glob
-import datetime
+from collections import namedtuple
 
 import numpy as np
-import tensorflow as tf
-import tensorflow_hub as hub
-import tensorflow_io as tfio
-
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from matplotlib import patches
-from IPython import display
-import pydub
-from scipy import signal
-import pandas as pd
+
 import utils
+import filters
+import score_cache
+import timing
+import classifier_heads
+
+
+# YAMNet frames the 16 kHz waveform into 0.96 s patches with a 0.48 s hop.
+# Each patch needs PATCH_WINDOW_SAMPLES of audio (96 STFT hops plus one 25 ms
+# STFT window) and the model zero pads the end of the waveform up to a whole
+# number of patch hops.
+PATCH_HOP_SAMPLES = 7680
+PATCH_WINDOW_SAMPLES = 15600
+
+
+def num_model_frames(num_samples):
+    """
+    Return the number of frames (rows of scores) the model will produce for
+    a waveform with num_samples samples
+    """
+    extra_samples = max(0, num_samples - PATCH_WINDOW_SAMPLES)
+    return 1 + (extra_samples + PATCH_HOP_SAMPLES - 1)//PATCH_HOP_SAMPLES
+
+
+def offset_views(wave_data, num_offsets, num_frames=None):
+    """
+    Return a tuple of a list of num_offsets views into wave_data, each
+    starting 1/num_offsets of a frame later than the previous one, and the
+    offset between them in samples
+
+    num_frames is the number of frames the model produces for the whole of
+    wave_data, if None it is calculated with num_model_frames()
+    """
+    if num_frames is None:
+        num_frames = num_model_frames(len(wave_data))
+    offset = int((len(wave_data)/num_frames)/num_offsets)
+    return ([wave_data[i*offset:] for i in range(num_offsets)], offset)
+
+
+def run_model(model, waveforms, single_pass=False):
+    """
+    Run the model over each waveform in the list "waveforms" and return a
+    list of (scores, embeddings) numpy arrays, one per waveform. The model
+    may return TensorFlow tensors or NumPy arrays.
+
+    If single_pass is True the waveforms are zero padded to a whole number of
+    patch hops and concatenated so the model is only called once. The frames
+    that straddle two waveforms are discarded, every other frame sees exactly
+    the same samples as it would in a separate call.
+    """
+    if not single_pass:
+        outputs = []
+        for wave in waveforms:
+            scores, embeddings, spectrogram = model(wave)
+            outputs.append((np.asarray(scores), np.asarray(embeddings)))
+        return outputs
+
+    segments = []
+    frame_ranges = []
+    start_frame = 0
+    for wave in waveforms:
+        num_frames = num_model_frames(len(wave))
+        # Padded length is PATCH_WINDOW_SAMPLES + (num_frames-1) hops, rounded
+        # up to a whole number of hops so the next waveform is hop aligned
+        segment = np.zeros((num_frames + 2)*PATCH_HOP_SAMPLES, dtype=np.float32)
+        segment[:len(wave)] = wave
+        segments.append(segment)
+        frame_ranges.append((start_frame, start_frame + num_frames))
+        start_frame += num_frames + 2
+
+    batch = np.concatenate(segments)
+    scores, embeddings, spectrogram = model(batch)
+    scores = np.asarray(scores)
+    embeddings = np.asarray(embeddings)
+
+    if len(scores) != num_model_frames(len(batch)):
+        raise ValueError("Model produced {} frames, expected {}".format(
+            len(scores), num_model_frames(len(batch))))
+
+    return [(scores[start:end], embeddings[start:end])
+            for (start, end) in frame_ranges]
+
+
+def filter_wave_data(wave_data, low_pass_cutoff = None,
+                     high_pass_cutoff = None, sample_rate = 16000):
+    """
+    Apply the low pass and/or high pass filters to wave_data if the cutoffs
+    are not None and return the result as float32. wave_data may also be a
+    2-D array with one waveform per row.
+    """
+    return filters.bandpass_filter(wave_data, low_pass_cutoff=low_pass_cutoff,
+                                   high_pass_cutoff=high_pass_cutoff,
+                                   fs=sample_rate, order=5)
+
+
+def model_outputs(model, wave_data, num_offsets, single_pass = False):
+    """
+    Run the model over num_offsets offset copies of wave_data and return a
+    tuple of (outputs, offset) where outputs is the list of per-offset
+    (scores, embeddings) from run_model() and offset is in samples
+    """
+    if single_pass:
+        views, offset = offset_views(wave_data, num_offsets)
+        outputs = run_model(model, views, single_pass=True)
+    else:
+        # Set the offset based on the first application of the model
+        outputs = run_model(model, [wave_data])
+        views, offset = offset_views(wave_data, num_offsets,
+                                     num_frames=len(outputs[0][0]))
+        outputs += run_model(model, views[1:])
+
+    return (outputs, offset)
+
+
+def batch_model_outputs(model, waves, num_offsets):
+    """
+    Run the model once over all the offset copies of every waveform in the
+    list "waves" and return a list of (outputs, offset) tuples, one per
+    waveform, as returned by model_outputs() with single_pass=True
+    """
+    views = []
+    offsets = []
+    for wave_data in waves:
+        wave_views, offset = offset_views(wave_data, num_offsets)
+        views += wave_views
+        offsets.append(offset)
+
+    outputs = run_model(model, views, single_pass=True)
+
+    return [(outputs[i*num_offsets:(i + 1)*num_offsets], offsets[i])
+            for i in range(len(waves))]
+
+
+# Per-recording result from score_audio_file_detailed(). The mask and score
+# arrays have one row per offset and one column per frame of the first offset,
+# later offsets with fewer frames are padded with False/0 (-1 for the class).
+# max_bird_classes is the bird class with the score in max_bird_scores.
+# head_scores is a dictionary of {head name: (mean score, max score)} for
+# the classifier heads run on the embeddings (see classifier_heads.py).
+# skipped is True if an activity gate skipped the model, the scores are then
+# zero rather than measured.
+ScoreResult = namedtuple("ScoreResult", ["top_class_score",
+                                         "threshold_score",
+                                         "threshold_masks",
+                                         "top_class_masks",
+                                         "max_bird_scores",
+                                         "max_bird_classes",
+                                         "head_scores",
+                                         "skipped"],
+                         defaults=(False,))
+
+
+def top_k_mask(scores_np, k):
+    """
+    Return a boolean array the shape of scores_np that is True for the k
+    highest scores in each row. This is the set of indices tf.math.top_k()
+    returns, found without sorting: scores above the k-th highest are in,
+    and scores equal to it are taken lowest index first, as top_k() does.
+    """
+    k = min(k, scores_np.shape[1])
+    if k <= 0:
+        return np.zeros(scores_np.shape, dtype=bool)
+    kth = np.partition(scores_np, scores_np.shape[1] - k, axis=1)[:, -k][:, None]
+    above = scores_np > kth
+    ties = scores_np == kth
+    # Number of the tied scores still needed to make up k in each row
+    needed = k - np.count_nonzero(above, axis=1)
+    return above | (ties & (np.cumsum(ties, axis=1) <= needed[:, None]))
+
+
+def score_frames(scores_np, bird_classes, score_threshold = 0.4,
+                 top_k_scores = 3):
+    """
+    Classify each frame of the (num_frames, 521) score matrix scores_np
+
+    A frame passes the threshold test if any of the bird_classes has a score
+    greater than score_threshold, and passes the top class test if any of the
+    top_k_scores classes is one of the bird_classes.
+
+    Return a tuple of (threshold_mask, top_class_mask, max_bird_score) with
+    one entry per frame
+    """
+    max_bird_score = np.max(scores_np[:, bird_classes], axis=1)
+    threshold_mask = max_bird_score > score_threshold
+
+    top_class_mask = np.any(top_k_mask(scores_np, top_k_scores)[:, bird_classes], axis=1)
+
+    return (threshold_mask, top_class_mask, max_bird_score)
+
+
+def score_model_outputs(outputs, bird_classes, score_threshold = 0.4,
+                        top_k_scores = 3, offset = 0, sample_rate = 16000,
+                        heads = None, timings = None, verbose = False):
+    """
+    Build a ScoreResult from the list of per-offset (scores, embeddings) model
+    outputs returned by run_model(). See score_audio_file() for how the
+    scores are calculated. heads is a list of classifier_heads.Head to run
+    on the embeddings. If timings is a dictionary the seconds spent counting
+    and running the heads are added to it as "count" and "heads".
+    """
+    with timing.timed(timings, "count"):
+        result = count_bird_frames(outputs, bird_classes, score_threshold,
+                                   top_k_scores, offset, sample_rate, verbose)
+    if heads:
+        with timing.timed(timings, "heads"):
+            result = result._replace(head_scores=classifier_heads.head_scores(heads, outputs))
+    return result
+
+
+def count_bird_frames(outputs, bird_classes, score_threshold, top_k_scores,
+                      offset, sample_rate, verbose):
+    """
+    Return the ScoreResult of score_model_outputs() without any head scores
+    """
+    num_offsets = len(outputs)
+    num_frames = len(outputs[0][0])
+
+    threshold_masks = np.zeros((num_offsets, num_frames), dtype=bool)
+    top_class_masks = np.zeros((num_offsets, num_frames), dtype=bool)
+    max_bird_scores = np.zeros((num_offsets, num_frames), dtype=np.float32)
+    max_bird_classes = np.full((num_offsets, num_frames), -1, dtype=np.int16)
+
+    for i, (scores_np, embeddings_np) in enumerate(outputs):
+        (threshold_mask, top_class_mask, max_bird_score) = score_frames(
+            scores_np[:num_frames], bird_classes, score_threshold, top_k_scores)
+        n = len(threshold_mask)
+        threshold_masks[i, :n] = threshold_mask
+        top_class_masks[i, :n] = top_class_mask
+        max_bird_scores[i, :n] = max_bird_score
+        max_bird_classes[i, :n] = np.asarray(bird_classes)[
+            np.argmax(scores_np[:n, bird_classes], axis=1)]
+
+        if verbose:
+            print("{:2d} Offset = {:5.3f}, Offset thresh count = {:3d}".format(
+                i,(i*offset)/sample_rate,np.count_nonzero(threshold_mask)))
+            print("{:2d} Offset = {:5.3f}, Offset top count = {:3d}".format(
+                i,(i*offset)/sample_rate,np.count_nonzero(top_class_mask)))
+
+    # Score is averaged over all the offset applications of the model and 
+    # then divided by the number of frames to give a value in the range 0-1
+
+    threshold_score = (np.count_nonzero(threshold_masks)/float(num_offsets))/float(
+            num_frames)
+
+    top_class_score = (np.count_nonzero(top_class_masks)/float(num_offsets))/float(
+            num_frames)
+
+    return ScoreResult(top_class_score, threshold_score, threshold_masks,
+                       top_class_masks, max_bird_scores, max_bird_classes, {})
+
+
+def skipped_result(num_offsets, num_frames, heads = None):
+    """
+    Return the ScoreResult of a recording that skipped the model: zero
+    scores, including for each of the heads, no bird frames and skipped set
+    """
+    return ScoreResult(0.0, 0.0,
+                       np.zeros((num_offsets, num_frames), dtype=bool),
+                       np.zeros((num_offsets, num_frames), dtype=bool),
+                       np.zeros((num_offsets, num_frames), dtype=np.float32),
+                       np.full((num_offsets, num_frames), -1, dtype=np.int16),
+                       {head.name: (0.0, 0.0) for head in heads or []},
+                       skipped=True)
+
+
+def score_audio_file_detailed(filename,
+                      model,
+                      bird_classes,
+                      num_offsets = 5,
+                      low_pass_cutoff = None,
+                      high_pass_cutoff = None,
+                      score_threshold = 0.4,
+                      top_k_scores = 3,
+                      sample_rate = 16000,
+                      stream = None,
+                      stream_type = "mp3",
+                      single_pass = False,
+                      cache = None,
+                      cache_id = None,
+                      timings = None,
+                      gate = None,
+                      heads = None,
+                      load_wave = None,
+                      verbose=False):
+    """
+    Score an audio file in the same way as score_audio_file() but return a
+    ScoreResult holding the per-frame bird masks and maximum bird score for
+    every offset as well as the top class and threshold scores
+
+    If cache is a score_cache.ScoreCache the raw model outputs are looked up
+    there first and stored there after running the model. cache_id identifies
+    the recording (e.g. its Cacophony ID), if None the SHA1 of the file or
+    stream contents is used.
+
+    If timings is a dictionary the seconds spent in each stage ("cache",
+    "decode", "filter", "gate", "model", "count" and "heads") are added to it.
+
+    If gate is an activity.ActivityGate the filtered audio is checked before
+    running the model. If it has too little activity the model isn't run and
+    a zero score with skipped set is returned (see skipped_result()).
+
+    heads is a list of classifier_heads.Head run on the embeddings of the
+    same model pass, their scores are in the result's head_scores. Cached
+    outputs without embeddings are ignored when there are heads.
+
+    load_wave is a function returning the already decoded audio (e.g. from
+    audio_cache.CachedClient.load_audio()), called instead of decoding
+    filename or stream and only if the model outputs aren't cached. cache_id
+    must then be given if there is a cache.
+    """
+
+    cached = None
+    if cache is not None:
+        with timing.timed(timings, "cache"):
+            if cache_id is None:
+                cache_id = "sha1:" + score_cache.content_hash(filename, stream)
+            key = score_cache.make_key(cache_id, sample_rate, low_pass_cutoff,
+                                       high_pass_cutoff, num_offsets,
+                                       model_name=getattr(model, "cache_name", None))
+            cached = cache.get(key)
+            if cached is not None and heads and cached[0][0][1] is None:
+                cached = None
+
+    if cached is not None:
+        (outputs, offset) = cached
+    else:
+        if load_wave is not None:
+            wave_data = load_wave()
+        else:
+            with timing.timed(timings, "decode"):
+                wave_data = utils.load_audio_16k_mono(filename, 
+                    out_sample_rate=sample_rate,stream=stream, stream_type=stream_type)
+        with timing.timed(timings, "filter"):
+            wave_data = filter_wave_data(wave_data, low_pass_cutoff, high_pass_cutoff,
+                                         sample_rate)
+        if gate is not None:
+            with timing.timed(timings, "gate"):
+                active = gate.check(wave_data, num_offsets, sample_rate)
+            if not active:
+                return skipped_result(num_offsets, num_model_frames(len(wave_data)), heads)
+        with timing.timed(timings, "model"):
+            (outputs, offset) = model_outputs(model, wave_data, num_offsets,
+                                              single_pass=single_pass)
+
+        if cache is not None:
+            with timing.timed(timings, "cache"):
+                cache.put(key, outputs, offset)
+
+    return score_model_outputs(outputs, bird_classes,
+                               score_threshold=score_threshold,
+                               top_k_scores=top_k_scores, offset=offset,
+                               sample_rate=sample_rate, heads=heads,
+                               timings=timings, verbose=verbose)
 
 
 def score_audio_file(filename,
@@ -43,6 +380,11 @@ def score_audio_file(filename,
                       sample_rate = 16000,
                       stream = None,
                       stream_type = "mp3",
+                      single_pass = False,
+                      cache = None,
+                      cache_id = None,
+                      timings = None,
+                      gate = None,
                       verbose=False):
     """
     Read audio data from the wave or mp3 file given by "filename"
@@ -58,6 +400,15 @@ def score_audio_file(filename,
     sounds. Run the model num_offsets time, offsetting the start of the file 
     by 1/num_offsets of a frame each time.
 
+    If single_pass is True all the offset copies of the audio are scored with
+    a single call to the model (see run_model()). The scores are the same but
+    the per-call overhead of the model is only paid once.
+
+    If cache is not None the raw model outputs are read from and saved to
+    that score_cache.ScoreCache (see score_audio_file_detailed()), so
+    rescoring with a different threshold, top k or bird classes does not
+    need to rerun the model.
+
     If a bird like sound has a threshold greater than score_threshold that 
     counts towards the threshold score.
 
@@ -67,76 +418,31 @@ def score_audio_file(filename,
     Scores are averaged over all offsets and the number of frames to return
     values from 0-1
 
-    Return a tuple of the count score and the threshold score
-    """
-
-    wave_data = utils.load_audio_16k_mono(filename, 
-        out_sample_rate=sample_rate,stream=stream, stream_type=stream_type)
-
-    if low_pass_cutoff != None:
-        wave_data =utils.butter_lowpass_filter( wave_data, low_pass_cutoff,
-        sample_rate, order=5)
-
-    if high_pass_cutoff != None:
-        wave_data =utils.butter_highpass_filter( wave_data, high_pass_cutoff,
-        sample_rate, order=5)
+    If timings is a dictionary the seconds spent decoding, filtering, running
+    the model and counting are added to it (see timing.py).
 
+    If gate is an activity.ActivityGate, recordings it finds too quiet score
+    zero without running the model.
 
-    sum_threshold_counts = 0
-    sum_top_class_counts = 0
-    offset =0
-
-    for i in range(num_offsets):
-
-        scores, embeddings, spectrogram = model(wave_data[i*offset:])
-
-        top_scores = tf.math.top_k(
-        scores, k=top_k_scores, sorted=True, name=None)
-
-        top_scores = top_scores[1].numpy()
-        scores_np = scores.numpy()
-
-
-
-        if i == 0:
-            # Set some parameters based on the first model applicatoin
-            num_frames = len(scores_np)
-            offset = int((len(wave_data)/num_frames)/num_offsets)
-
-
-        scores_above_threshold  = scores_np[:,:] > score_threshold
-
-        # Count the number of birds in each frame
-        threshold_count = 0
-        top_class_count = 0
-        for frame in range(scores_np.shape[0]):
-            if np.any(scores_above_threshold[frame,bird_classes]):
-                    threshold_count += 1
-
-
-            for frame_class in top_scores[frame,:]:
-                if frame_class in bird_classes:
-                    top_class_count += 1
-                    break
-
-        sum_threshold_counts += threshold_count
-
-        sum_top_class_counts += top_class_count
-
-        if verbose:
-            print("{:2d} Offset = {:5.3f}, Offset thresh count = {:3d}".format(
-                i,(i*offset)/SAMPLE_RATE,threshold_count))
-            print("{:2d} Offset = {:5.3f}, Offset top count = {:3d}".format(
-                i,(i*offset)/SAMPLE_RATE,top_class_count))
-
-
-    # Score is averaged over all the offset applications of the model and 
-    # then divided by the number of frames to give a value in the range 0-1
-
-    threshold_score = (sum_threshold_counts/float(num_offsets))/float(
-            num_frames)
-
-    top_class_score = (sum_top_class_counts/float(num_offsets))/float(
-            num_frames)
+    Return a tuple of the count score and the threshold score. Use
+    score_audio_file_detailed() to also get the per-frame results, or to run
+    classifier heads on the embeddings of the same model pass.
+    """
 
-    return( top_class_score, threshold_score )
+    result = score_audio_file_detailed(filename, model, bird_classes,
+                                       num_offsets=num_offsets,
+                                       low_pass_cutoff=low_pass_cutoff,
+                                       high_pass_cutoff=high_pass_cutoff,
+                                       score_threshold=score_threshold,
+                                       top_k_scores=top_k_scores,
+                                       sample_rate=sample_rate,
+                                       stream=stream,
+                                       stream_type=stream_type,
+                                       single_pass=single_pass,
+                                       cache=cache,
+                                       cache_id=cache_id,
+                                       timings=timings,
+                                       gate=gate,
+                                       verbose=verbose)
+
+    return( result.top_class_score, result.threshold_score )
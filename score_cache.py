@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Persistent cache of raw Yamnet model outputs for Yamnnet/Cacophony Audio
+Classification Experiments
+
+The per-frame score matrix (521 classes) for every offset, and optionally the
+1024 element embeddings, are stored as float16 blobs in an SQLite database.
+Entries are keyed on the recording (ID or content hash) plus the decoding,
+filtering and offset parameters, so scoring with a new score_threshold,
+top_k_scores or set of bird classes only needs the cached scores.
+
+Storing as float16 keeps about three significant figures, so a frame with a
+score within ~0.0002 of score_threshold may be classified differently to an
+uncached run.
+
+@author: que
+"""
+
+import hashlib
+import sqlite3
+import time
+
+import numpy as np
+
+DEFAULT_MAX_SIZE_MB = 1024
+NUM_CLASSES = 521
+EMBEDDING_SIZE = 1024
+
+
+def content_hash(filename=None, stream=None):
+    """
+    Return the SHA1 hex digest of the contents of filename, or of the stream
+    like object "stream" (which is rewound afterwards)
+    """
+    sha = hashlib.sha1()
+    if stream is not None:
+        position = stream.tell()
+        sha.update(stream.read())
+        stream.seek(position, 0)
+    else:
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def make_key(source_id, sample_rate, low_pass_cutoff, high_pass_cutoff,
+             num_offsets, model_name=None):
+    """
+    Build a cache key from the recording ID or content hash and the
+    parameters that change the model outputs. model_name is None for the
+    SavedModel, other backends give their own name.
+    """
+    key = "{}|sr={}|lp={}|hp={}|off={}".format(source_id, sample_rate,
+                                              low_pass_cutoff,
+                                              high_pass_cutoff, num_offsets)
+    if model_name is not None:
+        key += "|model={}".format(model_name)
+    return key
+
+
+class ScoreCache:
+    """
+    SQLite backed cache of per-offset (scores, embeddings) model outputs
+    with least recently used eviction once the stored blobs exceed
+    max_size_mb
+    """
+
+    def __init__(self, filename, max_size_mb=DEFAULT_MAX_SIZE_MB,
+                 store_embeddings=False, dtype=np.float16):
+        self.max_bytes = int(max_size_mb*1024*1024)
+        self.store_embeddings = store_embeddings
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        # Several processes may share the cache (e.g. score_db.py --workers),
+        # so wait for each other's writes rather than fail
+        self.con = sqlite3.connect(filename, isolation_level=None, timeout=60)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute('''CREATE TABLE IF NOT EXISTS outputs
+                 (key TEXT NOT NULL PRIMARY KEY,
+                 dtype TEXT,
+                 frame_counts TEXT,
+                 offset INT,
+                 scores BLOB,
+                 embeddings BLOB,
+                 nbytes INT,
+                 last_access REAL) ''')
+        self.con.execute("CREATE INDEX IF NOT EXISTS outputs_last_access ON outputs(last_access)")
+
+    def get(self, key):
+        """
+        Return a tuple of (outputs, offset) for key, where outputs is a list of
+        (scores, embeddings) float32 arrays per offset, or None if key is not
+        cached. embeddings is None when they were not stored.
+        """
+        row = self.con.execute("SELECT dtype, frame_counts, offset, scores, embeddings "
+                               "FROM outputs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.con.execute("UPDATE outputs SET last_access = ? WHERE key = ?",
+                         (time.time(), key))
+
+        (dtype, frame_counts, offset, scores_blob, embeddings_blob) = row
+        frame_counts = [int(n) for n in frame_counts.split(",")]
+        scores = np.frombuffer(scores_blob, dtype=dtype).reshape(-1, NUM_CLASSES)
+        scores = np.split(scores.astype(np.float32), np.cumsum(frame_counts)[:-1])
+        if embeddings_blob is None:
+            embeddings = [None]*len(scores)
+        else:
+            embeddings = np.frombuffer(embeddings_blob, dtype=dtype).reshape(-1, EMBEDDING_SIZE)
+            embeddings = np.split(embeddings.astype(np.float32), np.cumsum(frame_counts)[:-1])
+
+        return (list(zip(scores, embeddings)), offset)
+
+    def put(self, key, outputs, offset=0):
+        """
+        Store the list of per-offset (scores, embeddings) model outputs under
+        key and evict the least recently used entries if the cache is full
+        """
+        frame_counts = ",".join(str(len(scores)) for (scores, embeddings) in outputs)
+        scores_blob = np.concatenate([scores for (scores, embeddings) in outputs]).astype(
+            self.dtype).tobytes()
+        embeddings_blob = None
+        if self.store_embeddings and outputs[0][1] is not None:
+            embeddings_blob = np.concatenate([embeddings for (scores, embeddings) in outputs]).astype(
+                self.dtype).tobytes()
+        nbytes = len(scores_blob) + (len(embeddings_blob) if embeddings_blob else 0)
+
+        self.con.execute("INSERT OR REPLACE INTO outputs VALUES (?,?,?,?,?,?,?,?)",
+                         (key, self.dtype.str, frame_counts, offset, scores_blob,
+                          embeddings_blob, nbytes, time.time()))
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the total size of the
+        stored blobs is no more than max_bytes
+        """
+        total = self.con.execute("SELECT COALESCE(SUM(nbytes), 0) FROM outputs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for (key, nbytes) in self.con.execute("SELECT key, nbytes FROM outputs ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= nbytes
+        self.con.executemany("DELETE FROM outputs WHERE key = ?", stale)
+
+    def close(self):
+        self.con.close()
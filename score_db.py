@@ -15,17 +15,38 @@ Results are stored in an SQLite database
 
 import sqlite3
 import io
+import os
+import subprocess
+import sys
 import utils
 import score
+import score_cache
+import audio_cache
 
 import datetime
+import time
 import argparse
 from dateutil.parser import parse as parsedate
 from dateutil.tz import tzlocal
-from cacophonyapi.user import UserAPI as API
+import local_api
+import pipeline
+import jobs
+import timing
+import solar
+import rollups
+import detections
+import activity
+import classifier_heads
+import shards
+import cProfile
+import pstats
 local_tz = tzlocal()
 
-from private import private_data
+try:
+    from private import private_data
+except ImportError:
+    # Only needed when talking to the Cacophony server
+    private_data = None
 
 
 DEFAULT_START_DATE = datetime.date(2021,9,17)
@@ -37,6 +58,26 @@ DEFAULT_NUM_OFFSETS = 3
 DEFAULT_SCORE_THRESHOLD= 0.4
 DEFAULT_TOP_K_CLASS = 3
 SAMPLE_RATE = 16000
+INSERT_BATCH_SIZE = 100
+# sunrise and sunset keep their time zone, e.g. "2021-10-01 06:35:00+13:00",
+# which sqlite3's TIMESTAMP converter can't parse, so they are TEXT
+SOLAR_COLUMNS = (("sunrise", "TEXT"), ("sunset", "TEXT"),
+                 ("hours_from_sunrise", "REAL"))
+SCORES_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS {}
+                 (id INTEGER NOT NULL PRIMARY KEY,
+                 ts TIMESTEMP,
+                 dev_name TEXT,
+                 dev_id INT,
+                 thresh_score REAL,
+                 class_score REAL,
+                 ci_score REAL,
+                 latitude REAL,
+                 longtitude REAL,
+                 sunrise TEXT,
+                 sunset TEXT,
+                 hours_from_sunrise REAL) '''
+SCORES_COLUMNS = ("id", "ts", "dev_name", "dev_id", "thresh_score", "class_score", "ci_score",
+                  "latitude", "longtitude", "sunrise", "sunset", "hours_from_sunrise")
 
 
 def parse_arguments():
@@ -106,6 +147,193 @@ def parse_arguments():
         default = DEFAULT_TOP_K_CLASS,
         help="Top N for class score to be counted as bird" )
     
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="Score all the offsets with a single call to the model, always the case with --pipeline" )
+
+    parser.add_argument(
+        "--backend",
+        choices=utils.MODEL_BACKENDS,
+        default = "savedmodel",
+        help="Run the SavedModel or a converted TFLite model (see tflite_model.py)" )
+
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default = None,
+        help="Cache the raw model outputs in this SQLite3 Database" )
+
+    parser.add_argument(
+        "--cache-size-mb",
+        type=int,
+        default = score_cache.DEFAULT_MAX_SIZE_MB,
+        help="Maximum size of the model output cache in MB" )
+
+    parser.add_argument(
+        "--cache-embeddings",
+        action="store_true",
+        help="Store the embeddings as well as the scores in the cache, always on with --head" )
+
+    parser.add_argument(
+        "--audio-cache",
+        type=str,
+        default = None,
+        help="Keep downloaded and decoded recordings in this directory (see audio_cache.py)" )
+
+    parser.add_argument(
+        "--audio-cache-size-mb",
+        type=int,
+        default = audio_cache.DEFAULT_MAX_SIZE_MB,
+        help="Maximum size of the audio cache in MB" )
+
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Overlap downloading, decoding, scoring and database writes" )
+
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default = pipeline.DEFAULT_DOWNLOAD_WORKERS,
+        help="Number of download threads when using --pipeline" )
+
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default = pipeline.DEFAULT_DECODE_WORKERS,
+        help="Number of decode/filter processes when using --pipeline (0 to decode in the download threads)" )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default = pipeline.DEFAULT_BATCH_SIZE,
+        help="Maximum number of recordings per model call when using --pipeline" )
+
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default = pipeline.DEFAULT_MAX_WAIT,
+        help="Maximum seconds to wait to fill a batch when using --pipeline" )
+
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default = pipeline.DEFAULT_QUEUE_SIZE,
+        help="Maximum number of recordings in flight when using --pipeline" )
+
+    parser.add_argument(
+        "--local-dir",
+        type=str,
+        default = None,
+        help="Serve recordings from this directory (laid out like test_files/) instead of the Cacophony server" )
+
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default = jobs.DEFAULT_MAX_ATTEMPTS,
+        help="Give up on a recording after this many failed attempts" )
+
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default = jobs.DEFAULT_RETRY_BACKOFF,
+        help="Seconds to wait before the first retry of a failed recording, doubling with each attempt" )
+
+    parser.add_argument(
+        "--max-retry-wait",
+        type=float,
+        default = 0.0,
+        help="Wait up to this many seconds in total at the end of a run to retry failed recordings, "
+             "by default they are retried by the next run" )
+
+    parser.add_argument(
+        "--requery",
+        action="store_true",
+        help="Query the server for every day even if its recordings are already in the jobs table" )
+
+    parser.add_argument(
+        "--requery-days",
+        type=float,
+        default = jobs.DEFAULT_REQUERY_DAYS,
+        help="Query a day again on each run until it has been queried this many days after it "
+             "ended, to pick up recordings uploaded late. Later uploads need --requery" )
+
+    parser.add_argument(
+        "--timings-log",
+        type=str,
+        default = None,
+        help="Append per-recording stage timings to this JSONL file (serial scorer only)" )
+
+    parser.add_argument(
+        "--timings-table",
+        action="store_true",
+        help="Store per-recording stage timings in a timings table in the database (serial scorer only)" )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default = None,
+        help="Save a cProfile of the run to this file and print the slowest functions" )
+
+    parser.add_argument(
+        "--detections",
+        action="store_true",
+        help="Also store the per-frame bird detections of each recording (see detections.py)" )
+
+    parser.add_argument(
+        "--activity-gate",
+        action="store_true",
+        help="Skip the model for recordings with too little activity, marking their jobs as skipped (see activity.py)" )
+
+    parser.add_argument(
+        "--activity-db",
+        type=float,
+        default = activity.DEFAULT_THRESHOLD_DB,
+        help="With --activity-gate, frames this many dB above the noise floor are active" )
+
+    parser.add_argument(
+        "--min-activity",
+        type=float,
+        default = activity.DEFAULT_MIN_ACTIVITY,
+        help="With --activity-gate, skip the model if less than this fraction of frames are active" )
+
+    parser.add_argument(
+        "--head",
+        type=str,
+        action="append",
+        default = [],
+        help="Saved Keras classifier head to run on the YAMNet embeddings, as NAME=PATH or PATH. Can be repeated (see classifier_heads.py)" )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default = 1,
+        help="Split the days between this many processes, each with its own database, and merge them at the end (see shards.py)" )
+
+    parser.add_argument(
+        "--shard",
+        type=shards.parse_shard,
+        default = None,
+        help="Only score every N'th day starting with day i of the date range, given as i/N, e.g. to split a run over machines" )
+
+    parser.add_argument(
+        "--merge",
+        type=str,
+        nargs="+",
+        default = None,
+        help="Only merge these shard databases into the database" )
+
+    parser.add_argument(
+        "--solar-backfill",
+        action="store_true",
+        help="Only fill in the sunrise, sunset and hours from sunrise columns for existing records" )
+
+    parser.add_argument(
+        "--rebuild-rollups",
+        action="store_true",
+        help="Only rebuild the daily and hourly summary tables from the scores table" )
+
     parser.add_argument(
         "--pos-only",
         action="store_true",
@@ -124,6 +352,30 @@ def parse_arguments():
     return args
 
 
+def configure_connection(con):
+    """
+    
+    Switch the database pointed to by con to write-ahead logging and set
+    pragmas suited to bulk inserts
+
+    Parameters
+    ----------
+    con : SqLite3 Connection
+        Connection to open database.
+
+    Returns
+    -------
+    None
+
+    """
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-65536")
+    # INSERT OR REPLACE only fires the rollup delete triggers with this on
+    con.execute("PRAGMA recursive_triggers=ON")
+
+
 def create_sql_table(con):
     """
     
@@ -141,18 +393,107 @@ def create_sql_table(con):
     """
 
     cur = con.cursor()
-    cur.execute('''CREATE TABLE IF NOT EXISTS scores
-                 (id INTEGER NOT NULL PRIMARY KEY,
-                 ts TIMESTEMP,
-                 dev_name TEXT,
-                 dev_id INT,
-                 thresh_score REAL,
-                 class_score REAL,
-                 ci_score REAL,
-                 latitude REAL,
-                 longtitude REAL) ''')
+    cur.execute(SCORES_TABLE_SQL.format("scores"))
+
+    # Add the solar columns to databases created before they existed
+    columns = dict((row[1], row[2]) for row in cur.execute("PRAGMA table_info(scores)"))
+    for (name, sql_type) in SOLAR_COLUMNS:
+        if name not in columns:
+            cur.execute("ALTER TABLE scores ADD COLUMN {} {}".format(name, sql_type))
+    if "TIMESTAMP" in (columns.get("sunrise"), columns.get("sunset")):
+        migrate_solar_columns(con)
+
+    # Daily and hourly summaries kept up to date by triggers
+    rollups.create_rollup_tables(con)
+    cur.execute("CREATE INDEX IF NOT EXISTS scores_ts ON scores(ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS scores_dev_id ON scores(dev_id)")
 
+
+
+def migrate_solar_columns(con):
+    """
     
+    Rebuild the scores table of databases made when sunrise and sunset were
+    declared TIMESTAMP, so they are TEXT. Reading them from a connection
+    opened with PARSE_DECLTYPES failed on their time zone. The values are
+    copied unchanged. The indexes and the rollup triggers are dropped with
+    the old table and created again by create_sql_table().
+
+    Parameters
+    ----------
+    con : SqLite3 Connection
+        Connection to open database.
+
+    Returns
+    -------
+    None
+
+    """
+    print("Changing the sunrise and sunset columns of the scores table to TEXT")
+    column_list = ", ".join(SCORES_COLUMNS)
+    con.commit()
+    with con:
+        con.execute("DROP TABLE IF EXISTS scores_migrate")
+        con.execute(SCORES_TABLE_SQL.format("scores_migrate"))
+        con.execute("INSERT INTO scores_migrate ({0}) SELECT {0} FROM scores".format(column_list))
+        con.execute("DROP TABLE scores")
+        con.execute("ALTER TABLE scores_migrate RENAME TO scores")
+    
+    
+def insert_results(con, rows, detection_rows = (), head_rows = ()):
+    """
+    
+    Insert the scores, detections and head scores of a batch of recordings.
+    If the batch fails with an IntegrityError, e.g. for a recording already
+    in the scores table, it is rolled back and inserted a recording at a
+    time so only the recordings that fail are left out. Nothing is
+    committed, a transaction is begun if one isn't open so the rows are
+    committed together with the caller's other changes, e.g. job states.
+
+    Parameters
+    ----------
+    con : SQlite3 DB connection
+        Connection to open sqlite DB.
+    rows : list of tuple
+        Rows for the scores table from make_score_row().
+    detection_rows : list of tuple
+        (detection, frame_rows) tuples from detections.make_detection_rows().
+    head_rows : list of tuple
+        Rows from classifier_heads.head_score_rows().
+
+    Returns
+    -------
+    List of (rec_id, error) tuples for the recordings that couldn't be
+    inserted.
+
+    """
+    # Without an open transaction the outermost SAVEPOINT would start one
+    # that its RELEASE commits
+    if not con.in_transaction:
+        con.execute("BEGIN")
+    batches = [(rows, detection_rows, head_rows)]
+    failures = []
+    while batches:
+        (batch_rows, batch_detections, batch_heads) = batches.pop(0)
+        con.execute("SAVEPOINT insert_results")
+        try:
+            insert_score_rows(con, batch_rows)
+            detections.insert_detections(con, batch_detections)
+            classifier_heads.insert_head_scores(con, batch_heads)
+            con.execute("RELEASE insert_results")
+        except sqlite3.IntegrityError as e:
+            con.execute("ROLLBACK TO insert_results")
+            con.execute("RELEASE insert_results")
+            if len(batch_rows) == 1:
+                print("       Failed storing recording {:6d}: {}".format(batch_rows[0][0], e),
+                      flush=True)
+                failures.append((batch_rows[0][0], e))
+                continue
+            # Retry each recording on its own
+            batches += [([row], [d for d in batch_detections if d[0][0] == row[0]],
+                         [h for h in batch_heads if h[0] == row[0]]) for row in batch_rows]
+    return failures
+
     
 def recording_in_db(rec_id, con):
     """
@@ -178,6 +519,33 @@ def recording_in_db(rec_id, con):
     rows = cur.execute("SELECT id from scores where id = ?",(rec_id,))
     r = rows.fetchone()
     return r is not None
+
+
+def recordings_in_db(rec_ids, con):
+    """
+    
+    Returns the set of IDs in rec_ids that are already in the database
+    pointed to by "con", using a single query
+    
+    Parameters
+    ----------
+    rec_ids : iterable of int
+        IDs of the recordings.
+    con : SQLite3 connection
+        Connection to open DB.
+
+    Returns
+    -------
+    set of the IDs that are already in the database
+
+    """
+    
+    cur = con.cursor()
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS query_ids (id INTEGER NOT NULL PRIMARY KEY)")
+    cur.execute("DELETE FROM query_ids")
+    cur.executemany("INSERT OR IGNORE INTO query_ids VALUES (?)", [(rec_id,) for rec_id in rec_ids])
+    rows = cur.execute("SELECT scores.id FROM scores JOIN query_ids ON scores.id = query_ids.id")
+    return set(r[0] for r in rows)
     
     
 def extract_mean_ci_score(rec):
@@ -235,14 +603,12 @@ def get_lat_long(rec):
 
 
 
-def insert_scores_into_db(con,scores, ci, rec):
+def make_score_row(scores, ci, rec):
     """
     
 
     Parameters
     ----------
-    con : SQlite3 DB connection
-        Connection to open sqlite DB.
     scores : tuple
         tuple of scores (class,thresh).
     ci : float
@@ -252,7 +618,9 @@ def insert_scores_into_db(con,scores, ci, rec):
 
     Returns
     -------
-    None.
+    Tuple of values for a row of the scores table. Latitude and longtitude
+    are None if the record has no position, and the sunrise, sunset and
+    hours from sunrise (see solar.py) are None without a position.
 
     """
     rec_id = rec['id']
@@ -261,26 +629,96 @@ def insert_scores_into_db(con,scores, ci, rec):
     dt = parsedate(rec["recordingDateTime"])
     dt = dt.astimezone(local_tz)
     (lat,long) = get_lat_long(rec)
-    cur = con.cursor()
-    if lat is None or long is None:
+    return (rec_id, dt, dev_name, dev_id, scores[1], scores[0], ci, lat, long) + \
+        solar.solar_columns(dt, lat, long)
 
-        cur.execute("INSERT into scores VALUES ( ?,?,?,?,?,?,?)",( rec_id, dt,
-                dev_name,dev_id, scores[1], scores[0], ci ))
-        
-        print("        Dev name: {:30s} Time = {}".format(dev_name, dt.strftime("%d-%h-%Y %H:%M:%S")))
-        print("        Thresh = {:4.2f} Class = {:4.2f} CI = {:4.2f}".format(scores[1],scores[0],ci)) 
-        print("        No position (lat/long) data",flush=True  )                                                     
+
+def insert_score_rows(con, rows):
+    """
     
-    else:  
-        cur.execute("INSERT into scores VALUES ( ?,?,?,?,?,?,?,?,?)",( rec_id, dt,
-                dev_name,dev_id, scores[1], scores[0], ci,lat,long ))
-        
+
+    Parameters
+    ----------
+    con : SQlite3 DB connection
+        Connection to open sqlite DB.
+    rows : list of tuple
+        Rows for the scores table from make_score_row().
+
+    Returns
+    -------
+    None.
+
+    """
+    con.executemany("INSERT into scores (id, ts, dev_name, dev_id, thresh_score, class_score, "
+                    "ci_score, latitude, longtitude, sunrise, sunset, hours_from_sunrise) "
+                    "VALUES ( ?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+
+    for (rec_id, dt, dev_name, dev_id, thresh, class_score, ci, lat, long, *sun) in rows:
         print("        Dev name: {:30s} Time = {}".format(dev_name, dt.strftime("%d-%h-%Y %H:%M:%S")))
-        print("        Thresh = {:4.2f} Class = {:4.2f} CI = {:4.2f}".format(scores[1],scores[0],ci)) 
-        print("        Lat.   = {:4.2f} Long. = {:4.2f}".format(lat,long),flush=True  ) 
+        print("        Thresh = {:4.2f} Class = {:4.2f} CI = {:4.2f}".format(thresh,class_score,ci)) 
+        if lat is None or long is None:
+            print("        No position (lat/long) data",flush=True  )                                                     
+        else:
+            print("        Lat.   = {:4.2f} Long. = {:4.2f}".format(lat,long),flush=True  ) 
+
+
+def insert_scores_into_db(con,scores, ci, rec):
+    """
+    
+
+    Parameters
+    ----------
+    con : SQlite3 DB connection
+        Connection to open sqlite DB.
+    scores : tuple
+        tuple of scores (class,thresh).
+    ci : float
+        cacophony score.
+    rec : dict
+        dictionary of audio record.
+
+    Returns
+    -------
+    None.
+
+    """
+    insert_score_rows(con, [make_score_row(scores, ci, rec)])
                                                                      
         
-def score_recordings(recordings,args,con,model, client):
+def select_recordings_to_score(recordings, con):
+    """
+    
+    Return the recordings in "recordings" which have been processed by the
+    server and are not yet in the database pointed to by con. Jobs for
+    recordings already in the database are marked as scored.
+    
+    Parameters
+    ----------
+    recordings : list
+        List of recording records.
+    con : SQLite3 connection
+        connection to open SQLite database.
+
+    Returns
+    -------
+    list of recording records.
+
+    """
+    known_ids = recordings_in_db([rec['id'] for rec in recordings], con)
+    to_score = []
+    for rec in recordings:
+        if rec['id'] in known_ids:
+            print ("      Recording {:6d} is already in the database".format(rec['id']))
+        elif rec['processingState'] != 'FINISHED':
+            print ("      Recording {:6d} has not been processed".format(rec['id']))
+        else:
+            to_score.append(rec)
+    jobs.mark_jobs(con, known_ids, jobs.SCORED)
+    return to_score
+
+
+def score_recordings(recordings,args,con,model, client, cache=None, timing_log=None,
+                     gate=None, heads=None):
     """
     
     
@@ -297,6 +735,14 @@ def score_recordings(recordings,args,con,model, client):
     model : Yamnet Model
         Yamnet model.
     client: API connection
+    cache : score_cache.ScoreCache or None
+        Cache of raw model outputs.
+    timing_log : timing.TimingLog or None
+        Records the time spent in each stage for every recording.
+    gate : activity.ActivityGate or None
+        Skips the model for recordings with too little activity.
+    heads : list of classifier_heads.Head or None
+        Classifier heads run on the embeddings.
     
 
     Returns
@@ -306,40 +752,206 @@ def score_recordings(recordings,args,con,model, client):
     """
     
     
-    for rec in recordings:
-        
-        if recording_in_db(rec['id'], con):
-            print ("      Recording {:6d} is already in the database".format(rec['id']))
-        elif rec['processingState'] != 'FINISHED':
-            print ("      Recording {:6d} has not been processed".format(rec['id']))
-        else:
-            print("       Downloading recording {:6d} ".format(rec['id']))                                                                        
-              
-                                                                     
-            try:
-                audio_data = client.download_raw(rec['id'])
-                with io.BytesIO() as f:
-                    for chunk in audio_data:
-                        f.write(chunk)
-                    f.seek(0,0)
-                    scores =score.score_audio_file("",model, 
-                                               utils.BIRDS_CLASSES,
-                                               num_offsets=args.num_offsets, 
-                                               low_pass_cutoff=args.lowpass,
-                                               high_pass_cutoff=args.highpass, 
-                                               score_threshold=args.score_threshold, 
-                                               top_k_scores=args.top_k_class, 
-                                               sample_rate=SAMPLE_RATE,
-                                               stream=f,
-                                               stream_type="mp4")     
-                    ci = extract_mean_ci_score(rec)
+    rows = []
+    detection_rows = []
+    head_rows = []
+    failures = []
+    skipped = []
+
+    def write_batch():
+        start = time.perf_counter()
+        failures.extend(insert_results(con, rows, detection_rows, head_rows))
+        failed_ids = set(rec_id for (rec_id, error) in failures)
+        jobs.mark_jobs(con, [row[0] for row in rows if row[0] not in failed_ids], jobs.SCORED)
+        jobs.mark_jobs(con, skipped, jobs.SKIPPED)
+        jobs.mark_failed(con, failures, args.retry_backoff)
+        con.commit()
+        if timing_log is not None and (rows or failures):
+            timing_log.record(None, {"insert": time.perf_counter() - start})
+        del rows[:]
+        del detection_rows[:]
+        del head_rows[:]
+        del failures[:]
+        del skipped[:]
+
+    for rec in select_recordings_to_score(recordings, con):
+        print("       Downloading recording {:6d} ".format(rec['id']))                                                                        
+        jobs.mark_jobs(con, [rec['id']], jobs.DOWNLOADING)
                                                                  
-                                                                         
-                    insert_scores_into_db(con,scores, ci, rec) 
-            except:
-                print("       Failed downloading recording {:6d}".format(rec['id']),flush=True) 
+        timings = {}
+        num_bytes = None
+        try:
+            stream = None
+            load_wave = None
+            if isinstance(client, audio_cache.CachedClient):
+                # Decoded audio from the audio cache, downloaded only if
+                # missing, and only loaded if the model outputs aren't cached
+                downloaded = []
+                def load_wave(rec_id=rec['id']):
+                    (wave_data, num_bytes) = client.load_audio(rec_id, SAMPLE_RATE, timings)
+                    downloaded.append(num_bytes)
+                    return wave_data
+            else:
+                stream = io.BytesIO()
+                with timing.timed(timings, "download"):
+                    for chunk in client.download_raw(rec['id']):
+                        stream.write(chunk)
+                num_bytes = stream.tell()
+                stream.seek(0,0)
+            result = score.score_audio_file_detailed("",model, 
+                                       utils.BIRDS_CLASSES,
+                                       num_offsets=args.num_offsets, 
+                                       low_pass_cutoff=args.lowpass,
+                                       high_pass_cutoff=args.highpass, 
+                                       score_threshold=args.score_threshold, 
+                                       top_k_scores=args.top_k_class, 
+                                       sample_rate=SAMPLE_RATE,
+                                       stream=stream,
+                                       stream_type=utils.client_stream_type(client),
+                                       single_pass=args.single_pass,
+                                       cache=cache,
+                                       cache_id="rec:{}".format(rec['id']),
+                                       timings=timings,
+                                       gate=gate,
+                                       heads=heads,
+                                       load_wave=load_wave)
+            if load_wave is not None:
+                num_bytes = sum(downloaded)
+            if result.skipped:
+                print("       Recording {:6d} skipped by the activity gate".format(rec['id']))
+                skipped.append(rec['id'])
+            else:
+                ci = extract_mean_ci_score(rec)
+                scores = (result.top_class_score, result.threshold_score)
+                                                         
+                rows.append(make_score_row(scores, ci, rec))
+                if args.detections:
+                    detection_rows.append(detections.make_detection_rows(rec['id'], result,
+                                                                         SAMPLE_RATE))
+                head_rows += classifier_heads.head_score_rows(rec['id'], result.head_scores)
+        except Exception as e:
+            print("       Failed scoring recording {:6d}: {}".format(rec['id'], e),flush=True) 
+            failures.append((rec['id'], e))
+
+        if timing_log is not None:
+            timing_log.record(rec['id'], timings, num_bytes)
+
+        if len(rows) + len(failures) + len(skipped) >= INSERT_BATCH_SIZE:
+            write_batch()
+
+    write_batch()
     
     
+def write_pipeline_results(con, items, retry_backoff=jobs.DEFAULT_RETRY_BACKOFF,
+                           store_detections=False):
+    """
+    Store the results of scoring recordings in the pipeline. Called in the
+    pipeline's writer thread with its own connection "con".
+
+    Parameters
+    ----------
+    con : SQLite3 connection
+        Writer connection to the open database.
+    items : list of tuple
+        (rec, result, error) for each recording where result is the
+        score.ScoreResult, or None and error is the reason the recording
+        could not be scored. The scores of any classifier heads in the
+        results are stored too. Recordings the activity gate skipped are
+        only marked as skipped in the jobs table.
+    retry_backoff : float
+        Initial delay in seconds before a failed recording is retried.
+    store_detections : bool
+        Also store the per-frame detections (see detections.py).
+
+    Returns
+    -------
+    None.
+
+    """
+    rows = []
+    detection_rows = []
+    head_rows = []
+    failures = []
+    skipped = []
+    for (rec, result, error) in items:
+        if error is not None:
+            print("       Failed scoring recording {:6d}: {}".format(rec['id'], error),flush=True)
+            failures.append((rec['id'], error))
+            continue
+        if result.skipped:
+            print("       Recording {:6d} skipped by the activity gate".format(rec['id']))
+            skipped.append(rec['id'])
+            continue
+        scores = (result.top_class_score, result.threshold_score)
+        rows.append(make_score_row(scores, extract_mean_ci_score(rec), rec))
+        if store_detections:
+            detection_rows.append(detections.make_detection_rows(rec['id'], result, SAMPLE_RATE))
+        head_rows += classifier_heads.head_score_rows(rec['id'], result.head_scores)
+    failures += insert_results(con, rows, detection_rows, head_rows)
+    failed_ids = set(rec_id for (rec_id, error) in failures)
+    jobs.mark_jobs(con, [row[0] for row in rows if row[0] not in failed_ids], jobs.SCORED)
+    jobs.mark_jobs(con, skipped, jobs.SKIPPED)
+    jobs.mark_failed(con, failures, retry_backoff)
+
+
+def score_recordings_pipelined(recordings,args,con,model, client, gate=None, heads=None):
+    """
+    
+    Score the recordings in the list "recordings" using the staged pipeline
+    in pipeline.py, with stage concurrency set from the command line
+
+    Parameters
+    ----------
+    recordings : list
+        List of recording records.
+    args : dict
+        Dictionary of command-line parameter.
+    con : SQLite3 connection
+        connection to open SQLite database.
+    model : Yamnet Model
+        Yamnet model.
+    client: API connection
+    gate : activity.ActivityGate or None
+        Skips the model for recordings with too little activity.
+    heads : list of classifier_heads.Head or None
+        Classifier heads run on the embeddings.
+
+    Returns
+    -------
+    None.
+
+    """
+    to_score = select_recordings_to_score(recordings, con)
+    jobs.mark_jobs(con, [rec['id'] for rec in to_score], jobs.DOWNLOADING)
+
+    # Make sure the writer thread's connection sees a consistent database
+    con.commit()
+
+    def write_results(writer_con, items):
+        write_pipeline_results(writer_con, items, args.retry_backoff, args.detections)
+
+    def open_writer():
+        writer_con = sqlite3.connect(args.database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        configure_connection(writer_con)
+        return writer_con
+
+    pipeline.run_pipeline(to_score, client, model, utils.BIRDS_CLASSES,
+                          open_writer, write_results,
+                          num_offsets=args.num_offsets,
+                          low_pass_cutoff=args.lowpass,
+                          high_pass_cutoff=args.highpass,
+                          score_threshold=args.score_threshold,
+                          top_k_scores=args.top_k_class,
+                          sample_rate=SAMPLE_RATE,
+                          download_workers=args.download_workers,
+                          decode_workers=args.decode_workers,
+                          batch_size=args.batch_size,
+                          max_wait=args.max_wait,
+                          queue_size=args.queue_size,
+                          gate=gate,
+                          heads=heads)
+
+
 def update_position(recordings, con):
     """
 
@@ -361,22 +973,30 @@ def update_position(recordings, con):
 
     """
     
+    known_ids = recordings_in_db([rec['id'] for rec in recordings], con)
+    updates = []
     for rec in recordings:
         rec_id = rec['id']
         print("       Updating recording {:6d} ".format(rec_id))         
-        if recording_in_db(rec_id, con):
+        if rec_id in known_ids:
             (lat, long) = get_lat_long(rec)
             if lat is None or long is None:
                 print("         Record {} has no position data".format(rec_id))
                 continue
-            cur = con.cursor()
-            cur.execute("UPDATE scores SET latitude = ?, longtitude = ? WHERE id = ?",( lat,long, rec_id))
+            updates.append((lat, long, rec_id))
         
             print("        Lat = {:4.2f} Long = {:4.2f}".format(lat,long),flush=True )
     
         else:
             print("         Recording {:6d} is not in the database ".format(rec_id))  
 
+    # The solar columns depend on the position so are recalculated for the
+    # updated rows
+    con.executemany("UPDATE scores SET latitude = ?, longtitude = ?, sunrise = NULL, "
+                    "sunset = NULL, hours_from_sunrise = NULL WHERE id = ?", updates)
+    if solar.Sun is not None:
+        solar.update_solar_columns(con, [rec_id for (lat, long, rec_id) in updates])
+
 
 def update_ci_score(recordings, con):
     """
@@ -399,19 +1019,86 @@ def update_ci_score(recordings, con):
 
     """
     
+    known_ids = recordings_in_db([rec['id'] for rec in recordings], con)
+    updates = []
     for rec in recordings:
         rec_id = rec['id']
         print("       Updating recording {:6d} ".format(rec_id))         
-        if recording_in_db(rec_id, con):
+        if rec_id in known_ids:
             ci_score = extract_mean_ci_score(rec)
-            cur = con.cursor()
-            cur.execute("UPDATE scores SET ci_score = ? WHERE id = ?",( ci_score, rec_id))
+            updates.append((ci_score, rec_id))
         
             print("          CI Score =  {:4.2f}".format(ci_score),flush=True )
     
         else:
             print("         Recording {:6d} is not in the database ".format(rec_id))  
 
+    con.executemany("UPDATE scores SET ci_score = ? WHERE id = ?", updates)
+
+
+
+def score_job_recordings(recordings, args, con, model, client, cache=None, timing_log=None,
+                         gate=None, heads=None):
+    """
+    
+    Score the recordings with the serial or pipelined scorer depending on
+    the command line arguments
+
+    Returns
+    -------
+    None.
+
+    """
+    if args.pipeline:
+        score_recordings_pipelined(recordings,args,con,model, client, gate, heads)
+    else:     
+        score_recordings(recordings,args,con,model, client, cache, timing_log, gate, heads)
+
+
+def retry_failed_jobs(args, con, model, client, cache=None, timing_log=None, gate=None,
+                      heads=None):
+    """
+    
+    Retry failed recordings between args.start_date and args.end_date once
+    their backoff has expired, waiting for up to args.max_retry_wait
+    seconds in total. Anything left is retried on the next run.
+
+    Parameters
+    ----------
+    args : dictionary 
+        Command line arguments.
+    con : SQLite3 connection
+        connection to open SQLite database.
+    model : Yamnet Model
+        Yamnet model.
+    client: API connection
+    cache : score_cache.ScoreCache or None
+        Cache of raw model outputs.
+    timing_log : timing.TimingLog or None
+        Records the time spent in each stage for every recording.
+    gate : activity.ActivityGate or None
+        Skips the model for recordings with too little activity.
+    heads : list of classifier_heads.Head or None
+        Classifier heads run on the embeddings.
+
+    Returns
+    -------
+    None.
+
+    """
+    waited = 0.0
+    while True:
+        delay = jobs.next_retry_delay(con, args.start_date, args.end_date, args.max_attempts)
+        if delay is None or waited + delay > args.max_retry_wait:
+            break
+        print("Retrying failed recordings in {:.0f}s".format(delay), flush=True)
+        time.sleep(delay)
+        waited += delay
+        recordings = jobs.runnable_jobs(con, args.start_date, args.end_date, args.max_attempts,
+                                          include_skipped=gate is None)
+        score_job_recordings(recordings, args, con, model, client, cache, timing_log, gate,
+                             heads)
+        con.commit()
 
 
 def process_all_recordings(args):
@@ -419,6 +1106,10 @@ def process_all_recordings(args):
     
     Download and score all the audio recordings between the specified dates args.start_date and
     args.end_date. This is done one day at a time to avoid limits on the maximum number of downloads
+
+    Recordings are tracked in the jobs table (see jobs.py) so days that have
+    already been enumerated are not queried again and failed recordings are
+    retried with backoff
     
 
     Parameters
@@ -437,38 +1128,166 @@ def process_all_recordings(args):
     delta_date = datetime.timedelta(days=1)
     end_date = curr_date + delta_date
     
-    model, class_names = utils.load_model_and_class_names()
+    model, class_names = utils.load_model_and_class_names(args.backend)
+    heads = [classifier_heads.parse_head(spec) for spec in args.head]
     
-    client = API(private_data['server'], private_data['username'],private_data['password'])
+    if args.local_dir is not None:
+        client = local_api.LocalAPI(args.local_dir)
+    else:
+        from cacophonyapi.user import UserAPI as API
+        client = API(private_data['server'], private_data['username'],private_data['password'])
+
+    recordings_cache = None
+    if args.audio_cache is not None:
+        recordings_cache = audio_cache.AudioCache(args.audio_cache, args.audio_cache_size_mb)
+        client = audio_cache.CachedClient(client, recordings_cache)
     
 
     con = sqlite3.connect(args.database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    configure_connection(con)
     
     create_sql_table(con)
+    if args.detections:
+        detections.create_detections_tables(con)
+    if heads:
+        classifier_heads.create_head_scores_table(con)
+
+    cache = None
+    if args.cache is not None:
+        # Heads need the embeddings, outputs cached without them aren't reused
+        cache = score_cache.ScoreCache(args.cache, max_size_mb=args.cache_size_mb,
+                                       store_embeddings=args.cache_embeddings or bool(heads))
+
+    jobs.create_jobs_tables(con)
+
+    timing_log = timing.TimingLog(args.timings_log, con if args.timings_table else None)
+
+    gate = None
+    if args.activity_gate:
+        gate = activity.ActivityGate(args.activity_db, args.min_activity)
 
     while( curr_date < args.end_date):
+
+        if not shards.in_shard(curr_date, args.start_date, args.shard):
+            curr_date += delta_date
+            end_date = curr_date + delta_date
+            continue
         
         print("Working with date: ", curr_date.strftime("%d-%h-%Y"))
         
-        recordings = client.query(limit=999999, type_='audio', startDate=curr_date,endDate=end_date)
+        if args.pos_only or args.ci_only:
+            recordings = client.query(limit=999999, type_='audio', startDate=curr_date,endDate=end_date)
         
-        print("  There are {:4d} recordings".format(len(recordings)))
+            print("  There are {:4d} recordings".format(len(recordings)))
         
-        if  args.pos_only:
-            # Update positions only
-            update_position(recordings,con)
-        elif args.ci_only:
-            # Update cacophony index only
-            update_ci_score(recordings,con)
-        else:     
-            score_recordings(recordings,args,con,model, client)
+            if  args.pos_only:
+                # Update positions only
+                update_position(recordings,con)
+            else:
+                # Update cacophony index only
+                update_ci_score(recordings,con)
+
+        else:
+            if args.requery or not jobs.day_enumerated(con, curr_date, args.requery_days):
+                recordings = client.query(limit=999999, type_='audio', startDate=curr_date,endDate=end_date)
+                print("  There are {:4d} recordings".format(len(recordings)))
+                jobs.add_jobs(con, curr_date, recordings)
+                con.commit()
+
+            recordings = jobs.runnable_jobs(con, curr_date, end_date, args.max_attempts,
+                                              include_skipped=gate is None)
+            print("  There are {:4d} recordings to score".format(len(recordings)))
+            score_job_recordings(recordings, args, con, model, client, cache, timing_log, gate,
+                             heads)
         
         con.commit()
         
         curr_date += delta_date
         end_date = curr_date + delta_date
 
+    if not (args.pos_only or args.ci_only):
+        retry_failed_jobs(args, con, model, client, cache, timing_log, gate, heads)
+        print("Jobs: {}".format(", ".join("{} {:d}".format(state, count)
+                                          for state, count in sorted(jobs.job_counts(con).items()))))
+
+    con.commit()
     con.close()
+    timing_log.close()
+    timing_log.print_summary()
+    if gate is not None:
+        gate.print_summary()
+    if cache is not None:
+        print("Model output cache: {:d} hits, {:d} misses".format(cache.hits, cache.misses))
+        cache.close()
+    if recordings_cache is not None:
+        recordings_cache.print_summary()
+        recordings_cache.close()
+
+def merge_shards(database, shard_databases):
+    """
+    
+    Merge the shard databases into database, creating its tables first if
+    needed (see shards.py)
+
+    Parameters
+    ----------
+    database : str
+        Main SQLite database.
+    shard_databases : list of str
+        Shard databases to merge.
+
+    Returns
+    -------
+    None.
+
+    """
+    con = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    configure_connection(con)
+    create_sql_table(con)
+    jobs.create_jobs_tables(con)
+    detections.create_detections_tables(con)
+    classifier_heads.create_head_scores_table(con)
+    con.commit()
+    for shard_database in shard_databases:
+        count = shards.merge_database(con, shard_database)
+        print("Merged {:d} new scores from {}".format(count, shard_database))
+    con.close()
+
+
+def run_shards(args):
+    """
+    
+    Run args.workers score_db.py processes, one per shard, each writing to its
+    own shard database, then merge the shard databases into args.database.
+    The shard databases are kept so an interrupted run can be resumed.
+
+    Parameters
+    ----------
+    args : dictionary 
+        Command line arguments.
+
+    Returns
+    -------
+    None.
+
+    """
+    shard_databases = []
+    processes = []
+    for i in range(args.workers):
+        shard = (i, args.workers)
+        shard_databases.append(shards.shard_file(args.database, shard))
+        command = [sys.executable, os.path.abspath(__file__)] + \
+            shards.shard_command(sys.argv[1:], shard, shard_databases[-1],
+                                 args.profile, args.timings_log)
+        processes.append(subprocess.Popen(command))
+
+    failed = [i for (i, p) in enumerate(processes) if p.wait() != 0]
+    if failed:
+        print("Shards {} failed, only merging the scores they saved".format(
+            ", ".join(str(i) for i in failed)))
+
+    merge_shards(args.database, [db for db in shard_databases if os.path.exists(db)])
+
 
 def main():
     """
@@ -484,14 +1303,53 @@ def main():
 
     args =  parse_arguments()
 
-    print("\nScoring data from server: {}".format(private_data["server"]))
+    if args.solar_backfill or args.rebuild_rollups:
+        con = sqlite3.connect(args.database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        configure_connection(con)
+        create_sql_table(con)
+        if args.solar_backfill:
+            count = solar.backfill_solar_columns(con)
+            print("Updated the solar columns of {:d} records in {}".format(count, args.database))
+        if args.rebuild_rollups:
+            rollups.rebuild_rollups(con)
+            print("Rebuilt the summary tables in {}".format(args.database))
+        con.close()
+        return
+
+    if args.merge is not None:
+        merge_shards(args.database, args.merge)
+        return
+
+    if args.workers > 1 and (args.pos_only or args.ci_only):
+        print("--pos-only and --ci-only can't be used with --workers")
+        return
+
+    if args.pipeline and args.cache is not None:
+        print("--cache can't be used with --pipeline")
+        return
+
+    if args.local_dir is not None:
+        print("\nScoring data from directory: {}".format(args.local_dir))
+    else:
+        print("\nScoring data from server: {}".format(private_data["server"]))
     print("Using recordings from {} to {}".format(args.start_date.strftime("%d-%h-%Y"),
                                                    args.end_date.strftime("%d-%h-%Y") ))
     print("Scores stored in database: {}".format(args.database))
+    if args.shard is not None:
+        print("Scoring shard {:d} of {:d}".format(*args.shard))
 
     print("\nStarted: ",datetime.datetime.today().strftime("%d-%h-%Y %H:%M:%S"))
-   
-    process_all_recordings(args)
+
+    if args.workers > 1:
+        run_shards(args)
+    elif args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.runcall(process_all_recordings, args)
+        profiler.dump_stats(args.profile)
+        print("\nProfile saved to {}, slowest functions:".format(args.profile))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    else:
+        process_all_recordings(args)
  
     
     print("\nFinished: ",datetime.datetime.today().strftime("%d-%h-%Y %H:%M:%S"))
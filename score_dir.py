@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Script to score a local directory tree of wav/mp3/mp4 files using Yamnet
+based scoring, spread over a pool of worker processes
+
+Each worker loads the model once and limits TensorFlow to
+--threads-per-worker threads so throughput scales with the number of
+workers. Results go into the same SQLite "scores" table as score_db.py,
+or into a Parquet file if the output name ends in .parquet.
+
+Recording IDs, devices, Cacophony indices and positions are taken from any
+recordings.csv files in the tree (see local_api.py). Otherwise files named
+<ID>-<DEVICE>-<YYYYMMDD>-<HHMMSS>, <YYYYMMDD>-<HHMMSS> or <YYYYMMDD>-<ID>
+(as in outliers/ and "top scorers/") give the ID, device and timestamp, and
+the parent directory is used as the device name. Files without an ID in
+their name get a negative one from the hash of their contents (see
+content_id()), so it is the same every run and can't clash with a
+Cacophony ID.
+
+@author: que
+"""
+
+import argparse
+import datetime
+import glob
+import multiprocessing
+import os
+import sqlite3
+
+import utils
+import score
+import score_cache
+import local_api
+import score_db
+import solar
+
+DEFAULT_DB_NAME = "scores_local.db"
+DEFAULT_WORKERS = os.cpu_count()
+DEFAULT_THREADS_PER_WORKER = 1
+AUDIO_SUFFIXES = (".wav", ".mp3", ".mp4")
+
+# Set in each worker process by init_worker()
+_model = None
+_options = None
+
+
+def parse_arguments():
+    """
+    
+    Parse the command line arguments
+
+    Returns
+    -------
+    Args 
+
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "directories",
+        nargs="+",
+        help="Directories to score, searched recursively" )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default = DEFAULT_DB_NAME,
+        help="Save scores into this SQlite3 Database, or Parquet file if it ends in .parquet" )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default = DEFAULT_WORKERS,
+        help="Number of worker processes" )
+
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default = DEFAULT_THREADS_PER_WORKER,
+        help="TensorFlow or TFLite threads in each worker process" )
+
+    parser.add_argument(
+        "--backend",
+        choices=utils.MODEL_BACKENDS,
+        default = "savedmodel",
+        help="Run the SavedModel or a converted TFLite model (see tflite_model.py)" )
+
+    parser.add_argument(
+        "--highpass",
+        type=int,
+        default = score_db.DEFAULT_HIGH_PASS,
+        help="Cutoff value for high pass filtering")
+
+    parser.add_argument(
+        "--lowpass",
+        type=int,
+        default = score_db.DEFAULT_LOW_PASS,
+        help="Cutoff value for low pass filtering" )
+
+    parser.add_argument(
+        "--num-offsets",
+        type=int,
+        default = score_db.DEFAULT_NUM_OFFSETS,
+        help="Number of offsets in audio file during scoring" )
+
+    parser.add_argument(
+        "--score-threshold",
+        type=float,
+        default = score_db.DEFAULT_SCORE_THRESHOLD,
+        help="Threshold for score to be counted as bird" )
+
+    parser.add_argument(
+        "--top-k-class",
+        type=int,
+        default = score_db.DEFAULT_TOP_K_CLASS,
+        help="Top N for class score to be counted as bird" )
+
+    return parser.parse_args()
+
+
+def find_audio_files(directories):
+    """
+    Return a sorted list of the wav, mp3 and mp4 files under directories
+    """
+    files = []
+    for d in directories:
+        files += [f for f in glob.glob(os.path.join(d, "**", "*"), recursive=True)
+                  if f.lower().endswith(AUDIO_SUFFIXES)]
+    return sorted(files)
+
+
+def content_id(filename):
+    """
+    Return a recording ID for a file without one in its name, the negative
+    of the first 60 bits of the SHA1 of its contents
+    """
+    return -int(score_cache.content_hash(filename)[:15], 16)
+
+
+def file_record(filename, records):
+    """
+    
+    Return a recording record for filename in the same shape as the
+    Cacophony API returns, taken from "records" (a dictionary of filename:
+    record from local_api.LocalAPI) if present, otherwise parsed from the
+    file name. The timestamp is None if it can't be parsed. <YYYYMMDD>-<ID>
+    names only give the day, so the time is taken as midnight. The ID is
+    from content_id() if the name has none.
+
+    """
+    if filename in records:
+        return records[filename]
+
+    rec = {"id": None,
+           "deviceId": 0,
+           "deviceName": os.path.basename(os.path.dirname(os.path.abspath(filename))),
+           "recordingDateTime": None}
+    fields = os.path.splitext(os.path.basename(filename))[0].split("-")
+    if len(fields) >= 4 and fields[0].isdigit():
+        rec["id"] = int(fields[0])
+        rec["deviceName"] = "-".join(fields[1:-2])
+    try:
+        ts = utils.filename_to_date("-".join(fields[-2:]))
+        rec["recordingDateTime"] = ts.isoformat()
+    except ValueError:
+        if len(fields) == 2 and fields[1].isdigit():
+            try:
+                day = datetime.datetime.strptime(fields[0], "%Y%m%d")
+                rec["id"] = int(fields[1])
+                rec["recordingDateTime"] = day.isoformat()
+            except ValueError:
+                pass
+    if rec["id"] is None:
+        rec["id"] = content_id(filename)
+    return rec
+
+
+def init_worker(options):
+    """
+    Load the model once in each worker process
+    """
+    global _model, _options
+    if options["backend"] == "savedmodel":
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(options["threads_per_worker"])
+        tf.config.threading.set_inter_op_parallelism_threads(options["threads_per_worker"])
+    _model, class_names = utils.load_model_and_class_names(
+        options["backend"], num_threads=options["threads_per_worker"])
+    _options = options
+
+
+def score_file(filename):
+    """
+    Score one file in a worker process. Returns a tuple of (filename, scores,
+    error) where scores is the (class, thresh) tuple or None if it failed.
+    """
+    try:
+        scores = score.score_audio_file(filename, _model, utils.BIRDS_CLASSES,
+                                        num_offsets=_options["num_offsets"],
+                                        low_pass_cutoff=_options["lowpass"],
+                                        high_pass_cutoff=_options["highpass"],
+                                        score_threshold=_options["score_threshold"],
+                                        top_k_scores=_options["top_k_class"],
+                                        single_pass=True)
+        return (filename, scores, None)
+    except Exception as e:
+        return (filename, None, str(e))
+
+
+def make_row(filename, scores, rec):
+    """
+    Return a row for the scores table for filename
+    """
+    if rec["recordingDateTime"] is None:
+        ts = None
+    else:
+        ts = datetime.datetime.fromisoformat(rec["recordingDateTime"])
+    (lat, long) = score_db.get_lat_long(rec)
+    return (rec["id"], ts, rec["deviceName"], rec["deviceId"], scores[1], scores[0],
+            score_db.extract_mean_ci_score(rec), lat, long) + solar.solar_columns(ts, lat, long)
+
+
+def score_files(files, records, args):
+    """
+    Score files with a pool of args.workers processes and return the list of
+    rows for the scores table in the order they finish
+    """
+    options = {"threads_per_worker": args.threads_per_worker,
+               "backend": args.backend,
+               "num_offsets": args.num_offsets,
+               "lowpass": args.lowpass,
+               "highpass": args.highpass,
+               "score_threshold": args.score_threshold,
+               "top_k_class": args.top_k_class}
+
+    rows = []
+    # Spawn rather than fork so each worker starts its own TensorFlow runtime
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(options,)) as pool:
+        for i, (filename, scores, error) in enumerate(pool.imap_unordered(score_file, files)):
+            if error is not None:
+                print("{:6d}/{:d} Failed scoring {}: {}".format(i + 1, len(files), filename, error),
+                      flush=True)
+                continue
+            print("{:6d}/{:d} {} Thresh = {:4.2f} Class = {:4.2f}".format(
+                i + 1, len(files), filename, scores[1], scores[0]), flush=True)
+            rows.append(make_row(filename, scores, file_record(filename, records)))
+    return rows
+
+
+def write_sqlite(rows, database):
+    """
+    Insert rows into the scores table of database, replacing existing rows
+    with the same ID
+    """
+    con = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    score_db.configure_connection(con)
+    score_db.create_sql_table(con)
+    con.executemany("INSERT OR REPLACE into scores (id, ts, dev_name, dev_id, thresh_score, class_score, "
+                    "ci_score, latitude, longtitude, sunrise, sunset, hours_from_sunrise) "
+                    "VALUES ( ?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+    con.commit()
+    con.close()
+
+
+def write_parquet(rows, filename):
+    """
+    Write rows to a Parquet file with the same columns as the scores table
+    """
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=["id", "ts", "dev_name", "dev_id", "thresh_score",
+                                     "class_score", "ci_score", "latitude", "longtitude",
+                                     "sunrise", "sunset", "hours_from_sunrise"])
+    df.to_parquet(filename, index=False)
+
+
+def main():
+    """
+    
+    Main routine - parses options, scores the files and saves the scores
+
+    Returns
+    -------
+    None.
+
+    """
+    args = parse_arguments()
+
+    files = find_audio_files(args.directories)
+    records = {}
+    for d in args.directories:
+        api = local_api.LocalAPI(d)
+        records.update({api.filenames[rec_id]: rec for rec_id, rec in api.recordings.items()})
+
+    print("\nScoring {:d} files with {:d} workers".format(len(files), args.workers))
+    print("Scores stored in: {}".format(args.output))
+    print("\nStarted: ",datetime.datetime.today().strftime("%d-%h-%Y %H:%M:%S"))
+
+    rows = score_files(files, records, args)
+
+    if args.output.lower().endswith(".parquet"):
+        write_parquet(rows, args.output)
+    else:
+        write_sqlite(rows, args.output)
+
+    print("\nFinished: ",datetime.datetime.today().strftime("%d-%h-%Y %H:%M:%S"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Resident scoring service. Loads the model once and scores audio sent over a
+local HTTP endpoint, combining concurrent requests into batched model calls.
+
+    python score_server.py --port 8765 --max-batch-size 8 --max-wait 0.05
+
+POST /score with either the raw audio bytes as the body (the query string
+"type" gives the format, default mp3) or a JSON body {"path": "<file>"} for a
+file under the server's --root directory (by default the one it was started
+in). Other paths, including URLs, are refused so clients can't make ffmpeg
+open anything else. The query string, or the JSON body, may also set
+lowpass, highpass, score_threshold and top_k. The reply is a JSON object
+with the same top_class_score and threshold_score as score.score_audio_file.
+GET /health returns the server settings and request counts.
+
+score_remote() is a small client for other scripts.
+
+@author: que
+"""
+
+import argparse
+import concurrent.futures
+import http.server
+import io
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import utils
+import score
+import score_db
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT = 0.05
+SAMPLE_RATE = 16000
+
+
+def parse_arguments():
+    """
+
+    Parse the command line arguments
+
+    Returns
+    -------
+    Args
+
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default = DEFAULT_HOST,
+        help="Address to listen on, only local addresses should be used" )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default = DEFAULT_PORT,
+        help="Port to listen on" )
+
+    parser.add_argument(
+        "--root",
+        type=str,
+        default = ".",
+        help="Directory that JSON {\"path\": ...} requests may read files from" )
+
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default = DEFAULT_MAX_BATCH_SIZE,
+        help="Most recordings scored in one call to the model" )
+
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default = DEFAULT_MAX_WAIT,
+        help="Seconds to wait for more requests after the first one arrives" )
+
+    parser.add_argument(
+        "--backend",
+        choices=utils.MODEL_BACKENDS,
+        default = "savedmodel",
+        help="Run the SavedModel or a converted TFLite model (see tflite_model.py)" )
+
+    parser.add_argument(
+        "--num-offsets",
+        type=int,
+        default = score_db.DEFAULT_NUM_OFFSETS,
+        help="Number of offsets in audio file during scoring" )
+
+    parser.add_argument(
+        "--highpass",
+        type=int,
+        default = score_db.DEFAULT_HIGH_PASS,
+        help="Default cutoff value for high pass filtering")
+
+    parser.add_argument(
+        "--lowpass",
+        type=int,
+        default = score_db.DEFAULT_LOW_PASS,
+        help="Default cutoff value for low pass filtering" )
+
+    parser.add_argument(
+        "--score-threshold",
+        type=float,
+        default = score_db.DEFAULT_SCORE_THRESHOLD,
+        help="Default threshold for score to be counted as bird" )
+
+    parser.add_argument(
+        "--top-k-class",
+        type=int,
+        default = score_db.DEFAULT_TOP_K_CLASS,
+        help="Default top N for class score to be counted as bird" )
+
+    return parser.parse_args()
+
+
+class Batcher:
+    """
+    Runs the model in a single thread, scoring the waveforms passed to
+    submit() in batches of up to max_batch_size. A batch is started when it
+    is full or max_wait seconds after its first waveform arrived.
+    """
+
+    def __init__(self, model, num_offsets, max_batch_size = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait = DEFAULT_MAX_WAIT):
+        self.model = model
+        self.num_offsets = num_offsets
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.recordings = 0
+        self.thread = threading.Thread(target=self.run, name="score-batcher",
+                                       daemon=True)
+        self.thread.start()
+
+    def submit(self, wave_data):
+        """
+        Queue wave_data for the model and return a Future for its
+        (outputs, offset) as returned by score.model_outputs()
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((wave_data, future))
+        return future
+
+    def close(self):
+        """
+        Stop the batching thread once the queued waveforms are scored
+        """
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        done = False
+        while not done:
+            batch = []
+            deadline = None
+            while len(batch) < self.max_batch_size:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_wait
+
+            if not batch:
+                continue
+
+            try:
+                batch_outputs = score.batch_model_outputs(
+                    self.model, [wave_data for (wave_data, future) in batch],
+                    self.num_offsets)
+            except Exception as e:
+                for (wave_data, future) in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.recordings += len(batch)
+            for (wave_data, future), outputs in zip(batch, batch_outputs):
+                future.set_result(outputs)
+
+
+def request_options(params, defaults):
+    """
+    Return the scoring options for a request from the dictionary params
+    (query string or JSON body), using defaults for any not given
+    """
+    options = dict(defaults)
+    for name, convert in (("lowpass", int), ("highpass", int),
+                          ("score_threshold", float), ("top_k", int)):
+        if params.get(name) is not None:
+            options[name] = convert(params[name])
+    options["type"] = params.get("type", "mp3")
+    return options
+
+
+def resolve_path(root, path):
+    """
+    Return the real path of the file path, relative to the directory root.
+    Raise PermissionError if it isn't an existing file under root.
+    """
+    root = os.path.realpath(root)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full_path]) != root or not os.path.isfile(full_path):
+        raise PermissionError("{} is not a file under the server's root directory".format(path))
+    return full_path
+
+
+def make_handler(batcher, defaults, root = "."):
+    """
+    Return a request handler class that scores audio with batcher, reading
+    files for JSON requests from under the directory root
+    """
+
+    class ScoreHandler(http.server.BaseHTTPRequestHandler):
+
+        def send_json(self, status, reply):
+            body = json.dumps(reply).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_json(404, {"error": "Unknown path"})
+                return
+            self.send_json(200, {"num_offsets": batcher.num_offsets,
+                                 "max_batch_size": batcher.max_batch_size,
+                                 "max_wait": batcher.max_wait,
+                                 "defaults": defaults,
+                                 "batches": batcher.batches,
+                                 "recordings": batcher.recordings})
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/score":
+                self.send_json(404, {"error": "Unknown path"})
+                return
+
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params.update(json.loads(body))
+                    (filename, stream) = (resolve_path(root, params["path"]), None)
+                else:
+                    (filename, stream) = ("", io.BytesIO(body))
+                options = request_options(params, defaults)
+
+                # Decoding runs in this request's thread, only the model is shared
+                wave_data = utils.load_audio_16k_mono(filename, out_sample_rate=SAMPLE_RATE,
+                                                      stream=stream,
+                                                      stream_type=options["type"])
+                wave_data = score.filter_wave_data(wave_data, options["lowpass"],
+                                                   options["highpass"], SAMPLE_RATE)
+                (outputs, offset) = batcher.submit(wave_data).result()
+                result = score.score_model_outputs(outputs, utils.BIRDS_CLASSES,
+                                                   score_threshold=options["score_threshold"],
+                                                   top_k_scores=options["top_k"],
+                                                   offset=offset,
+                                                   sample_rate=SAMPLE_RATE)
+            except PermissionError as e:
+                self.send_json(403, {"error": str(e)})
+                return
+            except Exception as e:
+                self.send_json(400, {"error": str(e)})
+                return
+
+            self.send_json(200, {"top_class_score": result.top_class_score,
+                                 "threshold_score": result.threshold_score})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoreHandler
+
+
+def score_remote(filename = None, audio_bytes = None, stream_type = "mp3",
+                 url = "http://{}:{}".format(DEFAULT_HOST, DEFAULT_PORT),
+                 timeout = 60, **options):
+    """
+    Score a recording with a running score_server and return the tuple
+    (top_class_score, threshold_score), the same as score.score_audio_file()
+
+    Either filename (read by the server, relative to its --root directory) or
+    audio_bytes (sent in the request) must be given. options may set lowpass, highpass, score_threshold and
+    top_k, otherwise the server's defaults are used.
+    """
+    if audio_bytes is not None:
+        query = urllib.parse.urlencode(dict(options, type=stream_type))
+        request = urllib.request.Request(url + "/score?" + query, data=audio_bytes,
+                                         headers={"Content-Type": "application/octet-stream"})
+    else:
+        body = json.dumps(dict(options, path=filename, type=stream_type)).encode("utf-8")
+        request = urllib.request.Request(url + "/score", data=body,
+                                         headers={"Content-Type": "application/json"})
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            reply = json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError("Scoring server error: {}".format(
+            json.loads(e.read()).get("error", e.reason))) from e
+    return (reply["top_class_score"], reply["threshold_score"])
+
+
+def main():
+    """
+
+    Main routine - loads the model and serves scoring requests until
+    interrupted
+
+    Returns
+    -------
+    None.
+
+    """
+
+    args = parse_arguments()
+
+    model, class_names = utils.load_model_and_class_names(args.backend)
+    batcher = Batcher(model, args.num_offsets, max_batch_size=args.max_batch_size,
+                      max_wait=args.max_wait)
+    defaults = {"lowpass": args.lowpass,
+                "highpass": args.highpass,
+                "score_threshold": args.score_threshold,
+                "top_k": args.top_k_class}
+
+    server = http.server.ThreadingHTTPServer((args.host, args.port),
+                                             make_handler(batcher, defaults, args.root))
+    print("Scoring server listening on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print("Scored {:d} recordings in {:d} batches".format(batcher.recordings,
+                                                             batcher.batches))
+
+
+if __name__ == '__main__':
+    main()
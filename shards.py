@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Splitting a score_db.py run over several processes or machines
+
+Shard i of N scores the days of the date range whose index from the start
+date is i modulo N, so every shard gets a mix of seasons, and writes to its
+own database. Days never overlap between shards, so no recording is scored
+twice. score_db.py --workers N runs N shard processes on this machine and
+merges their databases into the main one at the end. On several machines
+run score_db.py --shard i/N on each and then combine the databases with
+score_db.py --merge.
+
+Merging copies the scores, detections, head scores and jobs from the shard
+databases, keeping rows already in the main database, so merging the same
+shard twice adds nothing. The summary tables are kept up to date by their
+triggers as the scores are added. Stage timings stay in the shard
+databases, and each shard writes its own --profile and --timings-log
+files.
+
+@author: que
+"""
+
+import argparse
+import os
+
+# Tables copied by merge_database() and the conflict handling for each. Jobs
+# already scored in the main database are kept, otherwise the shard's state
+# wins.
+MERGE_TABLES = (("scores", "OR IGNORE", ""),
+                ("detections", "OR IGNORE", ""),
+                ("detection_frames", "OR IGNORE", ""),
+                ("head_scores", "OR IGNORE", ""),
+                ("jobs", "", "ON CONFLICT (id) DO UPDATE SET state = excluded.state, "
+                             "attempts = excluded.attempts, last_error = excluded.last_error, "
+                             "next_attempt = excluded.next_attempt, updated = excluded.updated "
+                             "WHERE jobs.state != 'scored'"),
+                ("days", "OR IGNORE", ""))
+
+
+def parse_shard(text):
+    """
+    Parse a shard given as "i/N" on the command line into a tuple (i, N)
+    """
+    try:
+        (index, count) = (int(x) for x in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be given as i/N, e.g. 0/4")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard i/N needs 0 <= i < N")
+    return (index, count)
+
+
+def in_shard(day, start_day, shard):
+    """
+    Return True if day is scored by shard (i, N), or if shard is None
+    """
+    if shard is None:
+        return True
+    (index, count) = shard
+    return (day - start_day).days % count == index
+
+
+def shard_file(path, shard):
+    """
+    Return the name of shard (i, N)'s own copy of the file path of a run,
+    e.g. scores.shard0of4.db for its database
+    """
+    (root, ext) = os.path.splitext(path)
+    return "{}.shard{:d}of{:d}{}".format(root, shard[0], shard[1], ext)
+
+
+def shard_command(argv, shard, database, profile = None, timings_log = None):
+    """
+    Return the command line arguments for one shard process: argv (without
+    the program name) followed by --workers 1, the shard, its database and,
+    if they are given, its own profile and timings log files from
+    shard_file(). argparse keeps the last value of an option, so these
+    replace the run's own values however they were written in argv.
+    """
+    args = list(argv) + ["--workers", "1", "--shard", "{:d}/{:d}".format(*shard),
+                         "--database", database]
+    for (option, path) in (("--profile", profile), ("--timings-log", timings_log)):
+        if path is not None:
+            args += [option, shard_file(path, shard)]
+    return args
+
+
+def table_columns(con, schema, table):
+    """
+    Return the list of the columns of schema.table, empty if there is no such
+    table
+    """
+    return [row[1] for row in con.execute("PRAGMA {}.table_info({})".format(schema, table))]
+
+
+def merge_database(con, shard_path):
+    """
+    Copy the rows from the shard database in shard_path into the database
+    con, which must already have the tables score_db.py creates, and return
+    the number of new scores. Tables missing from either database are
+    skipped and only the columns in both are copied.
+    """
+    con.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+    try:
+        before = con.execute("SELECT count(*) FROM main.scores").fetchone()[0]
+        for (table, conflict, upsert) in MERGE_TABLES:
+            main_columns = table_columns(con, "main", table)
+            columns = [c for c in table_columns(con, "shard", table) if c in main_columns]
+            if not columns:
+                continue
+            column_list = ", ".join(columns)
+            # "WHERE true" is needed for an upsert after a SELECT
+            con.execute("INSERT {} INTO main.{} ({}) SELECT {} FROM shard.{} WHERE true {}".format(
+                conflict, table, column_list, column_list, table, upsert))
+        count = con.execute("SELECT count(*) FROM main.scores").fetchone()[0] - before
+        con.commit()
+    finally:
+        con.execute("DETACH DATABASE shard")
+    return count
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Sunrise, sunset and hours from sunrise for the scores table
+
+The times are calculated with suntime, as in the analysis notebooks, once per
+(day, location rounded to LOCATION_DIGITS decimal places) and cached.
+score_db.make_score_row() stores them with each new score,
+backfill_solar_columns() fills them in for existing rows and
+update_solar_columns() recalculates them for rows whose position changed.
+
+The day of a recording is its local solar day (UTC plus longitude/15
+hours), so the results don't depend on the time zone the timestamps were
+stored in.
+
+@author: que
+"""
+
+import datetime
+import functools
+
+import numpy as np
+
+try:
+    from suntime import Sun, SunTimeException
+except ImportError:
+    # Solar columns are left empty without suntime
+    Sun = None
+
+# 2 decimal places is about 1 km, which moves sunrise by a few seconds
+LOCATION_DIGITS = 2
+BACKFILL_BATCH_SIZE = 10000
+
+
+def solar_day(ts, long):
+    """
+    Return the date at longitude "long" of the time zone aware timestamp ts,
+    using local mean solar time
+    """
+    return (ts.astimezone(datetime.timezone.utc) + datetime.timedelta(hours=long/15.0)).date()
+
+
+@functools.lru_cache(maxsize=65536)
+def utc_sun_times(day, lat, long):
+    """
+    Return a tuple of the UTC (sunrise, sunset) datetimes on the local solar
+    day "day" at lat/long, or (None, None) if the sun doesn't rise or set
+    that day
+    """
+    sun = Sun(lat, long)
+    try:
+        times = (sun.get_sunrise_time(day), sun.get_sunset_time(day))
+    except SunTimeException:
+        return (None, None)
+    # Some suntime versions return the event on the neighbouring UTC day, so
+    # move it onto the local day
+    return tuple(t + datetime.timedelta(days=(day - solar_day(t, long)).days) for t in times)
+
+
+def sun_times(ts, lat, long):
+    """
+    Return a tuple of the (sunrise, sunset) datetimes on the day of the
+    timestamp ts at lat/long, in the same time zone as ts. A naive ts is
+    taken to be local time. Both are None if they can't be calculated.
+    """
+    if Sun is None or ts is None or lat is None or long is None:
+        return (None, None)
+    if ts.tzinfo is None:
+        ts = ts.astimezone()
+    day = solar_day(ts, long)
+    times = utc_sun_times(day, round(lat, LOCATION_DIGITS), round(long, LOCATION_DIGITS))
+    return tuple(None if t is None else t.astimezone(ts.tzinfo) for t in times)
+
+
+def solar_columns(ts, lat, long):
+    """
+    Return a tuple of (sunrise, sunset, hours_from_sunrise) for a row of the
+    scores table, all None if they can't be calculated
+    """
+    (sunrise, sunset) = sun_times(ts, lat, long)
+    if sunrise is None:
+        return (None, sunset, None)
+    if ts.tzinfo is None:
+        ts = ts.astimezone()
+    return (sunrise, sunset, (ts - sunrise)/datetime.timedelta(hours=1))
+
+
+def solar_updates(rows):
+    """
+    Return a list of (sunrise, sunset, hours_from_sunrise, id) updates for
+    the scores table from (id, ts, latitude, longtitude) rows. Each distinct
+    (day, rounded location) is only calculated once and the hours from
+    sunrise are worked out for all the rows at once.
+    """
+    ids = [row[0] for row in rows]
+    times = [row[1] if isinstance(row[1], datetime.datetime)
+             else datetime.datetime.fromisoformat(row[1]) for row in rows]
+    suns = [sun_times(ts, lat, long) for (ts, (rec_id, t, lat, long)) in zip(times, rows)]
+
+    # timestamp() treats naive times as local, the same as sun_times()
+    ts_seconds = np.array([ts.timestamp() for ts in times])
+    sunrise_seconds = np.array([np.nan if sunrise is None else sunrise.timestamp()
+                                for (sunrise, sunset) in suns])
+    hours = (ts_seconds - sunrise_seconds)/3600.0
+
+    return [(sunrise, sunset, None if np.isnan(h) else float(h), rec_id)
+            for ((sunrise, sunset), h, rec_id) in zip(suns, hours, ids)]
+
+
+def update_solar_columns(con, rec_ids):
+    """
+    Recalculate the sunrise, sunset and hours_from_sunrise columns of the
+    rows of the scores table with IDs in rec_ids, which have a position and a
+    timestamp, and return the number of rows updated. The caller commits.
+    """
+    if Sun is None:
+        raise ImportError("suntime is needed to calculate the solar columns")
+
+    rec_ids = list(rec_ids)
+    updated = 0
+    for start in range(0, len(rec_ids), BACKFILL_BATCH_SIZE):
+        batch = rec_ids[start:start + BACKFILL_BATCH_SIZE]
+        # A temporary table rather than IN (...) keeps under SQLite's
+        # variable limit
+        con.execute("CREATE TEMP TABLE IF NOT EXISTS solar_ids (id INTEGER NOT NULL PRIMARY KEY)")
+        con.execute("DELETE FROM solar_ids")
+        con.executemany("INSERT OR IGNORE INTO solar_ids VALUES (?)", [(i,) for i in batch])
+        rows = con.execute("SELECT id, ts, latitude, longtitude FROM scores "
+                           "JOIN solar_ids USING (id) WHERE latitude IS NOT NULL "
+                           "AND longtitude IS NOT NULL AND ts IS NOT NULL").fetchall()
+        updates = solar_updates(rows)
+        con.executemany("UPDATE scores SET sunrise = ?, sunset = ?, hours_from_sunrise = ? "
+                        "WHERE id = ?", updates)
+        updated += len(updates)
+    return updated
+
+
+def backfill_solar_columns(con, recompute = False):
+    """
+    Fill in the sunrise, sunset and hours_from_sunrise columns of the scores
+    table in the open database con for rows with a position, and return the
+    number of rows updated. Only rows without hours_from_sunrise are updated
+    unless recompute is True.
+
+    The rows are read and updated in batches (see solar_updates()).
+    """
+    if Sun is None:
+        raise ImportError("suntime is needed to calculate the solar columns")
+
+    query = "SELECT id, ts, latitude, longtitude FROM scores WHERE id > ? " \
+            "AND latitude IS NOT NULL AND longtitude IS NOT NULL AND ts IS NOT NULL"
+    if not recompute:
+        query += " AND hours_from_sunrise IS NULL"
+    query += " ORDER BY id LIMIT ?"
+
+    updated = 0
+    last_id = -1
+    while True:
+        # Read a batch at a time by ID so the updates don't disturb the query
+        rows = con.execute(query, (last_id, BACKFILL_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = solar_updates(rows)
+        con.executemany("UPDATE scores SET sunrise = ?, sunset = ?, hours_from_sunrise = ? "
+                        "WHERE id = ?", updates)
+        updated += len(updates)
+
+    con.commit()
+    return updated
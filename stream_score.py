@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Streaming Yamnet based scoring of audio as it arrives, for example from a
+live recorder or a pipe, without waiting for the whole recording.
+
+StreamingScorer keeps only the last 0.96 s window of audio the model needs.
+Each time another 1/num_offsets of a frame hop has arrived it scores the
+latest window, so num_offsets frames are produced per hop just as
+score.score_audio_file runs the model num_offsets times at different
+offsets. Per-frame detections are returned as they are produced and the
+running threshold and top class scores are kept up to date.
+
+The scores are close to, but not exactly the same as, score_audio_file:
+
+    - Loudness is normalised with the RMS of the audio seen so far rather
+      than of the whole recording
+    - Filtering is a causal, forward only, pass (filters.bandpass_filter_chunk)
+    - The end of the stream is zero padded to one window rather than to a
+      whole number of frame hops
+
+To score a file or live input from the command line (- reads stdin):
+
+    arecord -f S16_LE -r 16000 -c 1 -t wav | python stream_score.py -
+
+@author: que
+"""
+
+import argparse
+import subprocess
+from collections import namedtuple
+
+import numpy as np
+import pydub
+
+import utils
+import score
+import filters
+import score_db
+
+DEFAULT_CHUNK_SECONDS = 0.1
+TARGET_DB = -20
+
+# One scored window of the stream, time is the end of the window in seconds
+Detection = namedtuple("Detection", ["time",
+                                     "threshold",
+                                     "top_class",
+                                     "max_bird_score"])
+
+
+class StreamingScorer:
+    """
+    Score a stream of 16 kHz mono float samples passed to process() in
+    chunks of any size. Memory use is bounded by one model window plus the
+    largest chunk.
+    """
+
+    def __init__(self, model, bird_classes,
+                 num_offsets = 3,
+                 low_pass_cutoff = None,
+                 high_pass_cutoff = None,
+                 score_threshold = 0.4,
+                 top_k_scores = 3,
+                 sample_rate = 16000,
+                 target_db = TARGET_DB):
+        self.model = model
+        self.bird_classes = bird_classes
+        self.low_pass_cutoff = low_pass_cutoff
+        self.high_pass_cutoff = high_pass_cutoff
+        self.score_threshold = score_threshold
+        self.top_k_scores = top_k_scores
+        self.sample_rate = sample_rate
+        self.target_db = target_db
+        self.step = score.PATCH_HOP_SAMPLES//num_offsets
+
+        # Ring buffer holding the most recent window of filtered samples
+        self.buffer = np.zeros(score.PATCH_WINDOW_SAMPLES, dtype=np.float32)
+        self.samples = 0
+        self.last_window_end = 0
+        self.next_window_end = score.PATCH_WINDOW_SAMPLES
+        self.filter_state = None
+        self.sum_squares = 0.0
+
+        self.num_frames = 0
+        self.threshold_frames = 0
+        self.top_class_frames = 0
+
+    @property
+    def threshold_score(self):
+        """
+        Fraction of frames so far with a bird class over the score threshold
+        """
+        return self.threshold_frames/self.num_frames if self.num_frames else 0.0
+
+    @property
+    def top_class_score(self):
+        """
+        Fraction of frames so far with a bird class in the top k classes
+        """
+        return self.top_class_frames/self.num_frames if self.num_frames else 0.0
+
+    def gain(self):
+        """
+        Return the gain that brings the RMS of the audio so far to target_db
+        """
+        if self.sum_squares <= 0:
+            return np.float32(1.0)
+        rms = np.sqrt(self.sum_squares/self.samples)
+        return np.float32(10**((self.target_db - 20*np.log10(rms))/20))
+
+    def process(self, chunk):
+        """
+        Add a chunk of samples to the stream and return the list of
+        Detections for the windows it completed
+        """
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if len(chunk) == 0:
+            return []
+        (chunk, self.filter_state) = filters.bandpass_filter_chunk(
+            chunk, self.low_pass_cutoff, self.high_pass_cutoff,
+            fs=self.sample_rate, zi=self.filter_state)
+        self.sum_squares += float(np.dot(chunk, chunk))
+
+        # Samples held in "data" run from data_start to self.samples
+        data = np.concatenate((self.buffer, chunk))
+        self.samples += len(chunk)
+        data_start = self.samples - len(data)
+
+        windows = []
+        times = []
+        while self.next_window_end <= self.samples:
+            end = self.next_window_end - data_start
+            windows.append(data[end - score.PATCH_WINDOW_SAMPLES:end])
+            times.append(self.next_window_end/self.sample_rate)
+            self.last_window_end = self.next_window_end
+            self.next_window_end += self.step
+
+        self.buffer = data[-score.PATCH_WINDOW_SAMPLES:].copy()
+        return self.score_windows(windows, times)
+
+    def flush(self):
+        """
+        Zero pad the end of the stream so its last samples are scored and
+        return the list of Detections for the final window, if any
+        """
+        if self.samples <= self.last_window_end:
+            return []
+        pad = np.zeros(self.next_window_end - self.samples, dtype=np.float32)
+        data = np.concatenate((self.buffer, pad))
+        times = [self.next_window_end/self.sample_rate]
+        self.last_window_end = self.next_window_end
+        self.next_window_end += self.step
+        return self.score_windows([data[-score.PATCH_WINDOW_SAMPLES:]], times)
+
+    def score_windows(self, windows, times):
+        """
+        Run the model once over all the windows and update the running scores
+        """
+        if not windows:
+            return []
+
+        gain = self.gain()
+        windows = [np.clip(w*gain, -1.0, (2**15 - 1)/2**15) for w in windows]
+        outputs = score.run_model(self.model, windows, single_pass=True)
+        scores_np = np.concatenate([scores for (scores, embeddings) in outputs])
+
+        (threshold_mask, top_class_mask, max_bird_score) = score.score_frames(
+            scores_np, self.bird_classes, self.score_threshold, self.top_k_scores)
+        self.num_frames += len(threshold_mask)
+        self.threshold_frames += np.count_nonzero(threshold_mask)
+        self.top_class_frames += np.count_nonzero(top_class_mask)
+
+        return [Detection(t, bool(thresh), bool(top), float(max_score))
+                for (t, thresh, top, max_score) in zip(times, threshold_mask,
+                                                       top_class_mask, max_bird_score)]
+
+
+def read_chunks(source, chunk_samples, sample_rate = 16000):
+    """
+    Decode source (a file name, or - for stdin) with ffmpeg and yield it in
+    chunks of chunk_samples mono float32 samples as the audio arrives
+    """
+    command = [pydub.AudioSegment.converter, "-v", "error",
+               "-i", "pipe:0" if source == "-" else source,
+               "-vn", "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "-"]
+    p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                         stdin=None if source == "-" else subprocess.DEVNULL)
+    try:
+        while True:
+            data = p.stdout.read(chunk_samples*4)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+    finally:
+        p.stdout.close()
+        p.wait()
+
+
+def parse_arguments():
+    """
+
+    Parse the command line arguments
+
+    Returns
+    -------
+    Args
+
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "source",
+        help="Audio file or stream to score, - to read from stdin" )
+
+    parser.add_argument(
+        "--chunk-seconds",
+        type=float,
+        default = DEFAULT_CHUNK_SECONDS,
+        help="Seconds of audio read at a time" )
+
+    parser.add_argument(
+        "--backend",
+        choices=utils.MODEL_BACKENDS,
+        default = "savedmodel",
+        help="Run the SavedModel or a converted TFLite model (see tflite_model.py)" )
+
+    parser.add_argument(
+        "--highpass",
+        type=int,
+        default = score_db.DEFAULT_HIGH_PASS,
+        help="Cutoff value for high pass filtering")
+
+    parser.add_argument(
+        "--lowpass",
+        type=int,
+        default = score_db.DEFAULT_LOW_PASS,
+        help="Cutoff value for low pass filtering" )
+
+    parser.add_argument(
+        "--num-offsets",
+        type=int,
+        default = score_db.DEFAULT_NUM_OFFSETS,
+        help="Frames scored per frame hop" )
+
+    parser.add_argument(
+        "--score-threshold",
+        type=float,
+        default = score_db.DEFAULT_SCORE_THRESHOLD,
+        help="Threshold for score to be counted as bird" )
+
+    parser.add_argument(
+        "--top-k-class",
+        type=int,
+        default = score_db.DEFAULT_TOP_K_CLASS,
+        help="Top N for class score to be counted as bird" )
+
+    parser.add_argument(
+        "-a",
+        "--all-frames",
+        action="store_true",
+        help="Print every frame, not just those with a bird" )
+
+    return parser.parse_args()
+
+
+def main():
+    """
+
+    Main routine - scores the stream, printing detections as they happen
+
+    Returns
+    -------
+    None.
+
+    """
+
+    args = parse_arguments()
+
+    model, class_names = utils.load_model_and_class_names(args.backend)
+    scorer = StreamingScorer(model, utils.BIRDS_CLASSES,
+                             num_offsets=args.num_offsets,
+                             low_pass_cutoff=args.lowpass,
+                             high_pass_cutoff=args.highpass,
+                             score_threshold=args.score_threshold,
+                             top_k_scores=args.top_k_class,
+                             sample_rate=score_db.SAMPLE_RATE)
+
+    def report(detections):
+        for d in detections:
+            if args.all_frames or d.threshold or d.top_class:
+                print("{:8.2f}s bird score {:5.3f} {}{}  (class {:5.3f}, thresh {:5.3f})".format(
+                    d.time, d.max_bird_score, "T" if d.threshold else "-",
+                    "C" if d.top_class else "-", scorer.top_class_score,
+                    scorer.threshold_score), flush=True)
+
+    chunk_samples = int(args.chunk_seconds*score_db.SAMPLE_RATE)
+    try:
+        for chunk in read_chunks(args.source, chunk_samples, score_db.SAMPLE_RATE):
+            report(scorer.process(chunk))
+    except KeyboardInterrupt:
+        pass
+    report(scorer.flush())
+
+    print("\nFrames: {:d}, class score {:5.3f}, thresh score {:5.3f}".format(
+        scorer.num_frames, scorer.top_class_score, scorer.threshold_score))
+
+
+if __name__ == '__main__':
+    main()
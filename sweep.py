@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Parameter sweeps for Yamnnet/Cacophony Audio Classification Experiments
+
+Score many scoring configurations (score_threshold, top_k_scores and bird
+class set) from a single model inference per file, filter setting and number
+of offsets. Each file is only decoded once.
+
+@author: que
+"""
+
+import glob
+import os
+
+import numpy as np
+
+import utils
+import score
+import score_cache
+
+AUDIO_SUFFIXES = (".wav", ".mp3", ".mp4")
+
+
+def sweep_outputs(outputs, bird_class_sets, score_thresholds, top_k_scores):
+    """
+    Score the per-offset model outputs from score.run_model() for every
+    combination of bird class set, score threshold and top k.
+
+    bird_class_sets is a dictionary of name: array of class indices.
+
+    Return a list of (bird_classes name, score_threshold, top_k_scores,
+    top_class_score, threshold_score) tuples
+    """
+    num_offsets = len(outputs)
+    num_frames = len(outputs[0][0])
+    scores = np.concatenate([scores_np[:num_frames] for (scores_np, embeddings_np) in outputs])
+    normalise = float(num_offsets)*float(num_frames)
+
+    thresholds = np.asarray(score_thresholds, dtype=np.float32)
+    top_k_masks = {k: score.top_k_mask(scores, k) for k in top_k_scores}
+
+    results = []
+    for name, bird_classes in bird_class_sets.items():
+        max_bird_score = np.max(scores[:, bird_classes], axis=1)
+        threshold_counts = np.count_nonzero(max_bird_score[:, None] > thresholds[None, :], axis=0)
+
+        for k in top_k_scores:
+            top_class_score = np.count_nonzero(
+                np.any(top_k_masks[k][:, bird_classes], axis=1))/normalise
+            for threshold, threshold_count in zip(score_thresholds, threshold_counts):
+                results.append((name, threshold, k, top_class_score,
+                                threshold_count/normalise))
+
+    return results
+
+
+def sweep_scores(files,
+                 model,
+                 bird_class_sets = None,
+                 filters = ((None, None),),
+                 offsets = (3,),
+                 score_thresholds = (0.4,),
+                 top_k_scores = (3,),
+                 sample_rate = 16000,
+                 single_pass = True,
+                 cache = None,
+                 verbose = False):
+    """
+    Score every file in "files" for every combination of the parameters.
+
+    filters is a sequence of (low_pass_cutoff, high_pass_cutoff) pairs and
+    offsets a sequence of num_offsets values, the model is run once for each
+    file, filter and number of offsets. bird_class_sets is a dictionary of
+    name: array of class indices and defaults to {"birds": utils.BIRDS_CLASSES}.
+    score_thresholds and top_k_scores are applied to the model outputs without
+    rerunning the model.
+
+    If cache is a score_cache.ScoreCache the model outputs are read from and
+    written to it, keyed on the file contents.
+
+    Return a pandas DataFrame with one row per file and configuration and
+    columns: filename, low_pass_cutoff, high_pass_cutoff, num_offsets,
+    bird_classes, score_threshold, top_k_scores, top_class_score and
+    threshold_score
+    """
+    if bird_class_sets is None:
+        bird_class_sets = {"birds": utils.BIRDS_CLASSES}
+
+    rows = []
+    for i, filename in enumerate(files):
+        if verbose:
+            print("{:5d}/{:d} {}".format(i + 1, len(files), filename), flush=True)
+
+        wave_data = None
+        cache_id = None
+        if cache is not None:
+            cache_id = "sha1:" + score_cache.content_hash(filename)
+
+        for (low_pass_cutoff, high_pass_cutoff) in filters:
+            filtered = None
+            for num_offsets in offsets:
+                outputs = None
+                if cache is not None:
+                    key = score_cache.make_key(cache_id, sample_rate, low_pass_cutoff,
+                                               high_pass_cutoff, num_offsets,
+                                               model_name=getattr(model, "cache_name", None))
+                    cached = cache.get(key)
+                    if cached is not None:
+                        (outputs, offset) = cached
+
+                if outputs is None:
+                    if wave_data is None:
+                        wave_data = utils.load_audio_16k_mono(filename,
+                                                              out_sample_rate=sample_rate)
+                    if filtered is None:
+                        filtered = score.filter_wave_data(wave_data, low_pass_cutoff,
+                                                          high_pass_cutoff, sample_rate)
+                    (outputs, offset) = score.model_outputs(model, filtered, num_offsets,
+                                                            single_pass=single_pass)
+                    if cache is not None:
+                        cache.put(key, outputs, offset)
+
+                for result in sweep_outputs(outputs, bird_class_sets,
+                                            score_thresholds, top_k_scores):
+                    rows.append((filename, low_pass_cutoff, high_pass_cutoff,
+                                 num_offsets) + result)
+
+    import pandas as pd
+    return pd.DataFrame(rows, columns=["filename", "low_pass_cutoff",
+                                       "high_pass_cutoff", "num_offsets",
+                                       "bird_classes", "score_threshold",
+                                       "top_k_scores", "top_class_score",
+                                       "threshold_score"])
+
+
+def sweep_directory(directory, model, **kwargs):
+    """
+    Run sweep_scores() over all the wav, mp3 and mp4 files in directory and
+    its sub-directories. Keyword arguments are passed to sweep_scores()
+    """
+    files = sorted(f for f in glob.glob(os.path.join(directory, "**", "*"), recursive=True)
+                   if f.lower().endswith(AUDIO_SUFFIXES))
+    return sweep_scores(files, model, **kwargs)
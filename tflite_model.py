@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+TFLite backend for the YAMNet model
+
+TFLiteModel wraps a TFLite interpreter so it can be called in the same way as
+the SavedModel loaded by utils.load_model_and_class_names(), returning
+(scores, embeddings, spectrogram) for a 1-D float32 waveform of any length.
+The interpreter comes from the small tflite_runtime package when it is
+installed, otherwise from TensorFlow. YAMNet, including its waveform front
+end, converts to TFLite builtin ops only, so convert_model() doesn't allow
+TensorFlow ops. Models converted elsewhere with SELECT_TF_OPS contain
+"Flex" ops that only TensorFlow's interpreter can run, so those always use
+TensorFlow.
+
+The TFLite backends are experimental: see the README for how closely their
+scores match the SavedModel's.
+
+The .tflite files are converted from yamnet_1/ once with:
+
+    python tflite_model.py --quantization fp16
+    python tflite_model.py --quantization int8
+
+int8 is dynamic range quantization, the weights are stored as int8 and the
+activations stay float, so no representative data set is needed.
+
+@author: que
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+SAVED_MODEL_DIR = "./yamnet_1/"
+CLASS_MAP_PATH = os.path.join(SAVED_MODEL_DIR, "assets", "yamnet_class_map.csv")
+QUANTIZATIONS = ("fp16", "int8")
+NUM_CLASSES = 521
+EMBEDDING_SIZE = 1024
+
+
+def tflite_path(quantization):
+    """
+    Return the path of the converted model for quantization
+    """
+    return os.path.join(SAVED_MODEL_DIR, "yamnet_{}.tflite".format(quantization))
+
+
+def convert_model(quantization, saved_model_dir = SAVED_MODEL_DIR, output = None):
+    """
+    Convert the SavedModel in saved_model_dir to a TFLite model with fp16 or
+    int8 (dynamic range) weights and save it to output, by default
+    tflite_path(quantization). Returns the output path.
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("Unknown quantization: {}".format(quantization))
+    if output is None:
+        output = tflite_path(quantization)
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "fp16":
+        converter.target_spec.supported_types = [tf.float16]
+    with open(output, "wb") as f:
+        f.write(converter.convert())
+    return output
+
+
+def uses_flex_ops(model_path):
+    """
+    Return True if the model in model_path has Flex (SELECT_TF_OPS) ops. Their
+    custom op names, e.g. FlexRFFT, are stored as plain strings in the file.
+    """
+    with open(model_path, "rb") as f:
+        return b"Flex" in f.read()
+
+
+def make_interpreter(model_path, num_threads = None):
+    """
+    Return a TFLite interpreter for model_path, from tflite_runtime if it is
+    installed and the model has no Flex ops, otherwise from TensorFlow
+    """
+    if uses_flex_ops(model_path):
+        try:
+            import tensorflow as tf
+        except ImportError:
+            raise ImportError("{} uses TensorFlow (Flex) ops, which tflite_runtime can't run, "
+                              "so TensorFlow is needed".format(model_path))
+        Interpreter = tf.lite.Interpreter
+    else:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=model_path, num_threads=num_threads)
+
+
+class TFLiteModel:
+    """
+    Callable YAMNet TFLite model returning NumPy (scores, embeddings,
+    spectrogram) arrays, the same outputs as the SavedModel
+    """
+
+    def __init__(self, model_path, num_threads = None):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                "No TFLite model {}, convert one with tflite_model.py".format(model_path))
+        self.model_path = model_path
+        # Keeps this model's outputs apart from the SavedModel's in a ScoreCache
+        self.cache_name = os.path.basename(model_path)
+        self.interpreter = make_interpreter(model_path, num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.input_length = None
+
+    def output_indices(self):
+        """
+        Return the tensor indices of (scores, embeddings, spectrogram). The
+        converter does not keep the output order, so they are told apart by
+        their last dimension.
+        """
+        indices = {}
+        for details in self.interpreter.get_output_details():
+            size = details["shape"][-1]
+            if size == NUM_CLASSES:
+                indices["scores"] = details["index"]
+            elif size == EMBEDDING_SIZE:
+                indices["embeddings"] = details["index"]
+            else:
+                indices["spectrogram"] = details["index"]
+        return (indices["scores"], indices["embeddings"], indices["spectrogram"])
+
+    def __call__(self, waveform):
+        waveform = np.asarray(waveform, dtype=np.float32)
+        # Tensors are only reallocated when the waveform length changes
+        if len(waveform) != self.input_length:
+            self.interpreter.resize_tensor_input(self.input_index, [len(waveform)])
+            self.interpreter.allocate_tensors()
+            self.input_length = len(waveform)
+            self.outputs = self.output_indices()
+        self.interpreter.set_tensor(self.input_index, waveform)
+        self.interpreter.invoke()
+        return tuple(self.interpreter.get_tensor(i).copy() for i in self.outputs)
+
+
+def main():
+    """
+    Convert yamnet_1/ to TFLite
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default="fp16")
+    parser.add_argument("--saved-model", type=str, default=SAVED_MODEL_DIR)
+    parser.add_argument("-o", "--output", type=str, default=None)
+    args = parser.parse_args()
+
+    output = convert_model(args.quantization, args.saved_model, args.output)
+    print("Saved {} ({:.1f} MB)".format(output, os.path.getsize(output)/2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Lightweight per-stage timing of the scoring path
+
+score.score_audio_file() adds the seconds spent decoding, filtering, running
+the model and counting into a "timings" dictionary when one is passed in,
+using timed(). score_db.py collects these with the download time and size of
+every recording in a TimingLog, which can also write them to a JSONL file
+and/or a "timings" table, and prints p50/p95/total per stage at the end of
+a run.
+
+@author: que
+"""
+
+import contextlib
+import datetime
+import json
+import time
+
+import numpy as np
+
+# Stages in the order they happen, for the summary
+STAGES = ("download", "cache", "decode", "filter", "gate", "model", "count", "heads",
+          "insert")
+
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    """
+    Add the seconds spent in the with block to timings[stage]. Does nothing
+    if timings is None.
+    """
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def create_timings_table(con):
+    """
+    Create the "timings" table, one row per recording and stage, if it
+    doesn't exist
+    """
+    con.execute('''CREATE TABLE IF NOT EXISTS timings
+                 (id INTEGER,
+                 logged TIMESTAMP,
+                 stage TEXT,
+                 seconds REAL,
+                 bytes INTEGER)''')
+
+
+class TimingLog:
+    """
+    Collects per-recording stage timings, optionally writing them to the
+    JSONL file log_file and/or the timings table of the database con
+    """
+
+    def __init__(self, log_file = None, con = None):
+        self.seconds = {}
+        self.bytes = 0
+        self.recordings = 0
+        self.log = None if log_file is None else open(log_file, "a")
+        self.con = con
+        if con is not None:
+            create_timings_table(con)
+
+    def record(self, rec_id, timings, num_bytes = None):
+        """
+        Record the timings dictionary {stage: seconds} for recording rec_id
+        (None for stages that cover a batch, like inserts) and the bytes
+        downloaded for it
+        """
+        for stage, seconds in timings.items():
+            self.seconds.setdefault(stage, []).append(seconds)
+        if rec_id is not None:
+            self.recordings += 1
+        if num_bytes is not None:
+            self.bytes += num_bytes
+
+        now = datetime.datetime.now()
+        if self.log is not None:
+            entry = {"id": rec_id, "time": now.isoformat(timespec="seconds"),
+                     "bytes": num_bytes}
+            entry.update(timings)
+            self.log.write(json.dumps(entry) + "\n")
+        if self.con is not None:
+            self.con.executemany("INSERT into timings (id, logged, stage, seconds, bytes) "
+                                 "VALUES (?,?,?,?,?)",
+                                 [(rec_id, now, stage, seconds,
+                                   num_bytes if stage == "download" else None)
+                                  for stage, seconds in timings.items()])
+
+    def summary(self):
+        """
+        Return a list of (stage, count, p50, p95, total seconds) tuples
+        """
+        stages = [s for s in STAGES if s in self.seconds]
+        stages += sorted(s for s in self.seconds if s not in STAGES)
+        return [(stage, len(self.seconds[stage]),
+                 float(np.percentile(self.seconds[stage], 50)),
+                 float(np.percentile(self.seconds[stage], 95)),
+                 float(np.sum(self.seconds[stage]))) for stage in stages]
+
+    def print_summary(self):
+        """
+        Print the p50, p95 and total seconds for each stage
+        """
+        if not self.seconds:
+            return
+        print("\nStage timings for {:d} recordings, {:.1f} MB downloaded:".format(
+            self.recordings, self.bytes/2**20))
+        print("  {:10s} {:>7s} {:>9s} {:>9s} {:>10s}".format("stage", "count", "p50 s",
+                                                            "p95 s", "total s"))
+        for (stage, count, p50, p95, total) in self.summary():
+            print("  {:10s} {:7d} {:9.3f} {:9.3f} {:10.1f}".format(stage, count, p50, p95, total))
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Builds the YAMNet embedding training and test sets for the classifier heads
+in Korimako_Detector.ipynb, in parallel and cached on disk
+
+This is load_data() from the notebook: every mp3 under
+<base_dir>/{training,test}/<label directory> is decoded, augmented
+num_augments times with augment_data() and remove_silence(), and run
+through YAMNet to give one 1024 element embedding per frame. Here the files
+are spread over a pool of worker processes and two caches are kept under
+cache_dir:
+
+    audio/       the decoded audio of each file, keyed on its contents
+    embeddings/  the embeddings of each augmented copy, keyed on the file
+                 contents, the augmentation settings and its seed
+
+Augmented copy i of a file is made with a random generator seeded from
+(seed, i, file contents), so the same seed gives the same augmentations
+and retraining with new hyperparameters reads the embeddings back from the
+cache instead of running YAMNet again. Use a new seed for new
+augmentations. Workers only load the model if something isn't cached.
+
+In the notebook:
+
+    import training_data
+    train_data, train_labels, test_data, test_labels = training_data.load_data(
+        "korimako_data", {"korimako": 1, "not_korimako": 0}, num_augments=5,
+        crop_prob=1.0, speed_prob=0.0, pitch_prob=0.0, noise_prob=0.6,
+        loudness_prob=0.5, top_db=15)
+
+or to build the cache from the command line:
+
+    python training_data.py korimako_data --num-augments 5 --top-db 15
+
+@author: que
+"""
+
+import argparse
+import glob
+import hashlib
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+import utils
+import activity
+import score_cache
+
+SAMPLE_RATE = 16000
+DEFAULT_CACHE_DIR = "training_cache"
+DEFAULT_WORKERS = 2
+DEFAULT_LABELS = {"korimako": 1, "not_korimako": 0}
+# load_data() in the notebook reads up to this many seconds of each file
+END_TIME = 1000
+
+# Set in each worker process by init_worker()
+_model = None
+_options = None
+
+
+def parse_arguments():
+    """
+
+    Parse the command line arguments
+
+    Returns
+    -------
+    Args
+
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "base_dir",
+        help="Directory with training/ and test/ directories of labelled mp3 files" )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default = None,
+        help="Save the training and test sets to this .npz file" )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default = DEFAULT_CACHE_DIR,
+        help="Directory for the decoded audio and embeddings caches" )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default = DEFAULT_WORKERS,
+        help="Number of worker processes, each loads its own model" )
+
+    parser.add_argument(
+        "--backend",
+        choices=utils.MODEL_BACKENDS,
+        default = "savedmodel",
+        help="Run the SavedModel or a converted TFLite model (see tflite_model.py)" )
+
+    parser.add_argument(
+        "--num-augments",
+        type=int,
+        default = 5,
+        help="Augmented copies of each file, 0 for no augmentation" )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default = 0,
+        help="Seed for the augmentations" )
+
+    parser.add_argument("--crop-prob", type=float, default=1.0)
+    parser.add_argument("--speed-prob", type=float, default=0.0)
+    parser.add_argument("--pitch-prob", type=float, default=0.0)
+    parser.add_argument("--noise-prob", type=float, default=0.6)
+    parser.add_argument("--loudness-prob", type=float, default=0.5)
+
+    parser.add_argument(
+        "--top-db",
+        type=float,
+        default = 15,
+        help="Threshold for silence in remove_silence()" )
+
+    return parser.parse_args()
+
+
+def augment_data(wav_data, sample_rate, crop_prob, speed_prob, pitch_prob,
+                 noise_prob, loudness_prob, rng = None, verbose = False):
+    """
+    Perform random augmentations on the data in wav_data (a numpy array
+    sampled at "sample_rate"), as augment_data() in the notebook
+
+    The following parameters are used to control the probability of the associated actions:
+        crop_prob: extracting a random segment of the input
+        speed_prob: adjusting the speed
+        pitch_prob: making a small adjustment to the pitch
+        noise_prob: adding random noise
+        loudness_prob: adjusting the loudness
+
+    rng is the numpy Generator for the choices. nlpaug uses the global
+    random generators, so seed those as well for repeatable results.
+
+    The modified wave data is returned
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    wd = wav_data
+
+    # Extracting out a randomly sized segment of the file.
+    if rng.uniform() < crop_prob:
+        length = len(wd)
+        # Start anywhere in the first 70% of the sample
+        start = int(rng.uniform() * length * 0.70)
+        # Select random end point in what remains, but with bias towards slightly longer extracts
+        end = min(int((start + (length-start) * rng.uniform())*1.5),length)
+        if verbose:
+            print("Extracting between {:3.1f}s and {:3.1f}".format(start/sample_rate,end/sample_rate))
+        wd = wd[start:end]
+
+    # The draws are made whether or not nlpaug is needed so the choices
+    # don't depend on which augmentations are switched on
+    (speed, pitch, noise, loudness) = rng.uniform(size=4) < (speed_prob, pitch_prob,
+                                                             noise_prob, loudness_prob)
+    if not (speed or pitch or noise or loudness):
+        return wd
+
+    # nlpaug is slow to import and only needed here
+    import nlpaug.augmenter.audio as naa
+
+    if speed:
+        if verbose:
+            print("Adjusting speed")
+        wd = naa.SpeedAug(zone=(0,1.0),coverage=1.0,factor=(0.90,1.10)).augment(wd)
+    if pitch:
+        if verbose:
+            print("Adjusting pitch")
+        wd = naa.PitchAug(zone=(0,1.0),coverage=1.0,sampling_rate=sample_rate,
+                          factor=(0.8,2.0)).augment(wd)
+    if noise:
+        if verbose:
+            print("Adding noise")
+        wd = naa.NoiseAug(zone=(0,1.0),coverage=1.0,color='pink').augment(wd)
+    if loudness:
+        if verbose:
+            print("Adjusting loudness")
+        wd = naa.LoudnessAug(zone=(0,1.0),coverage=1.0, factor=(0.2,2.0)).augment(wd)
+
+    # Some nlpaug versions return a list holding the array
+    if isinstance(wd, list):
+        wd = wd[0]
+    return np.asarray(wd, dtype=np.float32)
+
+
+def find_files(base_dir, labels_direc):
+    """
+    Return a dictionary of {"training"/"test": list of (filename, label)}
+    """
+    files = {}
+    for d in ("training", "test"):
+        files[d] = []
+        for sd, label in labels_direc.items():
+            files[d] += [(f, label) for f in sorted(glob.glob(os.path.join(base_dir, d, sd, "*.mp3")))]
+    return files
+
+
+def cache_path(cache_dir, kind, key):
+    """
+    Return the .npy file in cache_dir/kind for the key string
+    """
+    return os.path.join(cache_dir, kind, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+
+def load_cached(path):
+    """
+    Return the array saved in path, or None if it isn't there
+    """
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached(path, data):
+    """
+    Save the array data to path, via a temporary file so a half written file
+    is never read
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{:d}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_path, path)
+
+
+def augment_key(options, i):
+    """
+    Return the part of the embeddings cache key for augmented copy i
+    """
+    if options["num_augments"] == 0:
+        return "aug=none"
+    return "seed={}|aug={}|crop={}|speed={}|pitch={}|noise={}|loud={}|top_db={}".format(
+        options["seed"], i, options["crop_prob"], options["speed_prob"], options["pitch_prob"],
+        options["noise_prob"], options["loudness_prob"], options["top_db"])
+
+
+def init_worker(options):
+    """
+    Set the options in each worker process. The model is loaded on first use.
+    """
+    global _options
+    _options = options
+
+
+def get_model():
+    """
+    Return the worker's model, loading it the first time
+    """
+    global _model
+    if _model is None:
+        _model, class_names = utils.load_model_and_class_names(_options["backend"], num_threads=1)
+    return _model
+
+
+def file_embeddings(filename):
+    """
+    Return the list of embeddings arrays, one per augmented copy, for
+    filename, from the cache where possible. Runs in a worker process.
+    """
+    options = _options
+    file_hash = score_cache.content_hash(filename)
+    audio_key = "{}|sr={}|end={}".format(file_hash, SAMPLE_RATE, END_TIME)
+    model_name = options["backend"]
+
+    wav_data = None
+    results = []
+    for i in range(max(1, options["num_augments"])):
+        key = "{}|{}|model={}".format(audio_key, augment_key(options, i), model_name)
+        path = cache_path(options["cache_dir"], "embeddings", key)
+        embeddings = load_cached(path)
+        if embeddings is None:
+            if wav_data is None:
+                audio_path = cache_path(options["cache_dir"], "audio", audio_key)
+                wav_data = load_cached(audio_path)
+                if wav_data is None:
+                    wav_data = utils.load_audio_16k_mono(filename, out_sample_rate=SAMPLE_RATE,
+                                                         end_time=END_TIME)
+                    save_cached(audio_path, wav_data)
+
+            if options["num_augments"] == 0:
+                aug_data = wav_data
+            else:
+                # A different, repeatable, seed for each file and copy
+                seed = [options["seed"], i, int(file_hash[:8], 16)]
+                random.seed(str(seed))
+                np.random.seed(np.random.SeedSequence(seed).generate_state(1)[0])
+                aug_data = augment_data(wav_data, SAMPLE_RATE, options["crop_prob"],
+                                        options["speed_prob"], options["pitch_prob"],
+                                        options["noise_prob"], options["loudness_prob"],
+                                        rng=np.random.default_rng(seed))
+                aug_data = activity.remove_silence(aug_data, top_db=options["top_db"])
+                if aug_data is None:
+                    # All silent, nothing to train on
+                    aug_data = np.zeros(0, dtype=np.float32)
+
+            if len(aug_data) == 0:
+                embeddings = np.zeros((0, 1024), dtype=np.float32)
+            else:
+                (scores, embeddings, spectrogram) = get_model()(aug_data)
+                embeddings = np.asarray(embeddings, dtype=np.float32)
+            save_cached(path, embeddings)
+        results.append(embeddings)
+    return results
+
+
+def load_data(base_dir, labels_direc, num_augments, crop_prob, speed_prob,
+              pitch_prob, noise_prob, loudness_prob, top_db, seed = 0,
+              cache_dir = DEFAULT_CACHE_DIR, workers = DEFAULT_WORKERS,
+              backend = "savedmodel"):
+    """
+    Load the training data, as load_data() in Korimako_Detector.ipynb but
+    with the files shared between workers processes and the decoded audio
+    and embeddings cached in cache_dir
+
+    In base_dir there should be a training/ and a test/ dir. In each there
+    should be sub-dirs that are keys in labels_direc, holding mp3 files.
+
+    num_augments: The number of augmentations to be generated. If zero then no augmentation is performed.
+
+    The following parameters are used to control the probability of the associated actions in data augmentation:
+
+        crop_prob: extracting a random segment of the input
+        speed_prob: adjusting the speed
+        pitch_prob: making a small adjustment to the pitch
+        noise_prob: adding random noise
+        loudness_prob: adjusting the loudness
+
+    top_db is the threshold for defining "silence" in remove_silence() and
+    seed picks the augmentations.
+
+    Frames are in file order, shuffle them when training (e.g. with
+    tf.data.Dataset.shuffle()).
+
+    return a tuple of (training_data, training_labels, test_data, test_labels)
+    """
+    options = {"num_augments": num_augments,
+               "crop_prob": crop_prob,
+               "speed_prob": speed_prob,
+               "pitch_prob": pitch_prob,
+               "noise_prob": noise_prob,
+               "loudness_prob": loudness_prob,
+               "top_db": top_db,
+               "seed": seed,
+               "cache_dir": cache_dir,
+               "backend": backend}
+
+    files = find_files(base_dir, labels_direc)
+    sets = {}
+    # Spawn rather than fork so each worker starts its own TensorFlow runtime
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=init_worker, initargs=(options,)) as pool:
+        for d in ("training", "test"):
+            print("Processing {:d} {} files".format(len(files[d]), d), flush=True)
+            all_embeddings = pool.map(file_embeddings, [f for (f, label) in files[d]])
+            data = [e for file_results in all_embeddings for e in file_results]
+            labels = [np.full(len(e), label)
+                      for (f, label), file_results in zip(files[d], all_embeddings)
+                      for e in file_results]
+            sets[d] = (np.concatenate(data) if data else np.zeros((0, 1024), dtype=np.float32),
+                       np.concatenate(labels) if labels else np.zeros(0, dtype=int))
+
+    (training_data, training_labels) = sets["training"]
+    (test_data, test_labels) = sets["test"]
+
+    # Print some statistics:
+
+    num_test = len(test_data)
+    num_training = len(training_data)
+    total = num_test + num_training
+    print("\nThere are {:4d} training data items".format(num_training))
+    print("There are {:4d} test data items".format(num_test))
+
+    if total > 0:
+        print("\nTraining:Test ratio is {:2d}:{:2d}".format(round(100*num_training/total),round(100*num_test/total)))
+
+    # Want mean scores to be close to 0.5 so we have about the same number as positives as negatives
+    if num_training > 0 and num_test > 0:
+        print("\nMean training label = {:3.2f}".format(np.mean(training_labels)))
+        print("Mean test label     = {:3.2f}".format(np.mean(test_labels)))
+
+    return (training_data,training_labels,test_data,test_labels)
+
+
+def main():
+    """
+
+    Main routine - builds the training and test sets, filling the caches
+
+    Returns
+    -------
+    None.
+
+    """
+    args = parse_arguments()
+
+    (training_data, training_labels, test_data, test_labels) = load_data(
+        args.base_dir, DEFAULT_LABELS, args.num_augments, args.crop_prob,
+        args.speed_prob, args.pitch_prob, args.noise_prob, args.loudness_prob,
+        args.top_db, seed=args.seed, cache_dir=args.cache_dir,
+        workers=args.workers, backend=args.backend)
+
+    if args.output is not None:
+        np.savez(args.output, training_data=training_data, training_labels=training_labels,
+                 test_data=test_data, test_labels=test_labels)
+        print("\nSaved to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
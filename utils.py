@@ -14,30 +14,28 @@ import csv
 import io
 import os
 import os.path
-import glob
 import datetime
+import subprocess
 
 import numpy as np
-import tensorflow as tf
-import tensorflow_hub as hub
-import tensorflow_io as tfio
-
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from matplotlib import patches
-from IPython import display
 import pydub
-from scipy import signal
-import pandas as pd
+import pydub.exceptions
+
+import filters
 
 BIRDS_CLASSES = np.array([93,93,95,96,97,98,99,100,101,102,106,107,108,109,110,111,113,114,115])
 
-def load_model_and_class_names():
+MODEL_BACKENDS = ("savedmodel", "tflite-fp16", "tflite-int8")
+
+def load_model_and_class_names(backend="savedmodel", num_threads=None):
     """
     Use tensorflow_hub to load the pre-trained model and a list of all the 521 class names:
+
+    backend "tflite-fp16" or "tflite-int8" loads the converted TFLite model
+    instead (see tflite_model.py), which is called in the same way and
+    returns (scores, embeddings, spectrogram) as NumPy arrays. num_threads
+    sets the TFLite interpreter threads.
     """
-    # Load the model.
-    model = hub.load("./yamnet_1/")
 
     # Find the name of the class with the top score when mean-aggregated across frames.
     def class_names_from_csv(class_map_csv_text):
@@ -46,6 +44,23 @@ def load_model_and_class_names():
         class_names = [display_name for (class_index, mid, display_name) in csv.reader(class_map_csv)]
         class_names = class_names[1:]  # Skip CSV header
         return class_names
+
+    if backend != "savedmodel":
+        if backend not in MODEL_BACKENDS:
+            raise ValueError("Unknown model backend: {}".format(backend))
+        import tflite_model
+        model = tflite_model.TFLiteModel(tflite_model.tflite_path(backend.split("-")[1]),
+                                         num_threads=num_threads)
+        with open(tflite_model.CLASS_MAP_PATH) as f:
+            return (model, class_names_from_csv(f.read()))
+
+    # TensorFlow is imported here so the rest of this module loads quickly
+    import tensorflow as tf
+    import tensorflow_hub as hub
+
+    # Load the model.
+    model = hub.load("./yamnet_1/")
+
     class_map_path = model.class_map_path().numpy()
     class_names = class_names_from_csv(tf.io.read_file(class_map_path).numpy().decode('utf-8'))
     
@@ -58,17 +73,30 @@ def load_audio_16k_mono(filename, out_sample_rate=16000, target_db = -20,
     """ Load an audio file in WAV or MP3/MP4 format based on the suffix,
     convert it to a float tensor, resample to 16 kHz single-channel audio. 
 
-    Sound files will be standardized to have average amplitude of target_db
+    Only the window from start_time to end_time (in seconds) is decoded:
+    ffmpeg seeks to start_time and downmixes and resamples straight to mono
+    float32 at out_sample_rate.
 
-    Start and end times are in seconds
+    Sound files will be standardized to have average amplitude of target_db,
+    measured over the decoded window
 
     if stream is not None then it's treated as a readable object (an open file
-    or a BytesIO stream). In this case the type is specified by "stream_type"
+    or a BytesIO stream). In this case the type is specified by "stream_type",
+    an ffmpeg input format such as "mp4", "mp3" or "wav". If stream_type is
+    None ffmpeg detects the format from the data.
 
     """
 
+    command = [pydub.AudioSegment.converter, "-nostdin", "-v", "error",
+               "-ss", str(start_time), "-t", str(end_time - start_time)]
+
     if stream is not None:
-        a = pydub.AudioSegment.from_file(stream, stream_type)
+        # The cache: protocol lets ffmpeg seek within piped input, which is
+        # needed for mp4 files with the index at the end
+        if stream_type is not None:
+            command += ["-f", stream_type]
+        command += ["-i", "cache:pipe:0"]
+        input_data = stream.read()
         
     else:
     
@@ -77,54 +105,52 @@ def load_audio_16k_mono(filename, out_sample_rate=16000, target_db = -20,
         except:
             "Unknown file suffix for {}".format(filename)
         suffix = suffix.lower()
-        if suffix == '.wav':
-            file_type = "wav"
-        elif suffix == '.mp3':
-            file_type = "mp3"
-        elif suffix == '.mp4':
-            file_type = "mp4"
-        else:
+        if suffix not in ('.wav', '.mp3', '.mp4'):
             print("Unknown file type: {}".format(filename))
             raise ValueError
 
-        a = pydub.AudioSegment.from_file(filename, file_type)
+        command += ["-i", filename]
+        input_data = None
+
+    command += ["-vn", "-ac", "1", "-ar", str(out_sample_rate), "-f", "f32le", "-"]
+    p = subprocess.run(command, input=input_data, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise pydub.exceptions.CouldntDecodeError(
+            "Decoding failed. ffmpeg returned error code: {}\n\n{}".format(
+                p.returncode, p.stderr.decode(errors="replace")))
 
+    wav = np.frombuffer(p.stdout, dtype=np.float32).copy()
 
-    # Resample to frame rate:
-    a = a.set_frame_rate(out_sample_rate)
-    # Normalize volume:
-    gain_change = target_db - a.dBFS
-    a = a.apply_gain(gain_change)
+    # Normalize volume, clipping as pydub does for 16 bit samples:
+    rms = np.sqrt(np.mean(np.square(wav, dtype=np.float64))) if len(wav) else 0.0
+    if rms > 0:
+        gain_change = target_db - 20*np.log10(rms)
+        wav *= np.float32(10**(gain_change/20))
+        np.clip(wav, -1.0, (2**15 - 1)/2**15, out=wav)
 
-    wav = np.array(a.get_array_of_samples(), dtype='float32')
-    wav = np.float32(wav) / 2**15
-    if a.channels == 2:
-        wav = wav.reshape((-1, 2))
-    return wav[out_sample_rate*start_time:out_sample_rate*end_time]  
+    return wav
+
+
+def client_stream_type(client):
+    """
+    Return the stream_type to decode recordings from client.download_raw()
+    with: the client's stream_type attribute if it has one (see local_api.py),
+    otherwise "mp4" as served by the Cacophony API
+    """
+    return getattr(client, "stream_type", "mp4")
 
 
 
-# High and Low Pass filters based on sci-py
+# High and Low Pass filters based on sci-py, see filters.py
 
 def butter_highpass_filter(data, cutoff, fs, order=5):
-    def butter_highpass(cutoff, fs, order=5):
-        nyq = 0.5 * fs
-        normal_cutoff = cutoff / nyq
-        b, a = signal.butter(order, normal_cutoff, btype='high', analog=False)
-        return b, a
-    b, a = butter_highpass(cutoff, fs, order=order)
-    y = signal.filtfilt(b, a, data)
-    return y
+    return filters.bandpass_filter(data, high_pass_cutoff=cutoff, fs=fs,
+                                   order=order)
 
 def butter_lowpass_filter(data, cutoff, fs, order=5):
-    def butter_lowpass(cutoff, fs, order=5):
-        nyq = 0.5 * fs
-        normal_cutoff = cutoff / nyq
-        b, a = signal.butter(order, normal_cutoff, btype='low', analog=False)
-        return b, a
-    b, a = butter_lowpass(cutoff, fs, order=order)
-    y = signal.filtfilt(b, a, data)
-    return y
+    return filters.bandpass_filter(data, low_pass_cutoff=cutoff, fs=fs,
+                                   order=order)
 
 
 def filename_to_date(filename):